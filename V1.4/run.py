@@ -48,14 +48,25 @@ from kivymd.uix.list import MDListItem, MDListItemLeadingIcon, MDListItemHeadlin
 from threading import Thread
 import threading
 import queue
+import time
 import weakref
 
 # 导入 tool 模块
 from tool.async_api_client import get_async_api_client, stop_async_api_client
+from tool.api_client import invalidate_api_clients, configure_response_cache
+from tool.model_router import get_model_router
+from tool.hedging import HedgePolicy
+from tool.context_builder import ContextWindow, context_budget, estimate_tokens, DEFAULT_CONTEXT_TOKENS, DEFAULT_BLOCK_FRACTION
+from tool.conversation_summary import configure_conversation_summarizer, get_conversation_summarizer
+from tool.persistence_worker import get_persistence_worker, stop_persistence_worker
+from tool.chat_compactor import get_chat_compactor, stop_chat_compactor
+from tool.atomic_io import atomic_write_text, load_json_with_backup
+from tool.data_saver import use_sqlite_backend
 from tool.image_loader import load_background_image
 from tool.data_loader import load_data_from_folder
 from tool.ui_helpers import toast, CopyLabel
 from tool.character_manager import CharacterManager  # 导入角色管理器
+from tool.character_paths import CharacterPathResolver
 from tool.platform_utils import fix_window_size_for_desktop, ensure_dir, get_storage_path, request_android_storage_permission, is_android
 import json
 import os
@@ -64,10 +75,19 @@ import os
 character_data_lock = threading.Lock()
 data = []
 
+# 聊天记录分页大小：启动时只加载最近的记录，向上滚动时按页加载更早的记录
+HISTORY_PAGE_SIZE = 50
+
+# 聊天日志后台压缩：无操作超过 COMPACTION_IDLE_SECONDS 秒后，每 COMPACTION_CHECK_INTERVAL 秒检查一次
+COMPACTION_IDLE_SECONDS = 120
+COMPACTION_CHECK_INTERVAL = 60
+
 # 配置管理器类
 class ConfigManager:
     _instance = None
-    _lock = threading.Lock()
+    _lock = threading.RLock()
+    # 修改配置后延迟写盘的秒数，期间的多次修改合并为一次写入
+    SAVE_DELAY = 1.0
     
     def __new__(cls):
         if cls._instance is None:
@@ -81,30 +101,63 @@ class ConfigManager:
         if not self._initialized:
             self.config_path = os.path.join(get_storage_path(), "config", "config.json")
             self._config = None
+            self._dirty = False
+            self._save_timer = None
+            self._write_lock = threading.Lock()  # 串行化写盘，保证后写入的版本不会被先写入的覆盖
             self.load_config()
             self._initialized = True
     
     def load_config(self):
         with self._lock:
-            if os.path.exists(self.config_path):
+            if os.path.exists(self.config_path) or os.path.exists(self.config_path + ".bak"):
                 try:
-                    with open(self.config_path, 'r', encoding='utf-8') as f:
-                        self._config = json.load(f)
+                    # 主文件损坏时回退到上一版本备份
+                    self._config = load_json_with_backup(self.config_path)
+                    if self._config is None:
+                        raise ValueError("配置文件及备份均已损坏")
                 except (json.JSONDecodeError, Exception) as e:
                     print(f"加载配置文件失败: {e}")
                     self._config = self._get_default_config()
             else:
                 self._config = self._get_default_config()
-                self.save_config()
+                self._dirty = True
+        # 在锁外写盘（flush 会自己加锁）
+        self.flush()
     
     def save_config(self):
+        """立即保存配置"""
         with self._lock:
+            self._dirty = True
+        self.flush()
+    
+    def _schedule_save(self):
+        """标记配置已修改，并在 SAVE_DELAY 秒后于后台线程写盘（调用方持有锁）"""
+        self._dirty = True
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+        self._save_timer = threading.Timer(self.SAVE_DELAY, self.flush)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+    
+    def flush(self):
+        """如有未保存的修改，立即写盘"""
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                # 在锁内序列化快照，写盘在锁外进行，不阻塞其他线程读写配置
+                text = json.dumps(self._config, ensure_ascii=False, indent=2)
+                self._dirty = False
             try:
                 ensure_dir(os.path.dirname(self.config_path))
-                with open(self.config_path, 'w', encoding='utf-8') as f:
-                    json.dump(self._config, f, ensure_ascii=False, indent=2)
+                atomic_write_text(self.config_path, text, backup=True)
             except Exception as e:
                 print(f"保存配置文件失败: {e}")
+                with self._lock:
+                    self._dirty = True
     
     def _get_default_config(self):
         return {
@@ -135,15 +188,38 @@ class ConfigManager:
                 return default
         return value
     
-    def set(self, key, value):
+    def _set_value(self, key, value):
+        """写入内存中的配置，返回值是否发生变化"""
         keys = key.split('.')
         config = self._config
         for k in keys[:-1]:
             if k not in config:
                 config[k] = {}
             config = config[k]
+        if keys[-1] in config and config[keys[-1]] == value:
+            return False
         config[keys[-1]] = value
-        self.save_config()
+        return True
+    
+    def set(self, key, value):
+        """修改一项配置（延迟合并写盘）"""
+        with self._lock:
+            if self._set_value(key, value):
+                self._schedule_save()
+    
+    def update(self, values):
+        """
+        批量修改配置，只写盘一次
+        
+        Args:
+            values: {"点分隔的键": 值} 字典
+        """
+        with self._lock:
+            changed = False
+            for key, value in values.items():
+                changed = self._set_value(key, value) or changed
+            if changed:
+                self._schedule_save()
 
 # 全局配置管理器实例
 config_manager = ConfigManager()
@@ -238,6 +314,27 @@ class Example(MDApp):
         
         # 存储最后发送的用户消息（用于API失败时重试）
         self._last_user_message = None
+        
+        # 懒加载聊天记录状态：data[0] 在日志中的位置、data 中已显示的起始位置
+        self._history_start = 0
+        self._displayed_start = 0
+        self._current_data_file = None
+        self._loading_older = False
+        # 角色名 -> 聊天记录文件路径（配置重新加载时自动失效，增删角色时手动失效）
+        self.character_paths = CharacterPathResolver(lambda: config_manager._config)
+        # 消息 id -> data 中的消息记录，编辑/撤回时直接按 id 定位
+        self._message_index = {}
+        # 发送给AI的上下文窗口（按token预算增量维护，不必每轮重新扫描聊天记录）
+        self._context_window = ContextWindow()
+        # ((聊天记录文件, 窗口 generation), 摘要消息)：窗口前移之前沿用同一份摘要，保持上下文开头不变
+        self._pinned_summary = None
+        # 最近一次用户操作或AI回复的时间，用于判断是否空闲
+        self._last_activity = time.time()
+        # 流式回复中正在生成的AI消息卡片及其已收到的文本
+        self._streaming_label = None
+        self._streaming_text = ""
+        # 当前等待回复的AI请求句柄（切换角色、撤回、重新生成时取消）
+        self._ai_request = None
 
     def get_application_name(self):
         """设置应用程序标题"""
@@ -270,8 +367,23 @@ class Example(MDApp):
         thread = Thread(target=self._load_data_async, daemon=True)
         thread.start()
         
-        # 初始化异步API客户端
-        self.async_client = get_async_api_client()
+        # 初始化异步API客户端（config: app.api_engine = "thread" | "asyncio"），并在后台预热API连接
+        self.async_client = get_async_api_client(config_manager.get("app.api_engine", "thread"))
+        self.async_client.warm_up_async()
+        # 可选：相同请求直接使用缓存的回复（config: app.response_cache，默认关闭）
+        configure_response_cache(config_manager.get("app.response_cache"))
+        # 可选：把移出上下文窗口的较早对话总结成摘要（config: app.conversation_summary，默认关闭）
+        configure_conversation_summarizer(config_manager.get("app.conversation_summary"))
+        # 可选：首字节迟迟未到时发出对冲请求（config: app.hedging，默认关闭）
+        self.async_client.set_hedging(HedgePolicy.from_config(config_manager.get("app.hedging")))
+        # 模型不可用时在可用模型之间自动切换（config: app.model_routing = "pinned" | "auto" | "off"）
+        self._configure_model_router()
+        
+        # 启动聊天记录持久化线程
+        get_persistence_worker()
+        
+        # 空闲时在后台压缩聊天日志
+        Clock.schedule_interval(self._maybe_compact_history, COMPACTION_CHECK_INTERVAL)
         
         # 从配置管理器读取默认模型
         self.current_model = config_manager.get("openai.model", "gemini-2.5-flash")
@@ -314,6 +426,13 @@ class Example(MDApp):
         # 添加主题切换功能
         self.theme_cls.theme_style = "Light"  # 默认浅色模式
         
+        # 可选的 SQLite 存储后端（config: app.storage_backend = "sqlite"），必须在加载角色之前启用
+        if config_manager.get("app.storage_backend", "json") == "sqlite":
+            try:
+                use_sqlite_backend()
+            except Exception as e:
+                print(f"启用SQLite存储后端失败，继续使用JSON文件: {e}")
+        
         # 初始化角色管理器
         self.character_manager = CharacterManager()
         self.character_manager.load_characters_from_config()
@@ -447,6 +566,8 @@ class Example(MDApp):
         )
         self.chat_history_layout.bind(minimum_height=self.chat_history_layout.setter('height'))
         self.chat_history.add_widget(self.chat_history_layout)
+        # 滚动到顶部时按需加载更早的聊天记录
+        self.chat_history.bind(scroll_y=self._on_chat_history_scroll)
 
         # 输入区域
         self.input_layout = MDBoxLayout(
@@ -536,42 +657,22 @@ class Example(MDApp):
         try:
             # 获取当前角色的聊天记录文件路径
             current_character = self.character_manager.current_character
-            character_data_file = None
-            
-            try:
-                config = config_manager._config
-                
-                if "characters" in config.get("app", {}):
-                    for char in config["app"]["characters"]:
-                        if char['name'] == current_character:
-                            data_file = char.get('data_file', f"data/chat_history_{current_character}.json")
-                            # 确保使用完整路径，特别是在移动端
-                            if not os.path.isabs(data_file):
-                                character_data_file = os.path.join(get_storage_path(), data_file)
-                            else:
-                                character_data_file = data_file
-                            break
-            except Exception as e:
-                print(f"读取角色配置时出错: {e}")
-            
-            if not character_data_file:
-                if current_character and current_character != "默认角色":
-                    character_data_file = os.path.join(get_storage_path(), "data", f"chat_history_{current_character}.json")
-                else:
-                    character_data_file = os.path.join(get_storage_path(), "data", "chat_data.json")
+            character_data_file = self._get_character_data_file(current_character)
             
             print(f"正在加载角色 '{current_character}' 的聊天记录文件: {character_data_file}")
             
-            # 只加载当前角色的聊天记录文件
+            # 只加载当前角色最近的聊天记录（数量足够构建上下文即可）
             try:
-                from tool.data_saver import load_chat_data
-                # 为每个角色维护独立的数据副本，避免全局变量污染
-                character_data = load_chat_data(character_data_file)
-                data = character_data.copy()  # 使用副本避免异步竞争
-                print(f"成功加载 {len(data)} 条聊天记录")
+                data, self._history_start = self._load_history_tail(character_data_file)
+                print(f"成功加载 {len(data)} 条聊天记录（从第 {self._history_start} 条开始）")
             except Exception as e:
                 print(f"加载角色聊天记录时出错: {e}")
                 data = []
+                self._history_start = 0
+            self._current_data_file = character_data_file
+            self._displayed_start = max(len(data) - HISTORY_PAGE_SIZE, 0)
+            self._message_index = {}
+            self._index_messages(data)
         finally:
             # 确保锁被释放
             character_data_lock.release()
@@ -579,36 +680,149 @@ class Example(MDApp):
         # 回到主线程添加 UI 控件（批量添加可减少重排）
         Clock.schedule_once(self._add_ui_items, 0)
 
+    def _get_character_data_file(self, character=None):
+        """获取角色（默认为当前角色）的聊天记录文件完整路径"""
+        if character is None:
+            character = self.character_manager.get_current_character()
+        return self.character_paths.resolve(character)
+    
+    def _load_history_tail(self, character_data_file):
+        """只读取最近的聊天记录：至少一页，且足够构建AI上下文"""
+        from tool.data_saver import load_chat_tail, merge_pending_records
+        # 不等待后台线程写盘（会阻塞主线程）：先取出尚未写入的记录，读取后合并
+        pending = get_persistence_worker().pending_records(character_data_file)
+        context_length = getattr(self, 'current_context_length', 50)
+        messages, start = load_chat_tail(character_data_file, max(HISTORY_PAGE_SIZE, context_length))
+        return merge_pending_records(messages, pending), start
+    
+    def _maybe_compact_history(self, dt):
+        """应用空闲且没有待写入的记录时，启动一轮后台压缩（跳过正在显示的会话）"""
+        if time.time() - self._last_activity < COMPACTION_IDLE_SECONDS:
+            return
+        if get_persistence_worker().pending_count():
+            return
+        get_chat_compactor().request_compaction(exclude=[self._current_data_file])
+    
+    def _index_messages(self, messages):
+        """将消息加入 id 索引"""
+        for message in messages:
+            if isinstance(message, dict) and 'id' in message:
+                self._message_index[message['id']] = message
+    
+    def _remove_messages(self, message_ids):
+        """按 id 从 data 中移除消息（从末尾向前查找，最近的消息几乎立即命中）"""
+        global data
+        
+        targets = [self._message_index.pop(message_id, None) for message_id in message_ids]
+        for target in targets:
+            if target is None:
+                continue
+            for i in range(len(data) - 1, -1, -1):
+                if data[i] is target:
+                    del data[i]
+                    self._context_window.remove(target)
+                    if i < self._displayed_start:
+                        self._displayed_start -= 1
+                    break
+    
+    def _create_message_label(self, item):
+        """根据消息记录创建 CopyLabel"""
+        # 检查数据结构，提取角色信息和内容
+        if isinstance(item, dict):
+            # 如果是字典格式，提取 role、content 和 id
+            role = item.get('role', 'assistant')
+            text = item.get('content', '')
+            message_id = item.get('id')
+        else:
+            # 如果是纯文本格式，默认为 assistant 角色
+            role = 'assistant'
+            text = str(item)
+            message_id = None
+        
+        # 创建 CopyLabel 时传入角色信息和消息 id
+        if role == 'user':
+            copy_label = CopyLabel(text=text, message_role=role, message_id=message_id, on_double_tap_callback=self._handle_user_message_double_tap)
+        elif role == 'assistant':
+            copy_label = CopyLabel(text=text, message_role=role, message_id=message_id, on_double_tap_callback=self._handle_ai_message_double_tap)
+        else:
+            copy_label = CopyLabel(text=text, message_role=role, message_id=message_id)
+        copy_label.bind(on_selection=self.open_context_menu)
+        return copy_label
+    
     def _add_ui_items(self, dt):
-        """在主线程中逐个添加 CopyLabel 到 box（限制初始数量加快显示）。"""
-        limit = 50  # 只初始显示前 50 条
-        for i, item in enumerate(data[:limit]):
-            # 检查数据结构，提取角色信息和内容
-            if isinstance(item, dict):
-                # 如果是字典格式，提取 role 和 content
-                role = item.get('role', 'assistant')
-                content = item.get('content', '')
-                text = content
-            else:
-                # 如果是纯文本格式，默认为 assistant 角色
-                role = 'assistant'
-                text = str(item)
-            
-            # 创建 CopyLabel 时传入角色信息
-            if role == 'user':
-                copy_label = CopyLabel(text=text, message_role=role, on_double_tap_callback=self._handle_user_message_double_tap)
-            elif role == 'assistant':
-                copy_label = CopyLabel(text=text, message_role=role, on_double_tap_callback=self._handle_ai_message_double_tap)
-            else:
-                copy_label = CopyLabel(text=text, message_role=role)
-            copy_label.bind(on_selection=self.open_context_menu)
-            self.chat_history_layout.add_widget(copy_label)
-
-        # 若有更多数据，可在用户滚动时按需加载（这里先不实现）
+        """在主线程中逐个添加 CopyLabel 到 box（只显示最近一页，更早的记录滚动到顶部时再加载）。"""
+        for item in data[self._displayed_start:]:
+            self.chat_history_layout.add_widget(self._create_message_label(item))
         
         # 延迟滚动到底部
         Clock.schedule_once(lambda dt: self._scroll_to_bottom(), 0.1)
     
+    def _on_chat_history_scroll(self, instance, scroll_y):
+        """滚动到顶部时加载更早的一页聊天记录"""
+        if scroll_y >= 1 and not self._loading_older:
+            self._loading_older = True
+            Clock.schedule_once(lambda dt: self._load_older_messages(), 0)
+    
+    def _load_older_messages(self):
+        """在聊天区域顶部插入更早的一页消息：先用内存中未显示的，再在后台线程从日志按页读取"""
+        if self._displayed_start == 0 and self._history_start > 0 and self._current_data_file:
+            # 读取可能要解压已封存的分段，放到后台线程，避免滚动到顶部时界面卡顿
+            thread = Thread(target=self._load_older_page_async,
+                            args=(self._current_data_file, self._history_start), daemon=True)
+            thread.start()
+            return
+        self._show_older_messages()
+    
+    def _load_older_page_async(self, data_file, end_index):
+        """在后台线程中读取一页更早的聊天记录，然后回到主线程插入"""
+        older, start = [], end_index
+        try:
+            from tool.data_saver import load_chat_page
+            older, start = load_chat_page(data_file, end_index, HISTORY_PAGE_SIZE)
+        except Exception as e:
+            print(f"加载更早聊天记录时出错: {e}")
+        finally:
+            Clock.schedule_once(lambda dt: self._insert_older_page(data_file, end_index, older, start), 0)
+    
+    def _insert_older_page(self, data_file, end_index, older, start):
+        """在主线程中把后台读取的一页更早记录并入 data 并显示"""
+        global data
+        
+        # 读取期间切换了角色或重新加载了聊天记录，这一页已经过时
+        if data_file != self._current_data_file or end_index != self._history_start:
+            self._loading_older = False
+            return
+        character_data_lock.acquire()
+        try:
+            data = older + data
+            self._displayed_start += len(older)
+            self._history_start = start
+            self._index_messages(older)
+        finally:
+            character_data_lock.release()
+        self._show_older_messages()
+    
+    def _show_older_messages(self):
+        """显示 data 中尚未显示的更早一页消息，完成后允许再次加载"""
+        try:
+            if self._displayed_start == 0:
+                return
+            
+            new_start = max(self._displayed_start - HISTORY_PAGE_SIZE, 0)
+            children = self.chat_history_layout.children
+            anchor = children[-1] if children else None
+            # children 顺序与显示顺序相反，从新到旧逐条插入到顶部
+            for item in reversed(data[new_start:self._displayed_start]):
+                self.chat_history_layout.add_widget(self._create_message_label(item), index=len(children))
+            self._displayed_start = new_start
+            print(f"已加载更早的聊天记录，当前显示从第 {self._history_start + new_start} 条开始")
+            
+            # 保持原先顶部的消息停留在视野内，避免界面跳动
+            if anchor is not None:
+                Clock.schedule_once(lambda dt: self.chat_history.scroll_to(anchor, padding=0, animate=False), 0)
+        finally:
+            self._loading_older = False
+    
     def _scroll_to_bottom(self):
         """滚动到底部"""
         if hasattr(self, 'chat_history'):
@@ -1194,55 +1408,26 @@ class Example(MDApp):
             self.chat_history_layout.clear_widgets()
             
             # 获取角色对应的数据文件路径
-            character_data_file = None
-            try:
-                config = config_manager._config
-                
-                if "characters" in config.get("app", {}):
-                    for char in config["app"]["characters"]:
-                        if char['name'] == character:
-                            data_file = char.get('data_file', os.path.join(get_storage_path(), "data", f"chat_history_{character}.json"))
-                            # 确保使用完整路径，特别是在移动端
-                            if not os.path.isabs(data_file):
-                                character_data_file = os.path.join(get_storage_path(), data_file)
-                            else:
-                                character_data_file = data_file
-                            break
-            except Exception as e:
-                print(f"读取角色配置时出错: {e}")
-            
-            if not character_data_file:
-                if character and character != "默认角色":
-                    character_data_file = os.path.join(get_storage_path(), "data", f"chat_history_{character}.json")
-                else:
-                    character_data_file = os.path.join(get_storage_path(), "data", "chat_data.json")
+            character_data_file = self._get_character_data_file(character)
             
             print(f"正在加载角色 '{character}' 的聊天记录文件: {character_data_file}")
             
-            # 加载聊天记录
-            from tool.data_saver import load_chat_data
-            chat_history = load_chat_data(character_data_file)
+            # 只加载最近的聊天记录，更早的记录滚动到顶部时再加载
+            chat_history, self._history_start = self._load_history_tail(character_data_file)
+            self._current_data_file = character_data_file
             
             # 更新全局数据 - 使用角色专属的数据副本
-            data = chat_history.copy() if chat_history else []
+            data = chat_history
+            self._displayed_start = max(len(data) - HISTORY_PAGE_SIZE, 0)
+            self._message_index = {}
+            self._index_messages(data)
             
             # 显示聊天记录
             if chat_history:
-                print(f"找到 {len(chat_history)} 条聊天记录")
-                for message in chat_history:
-                    role = message.get('role', 'assistant')
-                    content = message.get('content', '')
-                    
-                    if content:  # 只显示有内容的消息
-                        # 根据角色绑定双击事件
-                        if role == 'user':
-                            message_label = CopyLabel(text=content, message_role=role, on_double_tap_callback=self._handle_user_message_double_tap)
-                        elif role == 'assistant':
-                            message_label = CopyLabel(text=content, message_role=role, on_double_tap_callback=self._handle_ai_message_double_tap)
-                        else:
-                            message_label = CopyLabel(text=content, message_role=role)
-                        message_label.bind(on_selection=self.open_context_menu)
-                        self.chat_history_layout.add_widget(message_label)
+                print(f"找到 {len(chat_history)} 条最近的聊天记录")
+                for message in chat_history[self._displayed_start:]:
+                    if message.get('content', ''):  # 只显示有内容的消息
+                        self.chat_history_layout.add_widget(self._create_message_label(message))
             else:
                 print("该角色暂无聊天记录")
             
@@ -1253,6 +1438,9 @@ class Example(MDApp):
             print(f"加载角色聊天记录时出错: {e}")
             # 出错时显示默认数据
             data = []
+            self._history_start = 0
+            self._displayed_start = 0
+            self._message_index = {}
         finally:
             # 确保锁被释放
             character_data_lock.release()
@@ -1265,6 +1453,9 @@ class Example(MDApp):
         self.character_drawer.dismiss()
         print(f"主程序收到角色切换: {character}")
         
+        # 取消旧角色尚未完成的AI请求，避免回复写入新角色的聊天记录
+        self._cancel_ai_request()
+        
         # 立即清空当前数据，避免异步加载时的数据污染
         character_data_lock.acquire()
         try:
@@ -1279,12 +1470,15 @@ class Example(MDApp):
     def on_character_added(self, character: str) -> None:
         """角色添加回调"""
         print(f"主程序收到角色添加: {character}")
+        self.character_paths.invalidate()
     
     def on_character_deleted(self, deleted_character: str, new_current_character: str) -> None:
         """角色删除回调"""
         global data
         
         print(f"主程序收到角色删除: {deleted_character}，新当前角色: {new_current_character}")
+        self.character_paths.invalidate()
+        self._cancel_ai_request()
         
         # 立即清空当前数据，避免异步加载时的数据污染
         character_data_lock.acquire()
@@ -1538,11 +1732,13 @@ class Example(MDApp):
             # 更新界面颜色
             self._update_theme_colors()
             
-            # 保存主题配置到config.json
-            config_manager.set("theme.current_theme_index", theme_index)
-            config_manager.set("theme.theme_style", theme["style"])
-            config_manager.set("theme.primary_palette", theme["palette"])
-            config_manager.set("theme.accent_palette", theme["accent"])
+            # 保存主题配置到config.json（合并为一次写入）
+            config_manager.update({
+                "theme.current_theme_index": theme_index,
+                "theme.theme_style": theme["style"],
+                "theme.primary_palette": theme["palette"],
+                "theme.accent_palette": theme["accent"]
+            })
             
             print(f"[成功] 主题配置已保存: {theme['name']}")
     
@@ -1634,50 +1830,20 @@ class Example(MDApp):
             return
         
         # 获取当前角色的数据文件路径
-        current_character = self.character_manager.get_current_character()
-        if current_character and current_character != "默认角色":
-            # 查找角色对应的数据文件 - 从配置文件获取完整角色信息
-            character_data_file = None
-            try:
-                config = config_manager._config
-                
-                if "characters" in config.get("app", {}):
-                    for char in config["app"]["characters"]:
-                        if char['name'] == current_character:
-                            data_file = char.get('data_file', f"data/chat_history_{current_character}.json")
-                            # 确保使用完整路径，特别是在移动端
-                            if not os.path.isabs(data_file):
-                                character_data_file = os.path.join(get_storage_path(), data_file)
-                            else:
-                                character_data_file = data_file
-                            break
-            except Exception as e:
-                print(f"读取角色配置时出错: {e}")
-            
-            if not character_data_file:
-                character_data_file = os.path.join(get_storage_path(), "data", f"chat_history_{current_character}.json")
-        else:
-            # 如果没有角色或默认角色，使用默认文件
-            character_data_file = os.path.join(get_storage_path(), "data", "chat_data.json")
+        character_data_file = self._get_character_data_file()
         
         print(f"使用数据文件: {character_data_file}")
         
-        # 创建用户消息
-        user_message = {
-            'role': 'user',
-            'content': text
-        }
+        # 创建用户消息并保存到角色对应的聊天记录文件（后台线程写盘，不阻塞UI）
+        user_message = dict(get_persistence_worker().append_message(character_data_file, text, 'user'))
         
         # 添加到全局数据
         global data
         data.append(user_message)
-        
-        # 保存到角色对应的聊天记录文件
-        from tool.data_saver import save_message_to_chat_data
-        save_message_to_chat_data(text, 'user', character_data_file)
+        self._index_messages([user_message])
         
         # 创建并添加用户消息卡片
-        user_label = CopyLabel(text=text, message_role='user', on_double_tap_callback=self._handle_user_message_double_tap)
+        user_label = CopyLabel(text=text, message_role='user', message_id=user_message['id'], on_double_tap_callback=self._handle_user_message_double_tap)
         user_label.bind(on_selection=self.open_context_menu)
         self.chat_history_layout.add_widget(user_label)
         
@@ -1686,6 +1852,7 @@ class Example(MDApp):
         
         # 保存最后发送的用户消息（用于API失败时重试）
         self._last_user_message = text
+        self._last_activity = time.time()
         
         # 滚动到底部显示新消息
         Clock.schedule_once(lambda dt: self._scroll_to_bottom(), 0.1)
@@ -1880,25 +2047,45 @@ class Example(MDApp):
         # 滚动到底部
         Clock.schedule_once(lambda dt: self._scroll_to_bottom(), 0.1)
     
-    def _get_ai_response_async(self, user_message):
-        """异步获取AI回复"""
+    def _get_ai_response_async(self, user_message, supersede=False, regenerate=False):
+        """异步获取AI回复（supersede 为True时取消当前角色尚未完成的旧请求；regenerate 为True时不复用缓存的回复）"""
         if not self.async_client:
             # 如果没有异步客户端，显示提示信息
             self._show_error_message("AI服务未配置，请检查配置")
             return
         
+        if supersede:
+            self._cancel_ai_request()
+        
         # 在聊天区域显示加载圈
         self._show_chat_loading_indicator()
         
-        # 准备历史消息上下文
-        message_history = []
+        # 准备历史消息上下文：在token预算（config: app.context_tokens，不超过模型上下文窗口）内取最近的消息，
+        # context_length 仍作为条数上限；超出时窗口整块前移（config: app.context_block，0 为逐条滑动），
+        # 连续多轮的上下文开头相同，可以命中服务端的提示缓存
         context_length = getattr(self, 'current_context_length', 50)  # 从配置读取，默认50
-        for item in data[-context_length:]:  # 使用配置文件中的context_length值
-            if isinstance(item, dict) and 'role' in item and 'content' in item:
-                message_history.append({
-                    'role': item['role'],
-                    'content': item['content']
-                })
+        budget = context_budget(self.current_model, config_manager.get("app.context_tokens", DEFAULT_CONTEXT_TOKENS))
+        summarizer = get_conversation_summarizer()
+        if summarizer:
+            # 较早的对话以摘要的形式放在上下文开头，摘要占用的token从预算中扣除
+            character_data_file = self._get_character_data_file()
+            summary_message = summarizer.system_message(character_data_file)
+            if summary_message:
+                budget = max(1, budget - estimate_tokens(summary_message['content']))
+        message_history = self._context_window.build(data, budget, context_length,
+                                                     config_manager.get("app.context_block", DEFAULT_BLOCK_FRACTION))
+        if summarizer:
+            # 摘要只在窗口前移时换成最新版本，两次前移之间上下文开头保持不变
+            pin_key = (character_data_file, self._context_window.generation)
+            if self._pinned_summary and self._pinned_summary[0] == pin_key:
+                summary_message = self._pinned_summary[1]
+            else:
+                self._pinned_summary = (pin_key, summary_message)
+            # 新移出窗口的消息在后台合并进摘要，本轮仍使用已有摘要
+            pending = self._context_window.dropped_after(summarizer.through_id(character_data_file))
+            summarizer.request_update(character_data_file, pending, self.current_model)
+            if summary_message:
+                message_history.insert(0, summary_message)
         
         # 使用弱引用避免循环引用
         app_ref = weakref.ref(self)
@@ -1907,26 +2094,84 @@ class Example(MDApp):
             # 在主线程中处理结果
             app = app_ref()
             if app:
-                Clock.schedule_once(lambda dt: app._handle_ai_response(success, response, error_msg), 0)
+                Clock.schedule_once(lambda dt: app._handle_ai_response(success, response, error_msg, request), 0)
+        
+        def delta_callback(delta):
+            # 流式增量文本（已在主线程按帧合并）
+            app = app_ref()
+            if app:
+                app._handle_ai_delta(delta)
+        
+        # 流式模式下边生成边显示（config: app.stream_response，默认开启）
+        stream = config_manager.get("app.stream_response", True)
         
         # 异步调用API - 传入当前选择的模型
+        request = None
         try:
-            self.async_client.send_message_async(
+            request = self._ai_request = self.async_client.send_message_async(
                 user_message, 
                 message_history, 
                 message_callback,
-                model=self.current_model  # 使用当前选择的模型
+                model=self.current_model,  # 使用当前选择的模型
+                on_delta=delta_callback if stream else None,
+                conversation=self.character_manager.get_current_character(),  # 同一角色的请求按顺序执行
+                supersede=supersede,
+                regenerate=regenerate
             )
         except Exception as error:
             error_msg = str(error)
             Clock.schedule_once(lambda dt: self._handle_ai_response(False, "", error_msg), 0)
     
-    def _handle_ai_response(self, success, response, error_msg):
+    def _cancel_ai_request(self):
+        """取消等待中的AI请求，移除加载圈和未完成的流式回复卡片"""
+        request, self._ai_request = self._ai_request, None
+        if request is None:
+            return
+        if request.cancel():
+            print(f"已取消AI请求 {request.id}")
+        self._hide_loading_indicator()
+        if self._streaming_label is not None:
+            self.chat_history_layout.remove_widget(self._streaming_label)
+            self._streaming_label = None
+            self._streaming_text = ""
+    
+    def _handle_ai_delta(self, delta):
+        """流式回复：把新到达的文本追加到正在生成的AI消息卡片"""
+        if self._streaming_label is None:
+            # 收到首个token，用消息卡片替换加载圈，回复完成前保持输入框禁用
+            self._hide_loading_indicator()
+            self.message_input.disabled = True
+            self._streaming_text = delta
+            self._streaming_label = CopyLabel(text=delta, message_role='assistant', on_double_tap_callback=self._handle_ai_message_double_tap)
+            self._streaming_label.bind(on_selection=self.open_context_menu)
+            self.chat_history_layout.add_widget(self._streaming_label)
+        else:
+            self._streaming_text += delta
+            self._streaming_label.text = self._streaming_text
+        
+        # 滚动到底部
+        Clock.schedule_once(lambda dt: self._scroll_to_bottom(), 0)
+    
+    def _handle_ai_response(self, success, response, error_msg, request=None):
         """处理AI回复结果"""
         print(f"处理AI回复结果 - success: {success}, response长度: {len(response) if response else 0}, error_msg: {error_msg}")
         
+        # 已取消的请求（切换角色、撤回或被新请求取代）不再处理
+        if request is not None:
+            if request.cancelled:
+                print(f"忽略已取消请求 {request.id} 的回复")
+                return
+            if request is self._ai_request:
+                self._ai_request = None
+        
         # 隐藏加载指示器
         self._hide_loading_indicator()
+        self._last_activity = time.time()
+        
+        # 取出流式回复中已显示的消息卡片（非流式时为 None）
+        streaming_label = self._streaming_label
+        self._streaming_label = None
+        self._streaming_text = ""
         
         if success and response:
             # 过滤AI回复，移除markdown和emoji
@@ -1938,55 +2183,34 @@ class Example(MDApp):
                 print(f"过滤AI回复时出错: {e}")
                 # 如果过滤失败，仍然使用原始回复
             # 获取当前角色的数据文件路径
-            current_character = self.character_manager.get_current_character()
-            if current_character and current_character != "默认角色":
-                # 查找角色对应的数据文件 - 从配置文件获取完整角色信息
-                character_data_file = None
-                try:
-                    config = config_manager._config
-                    
-                    if "characters" in config.get("app", {}):
-                        for char in config["app"]["characters"]:
-                            if char['name'] == current_character:
-                                data_file = char.get('data_file', f"data/chat_history_{current_character}.json")
-                                # 确保使用完整路径，特别是在移动端
-                                if not os.path.isabs(data_file):
-                                    character_data_file = os.path.join(get_storage_path(), data_file)
-                                else:
-                                    character_data_file = data_file
-                                break
-                except Exception as e:
-                    print(f"读取角色配置时出错: {e}")
-                
-                if not character_data_file:
-                    character_data_file = os.path.join(get_storage_path(), f"data/chat_history_{current_character}.json")
-            else:
-                # 如果没有角色或默认角色，使用默认文件
-                character_data_file = os.path.join(get_storage_path(), "data/chat_data.json")
+            character_data_file = self._get_character_data_file()
             
-            # 创建AI回复消息
-            ai_message = {
-                'role': 'assistant',
-                'content': response
-            }
+            # 创建AI回复消息并保存到角色对应的聊天记录文件（后台线程写盘，不阻塞UI）
+            ai_message = dict(get_persistence_worker().append_message(character_data_file, response, 'assistant'))
             
             # 添加到全局数据
             global data
             data.append(ai_message)
+            self._index_messages([ai_message])
             
-            # 保存到角色对应的聊天记录文件
-            from tool.data_saver import save_message_to_chat_data
-            save_message_to_chat_data(response, 'assistant', character_data_file)
-            
-            # 创建并添加AI回复卡片
-            ai_label = CopyLabel(text=response, message_role='assistant', on_double_tap_callback=self._handle_ai_message_double_tap)
-            ai_label.bind(on_selection=self.open_context_menu)
-            self.chat_history_layout.add_widget(ai_label)
+            if streaming_label is not None:
+                # 流式回复：卡片已在界面上，换成过滤后的完整内容
+                streaming_label.message_id = ai_message['id']
+                streaming_label.text = response
+            else:
+                # 创建并添加AI回复卡片
+                ai_label = CopyLabel(text=response, message_role='assistant', message_id=ai_message['id'], on_double_tap_callback=self._handle_ai_message_double_tap)
+                ai_label.bind(on_selection=self.open_context_menu)
+                self.chat_history_layout.add_widget(ai_label)
             
             # 滚动到底部
             Clock.schedule_once(lambda dt: self._scroll_to_bottom(), 0.1)
             
         else:
+            # 流式回复中途失败：移除不完整的消息卡片
+            if streaming_label is not None:
+                self.chat_history_layout.remove_widget(streaming_label)
+            
             # 更友好的错误提示
             if error_msg and "None" not in str(error_msg):
                 error_text = f"AI暂时无法回复: {error_msg}"
@@ -2110,6 +2334,10 @@ class Example(MDApp):
             user_index = children.index(instance)
             print(f"找到用户消息在索引位置: {user_index}")
             
+            # 撤回的是最新一条用户消息且AI仍在回复时，取消该请求（不再继续生成和保存回复）
+            if not any(getattr(child, 'message_role', None) == 'user' for child in children[:user_index]):
+                self._cancel_ai_request()
+            
             # 查找对应的AI回复（在用户消息之后）
             ai_reply = None
             ai_index = None
@@ -2128,53 +2356,17 @@ class Example(MDApp):
             else:
                 print(f"只移除了用户消息，未找到对应的AI回复")
             
-            # 从数据中也移除
-            global data
-            # 找到对应的数据索引并移除
-            user_found = False
-            ai_found = False
-            new_data = []
-            
-            for item in data:
-                if (item.get('role') == 'user' and item.get('content') == instance.text and not user_found):
-                    user_found = True
-                    continue  # 跳过该用户消息
-                elif (user_found and item.get('role') == 'assistant' and not ai_found and ai_reply):
-                    ai_found = True
-                    continue  # 跳过对应的AI回复
-                new_data.append(item)
-            
-            data = new_data
+            # 从数据中也移除（按消息 id 定位，内容相同的消息不会被误删）
+            removed_ids = [label.message_id for label in (instance, ai_reply)
+                           if label is not None and label.message_id is not None]
+            self._remove_messages(removed_ids)
             
             # 保存更新后的数据到文件
-            current_character = self.character_manager.get_current_character()
-            if current_character and current_character != "默认角色":
-                # 获取角色的完整数据文件路径
-                character_data_file = None
-                try:
-                    config = config_manager._config
-                    
-                    if "characters" in config.get("app", {}):
-                        for char in config["app"]["characters"]:
-                            if char['name'] == current_character:
-                                data_file = char.get('data_file', f"data/chat_history_{current_character}.json")
-                                # 确保使用完整路径，特别是在移动端
-                                if not os.path.isabs(data_file):
-                                    character_data_file = os.path.join(get_storage_path(), data_file)
-                                else:
-                                    character_data_file = data_file
-                                break
-                except Exception as e:
-                    print(f"获取角色数据文件路径时出错: {e}")
-                
-                if not character_data_file:
-                    character_data_file = os.path.join(get_storage_path(), f"data/chat_history_{current_character}.json")
-            else:
-                character_data_file = os.path.join(get_storage_path(), "data/chat_data.json")
+            character_data_file = self._get_character_data_file()
             
-            import json
-            with open(character_data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            # 追加撤回记录，不重写整个聊天记录
+            if removed_ids:
+                get_persistence_worker().delete_messages(character_data_file, removed_ids)
             
             print("对话回合已撤回")
             
@@ -2257,26 +2449,14 @@ class Example(MDApp):
         # 从界面移除旧的AI回复
         self.chat_history_layout.remove_widget(instance)
         
-        # 从数据中移除旧的AI回复
-        global data
-        # 找到对应的数据索引并移除AI回复
-        user_found = False
-        new_data = []
-        
-        for item in data:
-            if (item.get('role') == 'user' and item.get('content') == user_question.text and not user_found):
-                user_found = True
-                new_data.append(item)  # 保留用户消息
-            elif user_found and item.get('role') == 'assistant' and item.get('content') == instance.text:
-                # 跳过旧的AI回复，不添加到新数据中
-                continue
-            else:
-                new_data.append(item)
+        # 从数据中移除旧的AI回复并追加撤回记录
+        if instance.message_id is not None:
+            self._remove_messages([instance.message_id])
+            if self._current_data_file:
+                get_persistence_worker().delete_messages(self._current_data_file, [instance.message_id])
         
-        data = new_data
-        
-        # 让AI重新思考这个问题
-        self._get_ai_response_async(user_question.text)
+        # 让AI重新思考这个问题（取代该角色尚未完成的旧请求）
+        self._get_ai_response_async(user_question.text, supersede=True, regenerate=True)
         
         print("AI正在重新思考该回合对话")
     
@@ -2368,42 +2548,18 @@ class Example(MDApp):
         old_text = instance.text
         instance.text = new_text
         
-        # 更新数据
-        global data
-        for item in data:
-            if item.get('role') == 'assistant' and item.get('content') == old_text:
-                item['content'] = new_text
-                break
+        # 按消息 id 更新数据
+        message = self._message_index.get(instance.message_id)
+        if message is not None:
+            message['content'] = new_text
+            self._context_window.update(message)
         
         # 保存到文件
-        current_character = self.character_manager.get_current_character()
-        if current_character and current_character != "默认角色":
-            # 获取角色的完整数据文件路径
-            character_data_file = None
-            try:
-                config = config_manager._config
-                
-                if "characters" in config.get("app", {}):
-                    for char in config["app"]["characters"]:
-                        if char['name'] == current_character:
-                            data_file = char.get('data_file', f"data/chat_history_{current_character}.json")
-                            # 确保使用完整路径，特别是在移动端
-                            if not os.path.isabs(data_file):
-                                character_data_file = os.path.join(get_storage_path(), data_file)
-                            else:
-                                character_data_file = data_file
-                            break
-            except Exception as e:
-                print(f"获取角色数据文件路径时出错: {e}")
-            
-            if not character_data_file:
-                character_data_file = os.path.join(get_storage_path(), f"data/chat_history_{current_character}.json")
-        else:
-            character_data_file = os.path.join(get_storage_path(), "data/chat_data.json")
+        character_data_file = self._get_character_data_file()
         
-        import json
-        with open(character_data_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # 追加编辑记录，不重写整个聊天记录
+        if instance.message_id is not None:
+            get_persistence_worker().update_message(character_data_file, instance.message_id, new_text)
         
         # 显示成功提示
         from kivymd.uix.snackbar import MDSnackbar, MDSnackbarText
@@ -2445,18 +2601,36 @@ class Example(MDApp):
             if hasattr(self, 'models_list_layout') and hasattr(self, '_refresh_models_list'):
                 self._refresh_models_list()
 
+    def _configure_model_router(self):
+        """把可用模型列表和路由模式交给模型路由器"""
+        get_model_router().configure(config_manager.get("app.available_models", []),
+                                     config_manager.get("app.model_routing", "pinned"))
+    
+    def _update_settings(self, settings):
+        """写入设置；API地址或密钥变化时立即写盘，并重建API客户端（下次请求时读取新设置）"""
+        api_keys = ("openai.base_url", "openai.api_key")
+        old_values = [config_manager.get(key) for key in api_keys]
+        config_manager.update(settings)
+        if [config_manager.get(key) for key in api_keys] != old_values:
+            config_manager.flush()
+            invalidate_api_clients()
+        self._configure_model_router()
+    
     def _save_settings(self):
         """保存设置到config.json"""
         try:
-            # 更新配置项
-            config_manager.set("openai.base_url", self.base_url_field.text.strip())
-            config_manager.set("openai.api_key", self.api_key_field.text.strip())
+            # 更新配置项（收集后一次写入）
+            settings = {
+                "openai.base_url": self.base_url_field.text.strip(),
+                "openai.api_key": self.api_key_field.text.strip()
+            }
             
             # 解析上下文长度
             try:
                 context_length = int(self.context_length_field.text.strip())
-                config_manager.set("app.context_length", context_length)
+                settings["app.context_length"] = context_length
             except ValueError:
+                self._update_settings(settings)
                 # 显示错误提示
                 from kivymd.uix.snackbar import MDSnackbar, MDSnackbarText
                 snackbar = MDSnackbar(
@@ -2472,7 +2646,8 @@ class Example(MDApp):
                 return
             
             # 直接从current_available_models获取模型列表（卡片列表中的模型）
-            config_manager.set("app.available_models", self.current_available_models.copy())
+            settings["app.available_models"] = self.current_available_models.copy()
+            self._update_settings(settings)
             
             # 删除保存成功提示，不再显示小tip
             pass
@@ -2580,6 +2755,13 @@ class Example(MDApp):
             stop_async_api_client()
             self.async_client = None
         
+        # 停止后台压缩，再写完所有待保存的聊天记录
+        stop_chat_compactor()
+        stop_persistence_worker()
+        
+        # 写入尚未落盘的配置修改
+        config_manager.flush()
+        
         print("应用资源清理完成")
 
     def check_android_storage(self):
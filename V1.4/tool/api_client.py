@@ -6,17 +6,515 @@ API客户端模块
 """
 
 import json
+import hashlib
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import os
-from typing import Dict, List, Optional, Any
+import socket
+import threading
+from typing import Dict, List, Optional, Any, Callable, Iterable, Iterator, Tuple
 from datetime import datetime
 import traceback
+from collections import OrderedDict
+
+from tool.atomic_io import atomic_write_json
+from tool.retry_policy import RetryPolicy, get_retry_policy, parse_retry_after
+from tool.model_router import get_model_router
+
+# 连接池默认大小（每个主机保持的长连接数）
+DEFAULT_POOL_SIZE = 4
+# 请求超时（秒）
+REQUEST_TIMEOUT = 30
+# 连接预热超时（秒）
+WARM_UP_TIMEOUT = 5
+
+
+# 流式响应结束标记
+SSE_DONE = "[DONE]"
+
+# 响应缓存：内存中保留的条目数
+CACHE_MAX_ENTRIES = 256
+# 响应缓存：磁盘上保留的条目数
+CACHE_MAX_DISK_ENTRIES = 2000
+# 响应缓存：条目有效期（秒）
+CACHE_TTL = 24 * 3600
+# 每写入多少个磁盘条目清理一次过期和超出数量的文件
+CACHE_PRUNE_INTERVAL = 32
+
+
+class APIError(Exception):
+    """API请求失败"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None, transient: bool = False):
+        """
+        Args:
+            message: 错误描述
+            status_code: HTTP状态码（非HTTP错误时为None）
+            retry_after: 服务器要求的重试等待秒数（Retry-After 响应头）
+            transient: 是否为请求发出前建立连接失败等可以安全重试的临时错误
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.transient = transient
+
+
+class CancelToken:
+    """请求取消标记，可在任意线程调用 cancel()"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        """是否已取消"""
+        return self._event.is_set()
+
+    def cancel(self):
+        """取消请求，并执行已注册的中断操作"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"中断请求时出错: {e}")
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """注册取消时执行的中断操作（已取消时立即执行）"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def discard(self, callback: Callable[[], None]):
+        """请求结束后注销中断操作"""
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def _abort_response(response: requests.Response):
+    """关闭响应底层的套接字，唤醒阻塞在读取上的线程（连接不再放回连接池复用）"""
+    connection = getattr(response.raw, '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class SSEDecoder:
+    """
+    增量解析 SSE（server-sent events）字节流，提取 data: 字段的内容
+    
+    OpenAI 兼容接口每个事件只有一行 data:，因此每读到一行 data: 就立即产出，
+    不等待事件之间的空行，保证首个token尽早到达。
+    """
+    
+    def __init__(self):
+        self._buffer = b""
+    
+    @staticmethod
+    def _parse_line(line: bytes) -> Optional[str]:
+        if not line.startswith(b"data:"):
+            return None
+        data = line[5:].rstrip(b"\r")
+        return (data[1:] if data.startswith(b" ") else data).decode('utf-8')
+    
+    def feed(self, chunk: bytes) -> List[str]:
+        """
+        输入网络上收到的一块字节（边界可以落在任意位置，包括多字节字符中间）
+        
+        Returns:
+            本块补全的所有 data: 内容（去掉一个前导空格）
+        """
+        self._buffer += chunk
+        if b"\n" not in chunk:
+            return []
+        *lines, self._buffer = self._buffer.split(b"\n")
+        return [data for data in map(self._parse_line, lines) if data is not None]
+    
+    def close(self) -> List[str]:
+        """输入结束，返回最后一行（没有换行结尾时）的内容"""
+        data = self._parse_line(self._buffer)
+        self._buffer = b""
+        return [data] if data is not None else []
+
+
+def describe_error(status_code: int, body: str) -> str:
+    """
+    根据非200响应生成错误描述
+    
+    Args:
+        status_code: HTTP状态码
+        body: 响应内容
+        
+    Returns:
+        错误描述
+    """
+    error_msg = f"API请求失败 (状态码: {status_code})"
+    try:
+        error_detail = json.loads(body)
+        if 'error' in error_detail:
+            error_msg += f": {error_detail['error'].get('message', '未知错误')}"
+    except:
+        error_msg += f": {body}"
+    return error_msg
+
+
+def status_error(status_code: int, body: str, retry_after: Optional[str] = None) -> APIError:
+    """
+    根据非200响应构造APIError
+    
+    Args:
+        status_code: HTTP状态码
+        body: 响应内容
+        retry_after: Retry-After 响应头的值
+        
+    Returns:
+        APIError实例
+    """
+    return APIError(describe_error(status_code, body), status_code, parse_retry_after(retry_after))
+
+
+def request_error(error: requests.exceptions.RequestException) -> APIError:
+    """
+    把 requests 的超时和连接错误转换为APIError
+    
+    只有请求发出前建立连接失败（连接超时、拒绝连接、域名解析失败）标记为 transient：
+    请求发出后的读取超时和断线，服务器可能已经在生成，重发会重复生成和计费。
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return APIError("API请求超时", transient=True)
+    if isinstance(error, requests.exceptions.Timeout):
+        return APIError("API请求超时")
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    if isinstance(reason, NewConnectionError):
+        return APIError("网络连接错误，请检查网络连接", transient=True)
+    return APIError(f"网络连接错误，请检查网络连接: {error}")
+
+
+def parse_stream_delta(payload: str) -> Optional[str]:
+    """
+    解析一条流式响应 data: 内容，取出增量文本
+    
+    Args:
+        payload: data: 后的 JSON 文本（不含结束标记 [DONE]）
+        
+    Returns:
+        增量文本，没有内容或无法解析时返回None
+        
+    Raises:
+        APIError: 服务端在流中返回了错误
+    """
+    try:
+        chunk = json.loads(payload)
+    except json.JSONDecodeError:
+        print(f"无法解析的SSE数据: {payload[:100]}")
+        return None
+    
+    if 'error' in chunk:
+        raise APIError(f"API流式响应错误: {chunk['error'].get('message', '未知错误')}")
+    # 部分服务在最后一个数据块中附带 usage
+    if chunk.get('usage'):
+        _prompt_usage.record(chunk['usage'])
+    choices = chunk.get('choices') or []
+    if choices:
+        return (choices[0].get('delta') or {}).get('content')
+    return None
+
+
+def iter_sse_data(chunks: Iterable[bytes]) -> Iterator[str]:
+    """
+    增量解析 SSE 字节流，逐个产出 data: 字段的内容
+    
+    Args:
+        chunks: 网络上收到的字节块
+        
+    Yields:
+        data: 后的文本（去掉一个前导空格）
+    """
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+def create_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """
+    创建带连接池的HTTP会话，同一主机的请求复用 TCP+TLS 连接
+    
+    Args:
+        pool_size: 每个主机保持的最大长连接数
+        
+    Returns:
+        requests.Session实例
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def cached_prompt_tokens(usage: Dict[str, Any]) -> Optional[int]:
+    """
+    从响应的 usage 字段取出命中服务端提示缓存的token数
+    
+    Args:
+        usage: 响应中的 usage 字段
+        
+    Returns:
+        命中缓存的提示token数，服务端没有报告时返回None
+    """
+    details = usage.get('prompt_tokens_details') or {}
+    if details.get('cached_tokens') is not None:
+        # OpenAI 及兼容接口（Gemini 等）
+        return details['cached_tokens']
+    if usage.get('prompt_cache_hit_tokens') is not None:
+        # DeepSeek
+        return usage['prompt_cache_hit_tokens']
+    return None
+
+
+class PromptUsageStats:
+    """提示token用量统计（线程安全）：记录服务端报告的提示token数和其中命中提示缓存的部分"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.prompt_tokens = 0
+        self.reported_prompt_tokens = 0
+        self.cached_tokens = 0
+    
+    def record(self, usage: Optional[Dict[str, Any]]):
+        """记录一个响应的 usage 字段（没有 usage 时忽略）"""
+        if not isinstance(usage, dict):
+            return
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        cached = cached_prompt_tokens(usage)
+        with self._lock:
+            self.responses += 1
+            self.prompt_tokens += prompt_tokens
+            if cached is not None:
+                self.reported_prompt_tokens += prompt_tokens
+                self.cached_tokens += cached
+        if cached is not None:
+            print(f"提示缓存命中: {cached}/{prompt_tokens} tokens")
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取统计快照
+        
+        Returns:
+            Dict[str, Any]: responses 带 usage 的响应数、prompt_tokens 提示token总数、
+            cached_tokens 命中提示缓存的token数、hit_rate 在报告缓存的响应中命中缓存的提示token占比
+        """
+        with self._lock:
+            return {
+                'responses': self.responses,
+                'prompt_tokens': self.prompt_tokens,
+                'cached_tokens': self.cached_tokens,
+                'hit_rate': self.cached_tokens / self.reported_prompt_tokens if self.reported_prompt_tokens else 0.0,
+            }
+
+
+# 全局提示token用量统计（所有客户端和执行引擎共用）
+_prompt_usage = PromptUsageStats()
+
+
+def get_prompt_usage_stats() -> PromptUsageStats:
+    """获取全局提示token用量统计"""
+    return _prompt_usage
+
+
+class ResponseCache:
+    """
+    按内容寻址的响应缓存：键为 (API地址, 模型, 消息, temperature, max_tokens) 的哈希，
+    切换到提供同名模型的其他服务商时不会命中之前服务商的回复。
+    内存层按 LRU 淘汰，可选的磁盘层每个条目一个文件；两层都按 TTL 过期并限制条目数。
+    """
+    
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL,
+                 disk_dir: Optional[str] = None, max_disk_entries: int = CACHE_MAX_DISK_ENTRIES):
+        """
+        初始化响应缓存
+        
+        Args:
+            max_entries: 内存中保留的条目数
+            ttl: 条目有效期（秒）
+            disk_dir: 磁盘缓存目录，None 表示只使用内存
+            max_disk_entries: 磁盘上保留的条目数
+        """
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        # 键 -> (过期时间戳, 回复内容)，按最近使用排序
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def make_key(base_url: str, model: str, messages: List[Dict[str, str]], temperature: float,
+                 max_tokens: int) -> str:
+        """计算缓存键"""
+        payload = json.dumps([base_url, model, messages, temperature, max_tokens], ensure_ascii=False,
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+    
+    def get(self, key: str) -> Optional[str]:
+        """
+        查找缓存
+        
+        Returns:
+            缓存的回复内容，未命中或已过期时返回None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+        
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, *entry)
+        return entry[1]
+    
+    def put(self, key: str, content: str):
+        """写入缓存（同时写入磁盘层）"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, content)
+            if not self.disk_dir:
+                return
+            prune = self._disk_writes % CACHE_PRUNE_INTERVAL == 0
+            self._disk_writes += 1
+        try:
+            atomic_write_json(self._disk_path(key), {"expires_at": expires_at, "content": content}, indent=None)
+            if prune:
+                self._prune_disk()
+        except OSError as e:
+            print(f"写入响应缓存失败: {e}")
+    
+    def _remember(self, key: str, expires_at: float, content: str):
+        """写入内存层并按 LRU 淘汰（调用方持有锁）"""
+        self._entries[key] = (expires_at, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def _read_disk(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        """从磁盘层读取 (过期时间戳, 回复内容)，未命中或已过期时返回None"""
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry["expires_at"] > now:
+                return entry["expires_at"], entry["content"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        # 已过期或文件损坏
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    
+    def _prune_disk(self):
+        """删除磁盘层中过期的条目，条目数超出上限时删除最久未写入的条目"""
+        try:
+            names = [name for name in os.listdir(self.disk_dir) if name.endswith('.json')]
+        except OSError:
+            return
+        oldest_allowed = time.time() - self.ttl
+        files = []
+        for name in names:
+            path = os.path.join(self.disk_dir, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if mtime < oldest_allowed:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            else:
+                files.append((mtime, path))
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_disk_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def clear(self):
+        """清空内存层和磁盘层"""
+        with self._lock:
+            self._entries.clear()
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.json'):
+                    try:
+                        os.remove(os.path.join(self.disk_dir, name))
+                    except OSError:
+                        pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计
+        
+        Returns:
+            Dict[str, Any]: entries 内存条目数、hits 内存命中、disk_hits 磁盘命中、misses 未命中、hit_rate 命中率
+        """
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
 
 
 class APIClient:
     """OpenAI API客户端"""
     
-    def __init__(self, api_key: str, base_url: str, model: str = "deepseek-v3"):
+    def __init__(self, api_key: str, base_url: str, model: str = "deepseek-v3",
+                 pool_size: int = DEFAULT_POOL_SIZE, session: Optional[requests.Session] = None,
+                 retry_policy: Optional[RetryPolicy] = None):
         """
         初始化API客户端
         
@@ -24,6 +522,9 @@ class APIClient:
             api_key: API密钥
             base_url: API基础URL
             model: 使用的模型
+            pool_size: 连接池大小
+            session: 共享的HTTP会话，None 表示创建自己的会话
+            retry_policy: 重试策略，None 使用全局重试策略
         """
         self.api_key = api_key
         self.base_url = base_url.rstrip('/')  # 移除末尾的斜杠
@@ -33,10 +534,40 @@ class APIClient:
             'Content-Type': 'application/json',
             'User-Agent': 'YU-Chat/1.0'
         }
+        # 长连接会话，避免每轮对话重新握手
+        self._owns_session = session is None
+        self.session = session if session is not None else create_session(pool_size)
+        # 限流、服务暂时不可用等临时错误自动重试
+        self.retry_policy = retry_policy or get_retry_policy()
+        
+    def warm_up(self, timeout: float = WARM_UP_TIMEOUT) -> bool:
+        """
+        预热连接：提前完成 DNS、TCP 和 TLS 握手，放入连接池供第一轮对话复用
+        
+        Args:
+            timeout: 超时秒数
+            
+        Returns:
+            连接是否建立成功（不关心响应状态码）
+        """
+        try:
+            response = self.session.head(self.base_url, headers=self.headers, timeout=timeout)
+            response.close()
+            return True
+        except requests.exceptions.RequestException as e:
+            print(f"API连接预热失败: {e}")
+            return False
+    
+    def close(self):
+        """关闭连接池中的所有连接（共享的会话由注册表负责关闭）"""
+        if self._owns_session:
+            self.session.close()
         
     def create_chat_completion(self, messages: List[Dict[str, str]], 
                              temperature: float = 0.7,
-                             max_tokens: int = 2000) -> Optional[str]:
+                             max_tokens: int = 2000,
+                             cancel_token: Optional[CancelToken] = None,
+                             use_cache: bool = True) -> Optional[str]:
         """
         创建聊天完成请求
         
@@ -44,88 +575,172 @@ class APIClient:
             messages: 消息列表，格式为 [{"role": "user", "content": "消息内容"}]
             temperature: 创造性参数 (0.0-2.0)
             max_tokens: 最大响应token数
+            cancel_token: 取消标记，取消后立即断开连接
+            use_cache: 是否使用响应缓存（开启缓存时有效）
             
         Returns:
-            AI回复内容，失败时返回None
+            AI回复内容，失败或已取消时返回None
         """
         try:
-            # 构建请求数据
-            data = {
-                "model": self.model,
-                "messages": messages,
-                "temperature": temperature,
-                "max_tokens": max_tokens,
-                "stream": False
-            }
-            
-            # 发送请求
-            print(f"发送API请求到: {self.base_url}/chat/completions")
-            print(f"请求数据: {data}")
-            
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=self.headers,
-                json=data,
-                timeout=30  # 30秒超时
-            )
-            
-            print(f"API响应状态码: {response.status_code}")
-            print(f"API响应内容: {response.text}")
-            
-            # 检查响应状态
-            if response.status_code == 200:
-                try:
-                    result = response.json()
-                    # API响应处理
-                    print(f"API响应内容: {result}")  # 调试信息
-                    
-                    # 检查响应结构
-                    print(f"检查choices字段: {'choices' in result}")
-                    if 'choices' in result:
-                        print(f"choices长度: {len(result['choices'])}")
-                        if len(result['choices']) > 0:
-                            print(f"第一个choice: {result['choices'][0]}")
-                    
-                    if 'choices' in result and len(result['choices']) > 0:
-                        message_content = result['choices'][0].get('message', {}).get('content', '')
-                        print(f"提取的message_content: '{message_content}'")
-                        print(f"message_content长度: {len(message_content) if message_content else 0}")
-                        if message_content:
-                            return message_content.strip()
-                        else:
-                            print("AI回复内容为空")
-                            return None
-                    else:
-                        print(f"API响应格式错误: 没有choices字段或choices为空")
-                        print(f"响应内容: {result}")
-                        return None
-                        
-                except json.JSONDecodeError as e:
-                    # JSON解析错误处理
-                    print(f"JSON解析错误: {e}")
-                    return None
-            else:
-                error_msg = f"API请求失败 (状态码: {response.status_code})"
-                try:
-                    error_detail = response.json()
-                    if 'error' in error_detail:
-                        error_msg += f": {error_detail['error'].get('message', '未知错误')}"
-                except:
-                    error_msg += f": {response.text}"
-                print(error_msg)
-                return None
-                
-        except requests.exceptions.Timeout:
-            print("API请求超时")
-            return None
-        except requests.exceptions.ConnectionError:
-            print("网络连接错误，请检查网络连接")
+            return self.request_chat_completion(messages, temperature, max_tokens, cancel_token, use_cache)
+        except APIError as e:
+            print(e)
             return None
         except Exception as e:
             # API请求错误处理
             traceback.print_exc()
             return None
     
+    def request_chat_completion(self, messages: List[Dict[str, str]],
+                                temperature: float = 0.7,
+                                max_tokens: int = 2000,
+                                cancel_token: Optional[CancelToken] = None,
+                                use_cache: bool = True) -> Optional[str]:
+        """
+        创建聊天完成请求，失败时抛出异常（供需要区分错误类型的调用方使用）
+        
+        内部以流式请求发送并拼接完整回复：响应头在开始生成时就返回，取消时可以立即关闭连接，
+        服务器随之停止生成，不必等完整回复生成完再丢弃。
+        
+        Args:
+            messages: 消息列表，格式为 [{"role": "user", "content": "消息内容"}]
+            temperature: 创造性参数
+            max_tokens: 最大响应token数
+            cancel_token: 取消标记，取消后立即断开连接
+            use_cache: 是否使用响应缓存（开启缓存时有效）
+            
+        Returns:
+            AI回复内容，回复为空或已取消时返回None
+            
+        Raises:
+            APIError: 重试后仍然失败
+        """
+        parts = list(self.create_chat_completion_stream(messages, temperature, max_tokens, cancel_token, use_cache))
+        if cancel_token and cancel_token.cancelled:
+            print("请求已取消，已断开连接")
+            return None
+        reply = "".join(parts).strip()
+        if not reply:
+            print("AI回复内容为空")
+        return reply or None
+    
+    def create_chat_completion_stream(self, messages: List[Dict[str, str]],
+                                      temperature: float = 0.7,
+                                      max_tokens: int = 2000,
+                                      cancel_token: Optional[CancelToken] = None,
+                                      use_cache: bool = True) -> Iterator[str]:
+        """
+        创建流式聊天完成请求，边生成边返回
+        
+        Args:
+            messages: 消息列表，格式为 [{"role": "user", "content": "消息内容"}]
+            temperature: 创造性参数 (0.0-2.0)
+            max_tokens: 最大响应token数
+            cancel_token: 取消标记，取消后立即断开连接并结束生成器
+            use_cache: 是否使用响应缓存（开启缓存时有效，命中时一次性返回完整回复）
+            
+        Yields:
+            AI回复的增量文本
+            
+        Raises:
+            APIError: 请求失败或连接中断
+        """
+        if cancel_token and cancel_token.cancelled:
+            return
+        cache = get_response_cache() if use_cache else None
+        if cache:
+            cache_key = cache.make_key(self.base_url, self.model, messages, temperature, max_tokens)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                print("命中响应缓存")
+                yield cached
+                return
+        
+        data = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True
+        }
+        
+        print(f"发送流式API请求到: {self.base_url}/chat/completions")
+        
+        def open_stream(remaining: float) -> requests.Response:
+            try:
+                # 流式模式下超时作用于相邻两次读取之间，而不是整个生成过程
+                response = self.session.post(
+                    f"{self.base_url}/chat/completions",
+                    headers=self.headers,
+                    json=data,
+                    stream=True,
+                    timeout=min(REQUEST_TIMEOUT, max(remaining, 1))
+                )
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                raise request_error(e)
+            if response.status_code != 200:
+                with response:
+                    raise self._status_error(response)
+            return response
+        
+        # 只重试建立连接和等待响应头的阶段：开始输出后再重试会让界面出现重复文本
+        response = self.retry_policy.call(open_stream, cancel_token)
+        if response is None:
+            return
+        
+        # 取消时关闭套接字，中断阻塞中的读取
+        abort = lambda: _abort_response(response)
+        if cancel_token:
+            cancel_token.on_cancel(abort)
+        
+        try:
+            with response:
+                if cancel_token and cancel_token.cancelled:
+                    return
+                
+                # 部分兼容接口忽略 stream 参数，直接返回完整结果
+                if response.headers.get('Content-Type', '').startswith('application/json'):
+                    try:
+                        result = response.json()
+                        _prompt_usage.record(result.get('usage'))
+                        content = result['choices'][0].get('message', {}).get('content', '')
+                    except (ValueError, KeyError, IndexError) as e:
+                        raise APIError(f"API响应格式错误: {e}")
+                    if content:
+                        if cache:
+                            cache.put(cache_key, content.strip())
+                        yield content
+                    return
+                
+                parts = []
+                try:
+                    # chunk_size=None: 数据到达多少就处理多少，不等待凑满缓冲区
+                    for payload in iter_sse_data(response.iter_content(chunk_size=None)):
+                        if cancel_token and cancel_token.cancelled:
+                            return
+                        if payload == SSE_DONE:
+                            break
+                        content = parse_stream_delta(payload)
+                        if content:
+                            parts.append(content)
+                            yield content
+                except requests.exceptions.RequestException as e:
+                    if cancel_token and cancel_token.cancelled:
+                        return
+                    raise APIError(f"流式响应中断: {e}")
+                # 完整接收后才写入缓存
+                reply = "".join(parts).strip()
+                if cache and reply and not (cancel_token and cancel_token.cancelled):
+                    cache.put(cache_key, reply)
+        finally:
+            if cancel_token:
+                cancel_token.discard(abort)
+
+    
+    def _status_error(self, response: requests.Response) -> APIError:
+        """根据非200响应构造APIError（带上 Retry-After）"""
+        return status_error(response.status_code, response.text, response.headers.get('Retry-After'))
+    
     def format_messages_for_api(self, chat_history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
         """
         将本地聊天记录格式化为API所需格式
@@ -144,10 +759,14 @@ class APIClient:
             
             # 只添加有效的消息
             if content and role in ["user", "assistant", "system"]:
-                formatted_messages.append({
-                    "role": role,
-                    "content": content
-                })
+                if len(message) == 2 and "role" in message:
+                    # 已是API格式（如 ContextWindow 构建的上下文），直接复用
+                    formatted_messages.append(message)
+                else:
+                    formatted_messages.append({
+                        "role": role,
+                        "content": content
+                    })
         
         return formatted_messages
     
@@ -159,15 +778,35 @@ class APIClient:
             连接是否成功
         """
         try:
+            # 连接测试必须真正访问网络，不使用响应缓存
             test_messages = [{"role": "user", "content": "Hello"}]
-            response = self.create_chat_completion(test_messages, max_tokens=10)
+            response = self.create_chat_completion(test_messages, max_tokens=10, use_cache=False)
             return response is not None
         except:
             return False
 
 
-# 全局API客户端实例
+# 全局API客户端实例（使用配置中默认模型的客户端）
 _api_client: Optional[APIClient] = None
+# 客户端注册表：(base_url, api_key, model) -> 长期复用的客户端
+_clients: Dict[Tuple[str, str, str], APIClient] = {}
+# base_url -> 共享的HTTP会话，同一服务的所有模型共用一个连接池
+_sessions: Dict[str, requests.Session] = {}
+_registry_lock = threading.RLock()
+
+
+def _get_registered_client(api_key: str, base_url: str, model: str) -> APIClient:
+    """从注册表获取客户端，不存在时创建（同一 base_url 的客户端共享HTTP会话）"""
+    base_url = base_url.rstrip('/')
+    key = (base_url, api_key, model)
+    with _registry_lock:
+        client = _clients.get(key)
+        if client is None:
+            session = _sessions.get(base_url)
+            if session is None:
+                session = _sessions[base_url] = create_session()
+            client = _clients[key] = APIClient(api_key, base_url, model, session=session)
+        return client
 
 
 def initialize_api_client(api_key: str, base_url: str, model: str = "deepseek-v3") -> APIClient:
@@ -183,8 +822,9 @@ def initialize_api_client(api_key: str, base_url: str, model: str = "deepseek-v3
         APIClient实例
     """
     global _api_client
-    _api_client = APIClient(api_key, base_url, model)
-    return _api_client
+    with _registry_lock:
+        _api_client = _get_registered_client(api_key, base_url, model)
+        return _api_client
 
 
 def get_api_client() -> Optional[APIClient]:
@@ -196,33 +836,112 @@ def get_api_client() -> Optional[APIClient]:
     """
     global _api_client
     
-    if _api_client is None:
-        # 从配置文件加载API设置
-        from .platform_utils import get_storage_path
-        config_path = os.path.join(get_storage_path(), "config", "config.json")
-        if os.path.exists(config_path):
-            try:
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                
-                openai_config = config.get('openai', {})
-                api_key = openai_config.get('api_key', '')
-                base_url = openai_config.get('base_url', 'https://api.openai.com/v1')
-                model = openai_config.get('model', 'deepseek-v3')
-                
-                if api_key:
-                    _api_client = APIClient(api_key, base_url, model)
-                else:
-                    print("警告: API密钥未配置")
+    with _registry_lock:
+        if _api_client is None:
+            # 从配置文件加载API设置（只在首次使用或设置变更后读取一次）
+            from .platform_utils import get_storage_path
+            config_path = os.path.join(get_storage_path(), "config", "config.json")
+            if os.path.exists(config_path):
+                try:
+                    with open(config_path, 'r', encoding='utf-8') as f:
+                        config = json.load(f)
                     
-            except Exception as e:
-                print(f"加载API配置失败: {e}")
+                    openai_config = config.get('openai', {})
+                    api_key = openai_config.get('api_key', '')
+                    base_url = openai_config.get('base_url', 'https://api.openai.com/v1')
+                    model = openai_config.get('model', 'deepseek-v3')
+                    
+                    if api_key:
+                        _api_client = _get_registered_client(api_key, base_url, model)
+                    else:
+                        print("警告: API密钥未配置")
+                        
+                except Exception as e:
+                    print(f"加载API配置失败: {e}")
+        
+        return _api_client
+
+
+def get_model_client(model: Optional[str] = None, base_url: Optional[str] = None) -> Optional[APIClient]:
+    """
+    获取使用指定模型的客户端（与默认客户端共用API设置和连接池）
+    
+    Args:
+        model: 模型名称，None 表示默认模型
+        base_url: 备用API地址（使用相同的密钥），None 表示默认地址
+        
+    Returns:
+        APIClient实例，API未配置时返回None
+    """
+    client = get_api_client()
+    if client is None:
+        return None
+    model = model or client.model
+    base_url = (base_url or client.base_url).rstrip('/')
+    if model == client.model and base_url == client.base_url:
+        return client
+    return _get_registered_client(client.api_key, base_url, model)
+
+
+def invalidate_api_clients():
+    """
+    API设置变更后调用：关闭所有连接并清空注册表，下次请求时重新读取配置
+    """
+    global _api_client
+    with _registry_lock:
+        sessions = list(_sessions.values())
+        _clients.clear()
+        _sessions.clear()
+        _api_client = None
+    for session in sessions:
+        session.close()
+    print("API客户端已重置，下次请求时使用新设置")
+
+
+# 全局响应缓存，None 表示未开启
+_response_cache: Optional[ResponseCache] = None
+
+
+def configure_response_cache(config: Optional[Dict[str, Any]]) -> Optional[ResponseCache]:
+    """
+    根据配置（app.response_cache）开启或关闭响应缓存
     
-    return _api_client
+    Args:
+        config: {"enabled": bool, "ttl": 秒, "max_entries": 内存条目数, "disk": 是否写入磁盘, "max_disk_entries": 磁盘条目数}
+        
+    Returns:
+        ResponseCache实例，未开启时返回None
+    """
+    global _response_cache
+    if not config or not config.get("enabled"):
+        _response_cache = None
+        return None
+    disk_dir = None
+    if config.get("disk", True):
+        from .platform_utils import get_storage_path
+        disk_dir = os.path.join(get_storage_path(), "cache", "responses")
+    _response_cache = ResponseCache(max_entries=config.get("max_entries", CACHE_MAX_ENTRIES),
+                                    ttl=config.get("ttl", CACHE_TTL),
+                                    disk_dir=disk_dir,
+                                    max_disk_entries=config.get("max_disk_entries", CACHE_MAX_DISK_ENTRIES))
+    return _response_cache
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    获取全局响应缓存
+    
+    Returns:
+        ResponseCache实例，未开启时返回None
+    """
+    return _response_cache
 
 
 def send_message_to_ai(message_content: str, chat_history: List[Dict[str, Any]], 
-                      temperature: float = 0.7, model: Optional[str] = None) -> Optional[str]:
+                      temperature: float = 0.7, model: Optional[str] = None,
+                      cancel_token: Optional[CancelToken] = None,
+                      base_url: Optional[str] = None,
+                      use_cache: bool = True) -> Optional[str]:
     """
     发送消息到AI并获取回复
     
@@ -230,62 +949,83 @@ def send_message_to_ai(message_content: str, chat_history: List[Dict[str, Any]],
         message_content: 用户消息内容
         chat_history: 聊天历史记录
         temperature: 创造性参数
-        model: 模型名称（可选，如果提供则临时使用指定模型）
+        model: 模型名称（可选，如果提供则使用指定模型的客户端）
+        cancel_token: 取消标记
+        base_url: 备用API地址（可选，默认使用配置中的地址）
+        use_cache: 是否使用响应缓存（开启缓存时有效）
         
     Returns:
         AI回复内容，失败时返回None
     """
-    client = get_api_client()
+    # 使用指定模型的长期客户端（与默认客户端共用API设置和连接池）
+    client = get_model_client(model, base_url)
     if not client:
         print("API客户端未初始化")
         return None
     
     try:
-        # 如果需要使用特定模型，临时创建新的客户端
-        if model:
-            # 从配置获取API设置
-            from .platform_utils import get_storage_path
-            config_path = os.path.join(get_storage_path(), "config", "config.json")
-            if os.path.exists(config_path):
-                try:
-                    with open(config_path, 'r', encoding='utf-8') as f:
-                        config = json.load(f)
-                    
-                    openai_config = config.get('openai', {})
-                    api_key = openai_config.get('api_key', '')
-                    base_url = openai_config.get('base_url', 'https://api.openai.com/v1')
-                    
-                    if api_key:
-                        # 临时创建使用指定模型的客户端
-                        temp_client = APIClient(api_key, base_url, model)
-                        # 格式化消息历史
-                        messages = temp_client.format_messages_for_api(chat_history)
-                        
-                        # 发送请求并获取回复
-                        response = temp_client.create_chat_completion(messages, temperature=temperature)
-                        return response
-                    else:
-                        print("警告: API密钥未配置，使用默认模型")
-                        
-                except Exception as e:
-                    print(f"临时客户端创建失败: {e}")
-        
-        # 使用默认客户端
         # 格式化消息历史
         messages = client.format_messages_for_api(chat_history)
         
-        print(f"发送给API的消息: {messages}")
+        print(f"发送给API的消息: {len(messages)} 条")
+        
+        # 发送请求并获取回复（模型不可用时由路由器切换到其他可用模型）
+        def request(routed_model: Optional[str]) -> Optional[str]:
+            return get_model_client(routed_model, base_url).request_chat_completion(
+                messages, temperature=temperature, cancel_token=cancel_token, use_cache=use_cache)
         
-        # 发送请求并获取回复
-        response = client.create_chat_completion(messages, temperature=temperature)
-        return response
+        return get_model_router().call(model, request)
         
+    except APIError as e:
+        print(e)
+        return None
     except Exception as e:
         print(f"发送消息到AI时发生错误: {e}")
         traceback.print_exc()
         return None
 
 
+def stream_message_to_ai(message_content: str, chat_history: List[Dict[str, Any]],
+                         temperature: float = 0.7, model: Optional[str] = None,
+                         cancel_token: Optional[CancelToken] = None,
+                         base_url: Optional[str] = None,
+                         use_cache: bool = True) -> Iterator[str]:
+    """
+    以流式方式发送消息到AI，逐段返回回复
+    
+    Args:
+        message_content: 用户消息内容
+        chat_history: 聊天历史记录
+        temperature: 创造性参数
+        model: 模型名称（可选，如果提供则使用指定模型的客户端）
+        cancel_token: 取消标记
+        base_url: 备用API地址（可选，默认使用配置中的地址）
+        use_cache: 是否使用响应缓存（开启缓存时有效）
+        
+    Yields:
+        AI回复的增量文本
+        
+    Raises:
+        APIError: 客户端未初始化或请求失败
+    """
+    client = get_model_client(model, base_url)
+    if not client:
+        raise APIError("API客户端未初始化")
+    
+    messages = client.format_messages_for_api(chat_history)
+    
+    # 收到首个token前模型不可用时由路由器切换到其他可用模型；开始输出后不再切换
+    def open_stream(routed_model: Optional[str]) -> Tuple[Optional[str], Iterator[str]]:
+        stream = get_model_client(routed_model, base_url).create_chat_completion_stream(
+            messages, temperature=temperature, cancel_token=cancel_token, use_cache=use_cache)
+        return next(stream, None), stream
+    
+    first, stream = get_model_router().call(model, open_stream)
+    if first is not None:
+        yield first
+        yield from stream
+
+
 if __name__ == "__main__":
     # 测试代码
     # API客户端测试
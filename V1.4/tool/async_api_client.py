@@ -7,47 +7,208 @@
 
 import threading
 import queue
+import time
+from collections import deque
 from typing import Optional, Callable, List, Dict, Any
 from datetime import datetime
 import traceback
 
-from tool.api_client import get_api_client, send_message_to_ai
+from tool.api_client import (
+    get_api_client,
+    get_model_client,
+    get_response_cache,
+    get_prompt_usage_stats,
+    send_message_to_ai,
+    stream_message_to_ai,
+    CancelToken,
+    APIError
+)
+from tool.retry_policy import get_retry_policy
+from tool.model_router import get_model_router
+from tool.hedging import HedgePolicy
+
+# 默认工作线程数
+DEFAULT_WORKERS = 4
+# 未指定会话的聊天请求共用的会话标识（彼此之间仍按顺序执行）
+DEFAULT_CONVERSATION = ""
+# 排队等待时间统计保留的最近样本数
+WAIT_SAMPLES = 200
+# 排队超过该时间（毫秒）时输出提示
+SLOW_WAIT_MS = 1000
+# 请求执行方式：线程池中阻塞调用 requests，或在 asyncio 事件循环中并发（见 tool.async_engine）
+ENGINE_THREAD = "thread"
+ENGINE_ASYNCIO = "asyncio"
+
+
+def _schedule_next_frame(func: Callable):
+    """在 Kivy 主线程的下一帧执行 func"""
+    from kivy.clock import Clock
+    Clock.schedule_once(func, 0)
+
+
+class RequestHandle:
+    """异步请求句柄，用于取消请求"""
+    
+    def __init__(self, request_id: int, conversation: Optional[str] = None):
+        self.id = request_id
+        self.conversation = conversation
+        self.cancel_token = CancelToken()
+        self._done = threading.Event()
+        
+    @property
+    def cancelled(self) -> bool:
+        """是否已取消"""
+        return self.cancel_token.cancelled
+        
+    @property
+    def done(self) -> bool:
+        """请求是否已处理完毕（包括被取消后跳过）"""
+        return self._done.is_set()
+        
+    def cancel(self) -> bool:
+        """
+        取消请求：排队中的请求不再发送，进行中的流式读取立即断开。
+        取消后不再调用回调，已安排到主线程但尚未执行的流式增量也会被丢弃；
+        已处理完毕的请求同样会被标记为取消，调用方可据此丢弃尚未处理的结果。
+        
+        Returns:
+            bool: 请求尚未处理完毕、取消生效时返回True
+        """
+        pending = not self._done.is_set()
+        self.cancel_token.cancel()
+        return pending
+        
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待请求处理完毕"""
+        return self._done.wait(timeout)
+
+
+class DeltaThrottle:
+    """合并后台线程收到的流式增量文本，每帧最多在主线程回调一次"""
+    
+    def __init__(self, on_delta: Callable[[str], None],
+                 schedule: Optional[Callable[[Callable], None]] = None,
+                 cancel_token: Optional[CancelToken] = None):
+        """
+        初始化增量节流器
+        
+        Args:
+            on_delta: 主线程回调，参数为自上次回调以来新到达的文本
+            schedule: 把函数安排到下一帧执行的方法，默认使用 Kivy Clock
+            cancel_token: 取消标记，取消后不再回调
+        """
+        self._on_delta = on_delta
+        self._schedule = schedule or _schedule_next_frame
+        self._cancel_token = cancel_token
+        self._pending = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+        
+    def push(self, delta: str):
+        """提交一段增量文本（后台线程调用）"""
+        with self._lock:
+            self._pending.append(delta)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._schedule(self._flush)
+        
+    def _flush(self, *args):
+        """把积累的文本一次性交给回调（主线程执行）"""
+        with self._lock:
+            text = "".join(self._pending)
+            self._pending.clear()
+            self._scheduled = False
+        if text and not (self._cancel_token and self._cancel_token.cancelled):
+            self._on_delta(text)
 
 
 class AsyncAPIClient:
-    """异步API客户端，使用后台线程处理API调用"""
+    """
+    异步API客户端，使用后台线程池或 asyncio 事件循环处理API调用
+    
+    同一会话（角色）的聊天请求按提交顺序逐个执行，不同会话之间以及连接测试等
+    其他请求可以并行，一个慢模型不会阻塞其他角色。
+    """
     
-    def __init__(self):
-        """初始化异步API客户端"""
-        self._thread = None
+    def __init__(self, max_workers: int = DEFAULT_WORKERS, engine: str = ENGINE_THREAD):
+        """
+        初始化异步API客户端
+        
+        Args:
+            max_workers: 工作线程数（线程模式）
+            engine: 请求执行方式 ENGINE_THREAD 或 ENGINE_ASYNCIO
+        """
+        self._max_workers = max(1, max_workers)
+        self._engine_name = engine
+        self._engine = None
+        self._threads = []
+        # 可以立即执行的任务
         self._queue = queue.Queue()
         self._running = False
         self._callbacks = {}
         self._request_id = 0
+        self._lock = threading.Lock()
+        # 有任务正在排队或执行的会话 -> 该会话中等待前一个任务完成的后续任务
+        self._conversations: Dict[str, deque] = {}
+        # 会话 -> 尚未处理完毕的聊天请求句柄（用于新请求取代旧请求）
+        self._active_handles: Dict[str, List[RequestHandle]] = {}
+        # 统计信息
+        self._busy = 0
+        self._completed = 0
+        self._wait_samples = deque(maxlen=WAIT_SAMPLES)
+        # 对冲策略，None 表示不对冲
+        self._hedging: Optional[HedgePolicy] = None
+        
+    def set_hedging(self, policy: Optional[HedgePolicy]):
+        """
+        设置对冲策略（可选功能）：聊天请求迟迟没有首字节时再发一个相同请求，采用先返回的结果
+        
+        Args:
+            policy: 对冲策略，None 表示关闭对冲
+        """
+        self._hedging = policy
         
     def start(self):
         """启动异步处理线程"""
         if not self._running:
             self._running = True
-            self._thread = threading.Thread(target=self._worker, daemon=True)
-            self._thread.start()
+            if self._engine_name == ENGINE_ASYNCIO:
+                from tool.async_engine import AsyncEngine
+                self._engine = AsyncEngine()
+                self._engine.start()
+                print(f"异步API客户端使用 asyncio 引擎（{self._engine.transport_name}）")
+                return
+            self._threads = [threading.Thread(target=self._worker, daemon=True)
+                             for _ in range(self._max_workers)]
+            for thread in self._threads:
+                thread.start()
             # 异步API客户端已启动
             
     def stop(self):
         """停止异步处理线程"""
         if self._running:
             self._running = False
-            # 发送停止信号
-            self._queue.put(None)
-            if self._thread:
-                self._thread.join(timeout=5)
+            if self._engine is not None:
+                self._engine.stop()
+                self._engine = None
+            # 每个工作线程一个停止信号
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join(timeout=5)
+            self._threads = []
             # 异步API客户端已停止
             
     def send_message_async(self, message_content: str, 
                           chat_history: List[Dict[str, Any]],
                           callback: Callable[[Optional[str], Optional[str]], None],
                           temperature: float = 0.7,
-                          model: Optional[str] = None) -> int:
+                          model: Optional[str] = None,
+                          on_delta: Optional[Callable[[str], None]] = None,
+                          conversation: str = DEFAULT_CONVERSATION,
+                          supersede: bool = False,
+                          regenerate: bool = False) -> RequestHandle:
         """
         异步发送消息到AI
         
@@ -56,28 +217,43 @@ class AsyncAPIClient:
             chat_history: 聊天历史记录
             callback: 回调函数，参数为(response, error)
             temperature: 创造性参数
+            model: 模型名称
+            on_delta: 流式回调，提供时使用流式请求，参数为新到达的文本（在主线程按帧合并调用）
+            conversation: 会话标识（如角色名），同一会话的请求按提交顺序执行
+            supersede: 为True时取消同一会话中尚未完成的旧请求，由本请求取代
+            regenerate: 是否为重新生成，temperature > 0 时不使用响应缓存（用户想要一个新的回复）
             
         Returns:
-            请求ID，可用于跟踪请求
+            RequestHandle: 请求句柄，id 为请求ID，cancel() 可取消请求
         """
-        request_id = self._request_id
-        self._request_id += 1
+        handle = RequestHandle(self._next_request_id(), conversation)
+        with self._lock:
+            superseded = self._active_handles.get(conversation, []) if supersede else []
+            self._active_handles[conversation] = [h for h in self._active_handles.get(conversation, [])
+                                                  if h not in superseded] + [handle]
+        for old_handle in superseded:
+            if old_handle.cancel():
+                print(f"请求 {old_handle.id} 已被新请求 {handle.id} 取代")
         
         # 创建请求任务
         task = {
-            'id': request_id,
+            'id': handle.id,
+            'handle': handle,
             'type': 'send_message',
             'message_content': message_content,
             'chat_history': chat_history,
             'temperature': temperature,
             'model': model,
             'callback': callback,
+            'on_delta': on_delta,
+            'conversation': conversation,
+            'use_cache': not (regenerate and temperature > 0),
             'timestamp': datetime.now()
         }
         
         # 添加到队列
-        self._queue.put(task)
-        return request_id
+        self._submit(task)
+        return handle
         
     def test_connection_async(self, callback: Callable[[bool, Optional[str]], None]) -> int:
         """
@@ -89,18 +265,139 @@ class AsyncAPIClient:
         Returns:
             请求ID
         """
-        request_id = self._request_id
-        self._request_id += 1
-        
         task = {
-            'id': request_id,
+            'id': self._next_request_id(),
             'type': 'test_connection',
             'callback': callback,
             'timestamp': datetime.now()
         }
         
-        self._queue.put(task)
-        return request_id
+        self._submit(task)
+        return task['id']
+        
+    def warm_up_async(self):
+        """
+        异步预热API连接，让第一轮对话复用已建立的长连接
+        """
+        self._submit({'id': self._next_request_id(), 'type': 'warm_up', 'callback': None,
+                      'timestamp': datetime.now()})
+        
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取线程池统计信息
+        
+        Returns:
+            Dict[str, Any]: workers 工作线程数、busy 正在执行的任务数、queue_depth 排队任务数、
+            completed 已完成任务数，以及最近请求的排队等待时间 wait_ms_avg/wait_ms_p95/wait_ms_max；
+            retry 为API请求的重试统计（见 RetryStats.snapshot），routing 为各模型的健康状态（见 ModelRouter.get_stats），
+            hedging 为对冲统计（见 HedgeStats.snapshot，未开启对冲时为None），
+            cache 为响应缓存统计（见 ResponseCache.get_stats，未开启缓存时为None），
+            prompt_usage 为服务端报告的提示token用量及提示缓存命中情况（见 PromptUsageStats.snapshot）
+        """
+        with self._lock:
+            waits = sorted(self._wait_samples)
+            backlog = sum(len(pending) for pending in self._conversations.values())
+            return {
+                'engine': self._engine_name,
+                'workers': len(self._threads),
+                'busy': self._busy,
+                'queue_depth': self._queue.qsize() + backlog,
+                'completed': self._completed,
+                'wait_ms_avg': sum(waits) / len(waits) if waits else 0.0,
+                'wait_ms_p95': waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+                'wait_ms_max': waits[-1] if waits else 0.0,
+                'retry': get_retry_policy().get_stats(),
+                'routing': get_model_router().get_stats(),
+                'hedging': self._hedging.get_stats() if self._hedging else None,
+                'cache': get_response_cache().get_stats() if get_response_cache() else None,
+                'prompt_usage': get_prompt_usage_stats().snapshot(),
+            }
+        
+    def _next_request_id(self) -> int:
+        """分配请求ID（可能在多个线程中调用）"""
+        with self._lock:
+            request_id = self._request_id
+            self._request_id += 1
+            return request_id
+        
+    def _submit(self, task: Dict[str, Any]):
+        """提交任务：所属会话已有任务在排队或执行时，先挂在该会话后面"""
+        task['enqueued_at'] = time.monotonic()
+        conversation = task.get('conversation')
+        with self._lock:
+            if conversation is not None:
+                if conversation in self._conversations:
+                    self._conversations[conversation].append(task)
+                    return
+                self._conversations[conversation] = deque()
+        self._dispatch(task)
+        
+    def _dispatch(self, task: Dict[str, Any]):
+        """把可以立即执行的任务交给工作线程或事件循环"""
+        if self._engine is not None:
+            self._engine.submit(self._run_task_async(task))
+        else:
+            self._queue.put(task)
+        
+    def _release(self, task: Dict[str, Any]):
+        """任务完成后放行所属会话的下一个任务"""
+        conversation = task.get('conversation')
+        handle = task.get('handle')
+        if handle is not None:
+            with self._lock:
+                handles = self._active_handles.get(conversation, [])
+                if handle in handles:
+                    handles.remove(handle)
+                if not handles:
+                    self._active_handles.pop(conversation, None)
+            handle._done.set()
+        if conversation is None:
+            return
+        with self._lock:
+            pending = self._conversations.get(conversation)
+            if not pending:
+                self._conversations.pop(conversation, None)
+                return
+            next_task = pending.popleft()
+        self._dispatch(next_task)
+        
+    def _task_started(self, task: Dict[str, Any]) -> bool:
+        """
+        记录排队等待时间
+        
+        Returns:
+            bool: 需要执行返回True，排队期间已被取消返回False
+        """
+        wait_ms = (time.monotonic() - task['enqueued_at']) * 1000
+        with self._lock:
+            self._wait_samples.append(wait_ms)
+            self._busy += 1
+        if wait_ms >= SLOW_WAIT_MS:
+            print(f"请求 {task['id']} 排队等待 {wait_ms:.0f}ms，当前统计: {self.get_stats()}")
+        
+        handle = task.get('handle')
+        if handle is not None and handle.cancelled:
+            print(f"请求 {task['id']} 已取消，跳过")
+            return False
+        return True
+        
+    def _task_finished(self, task: Dict[str, Any]):
+        """更新统计并放行同一会话的下一个任务"""
+        with self._lock:
+            self._busy -= 1
+            self._completed += 1
+        self._release(task)
+        
+    async def _run_task_async(self, task: Dict[str, Any]):
+        """在 asyncio 引擎中执行任务"""
+        try:
+            if self._task_started(task):
+                await self._process_task_async(task)
+        except Exception as e:
+            print(f"异步引擎任务错误: {e}")
+            traceback.print_exc()
+        finally:
+            self._task_finished(task)
         
     def _worker(self):
         """后台工作线程"""
@@ -110,20 +407,23 @@ class AsyncAPIClient:
             try:
                 # 获取任务（最多等待1秒）
                 task = self._queue.get(timeout=1)
-                
-                # 检查是否为停止信号
-                if task is None:
-                    break
-                    
-                # 处理任务
-                self._process_task(task)
-                
             except queue.Empty:
                 # 队列为空，继续循环
                 continue
+                
+            # 检查是否为停止信号
+            if task is None:
+                break
+                
+            try:
+                # 处理任务（排队期间已被取消的直接跳过）
+                if self._task_started(task):
+                    self._process_task(task)
             except Exception as e:
                 print(f"工作线程错误: {e}")
                 traceback.print_exc()
+            finally:
+                self._task_finished(task)
                 
         # 异步API工作线程已停止
         
@@ -137,6 +437,10 @@ class AsyncAPIClient:
                 self._handle_send_message(task, callback)
             elif task_type == 'test_connection':
                 self._handle_test_connection(callback)
+            elif task_type == 'warm_up':
+                client = get_api_client()
+                if client:
+                    client.warm_up()
             else:
                 print(f"未知任务类型: {task_type}")
                 
@@ -156,34 +460,158 @@ class AsyncAPIClient:
             chat_history = task['chat_history']
             temperature = task['temperature']
             model = task.get('model')
+            cancel_token = task['handle'].cancel_token
             
             print(f"异步消息处理开始: {message_content}")
             
             print(f"异步处理消息: '{message_content}'")
-            print(f"消息历史: {chat_history}")
+            print(f"消息历史: {len(chat_history)} 条")
             
-            # 调用同步API，传入模型参数
-            response = send_message_to_ai(message_content, chat_history, temperature, model)
-            
-            print(f"同步API返回结果: {response is not None}")
-            if response:
-                print(f"返回内容长度: {len(response)}")
+            if self._hedging:
+                response = self._hedged_response(task)
+            elif task.get('on_delta'):
+                response = self._stream_response(task, self._delta_sink(task), model, cancel_token)
+            else:
+                # 调用同步API，传入模型参数
+                response = send_message_to_ai(message_content, chat_history, temperature, model, cancel_token,
+                                              use_cache=task['use_cache'])
             
-            if callback:
-                if response:
-                    print("调用成功回调")
-                    callback(True, response, None)
-                else:
-                    print("调用失败回调 - AI回复为空")
-                    callback(False, None, "AI回复为空")
+            self._deliver_response(task, callback, response)
                     
         except Exception as e:
             # 发送消息错误处理
             print(f"异步消息处理异常: {e}")
-            if callback:
+            if callback and not task['handle'].cancelled:
                 print("调用异常回调")
                 callback(False, None, str(e))
                 
+    def _deliver_response(self, task: Dict[str, Any],
+                          callback: Callable[[Optional[str], Optional[str]], None],
+                          response: Optional[str]):
+        """把聊天请求的结果交给回调（已取消的请求不回调）"""
+        if task['handle'].cancelled:
+            print(f"请求 {task['id']} 已取消，不再回调")
+            return
+        
+        print(f"同步API返回结果: {response is not None}")
+        if response:
+            print(f"返回内容长度: {len(response)}")
+        
+        if callback:
+            if response:
+                print("调用成功回调")
+                callback(True, response, None)
+            else:
+                print("调用失败回调 - AI回复为空")
+                callback(False, None, "AI回复为空")
+                
+    def _delta_sink(self, task: Dict[str, Any]) -> Callable[[str], None]:
+        """创建流式增量的接收函数：记录首个token耗时，并经节流器转发给界面"""
+        throttle = DeltaThrottle(task['on_delta'], cancel_token=task['handle'].cancel_token)
+        received = []
+        
+        def push(delta: str):
+            if not received:
+                first_token_ms = (datetime.now() - task['timestamp']).total_seconds() * 1000
+                print(f"首个token耗时: {first_token_ms:.0f}ms")
+                received.append(True)
+            throttle.push(delta)
+        return push
+        
+    def _stream_response(self, task: Dict[str, Any], push: Callable[[str], None], model: Optional[str],
+                         cancel_token: CancelToken, base_url: Optional[str] = None) -> Optional[str]:
+        """流式请求：增量文本交给 push，返回完整回复"""
+        parts = []
+        for delta in stream_message_to_ai(task['message_content'], task['chat_history'],
+                                          task['temperature'], model, cancel_token, base_url,
+                                          use_cache=task['use_cache']):
+            parts.append(delta)
+            push(delta)
+        return "".join(parts).strip() or None
+        
+    def _hedged_response(self, task: Dict[str, Any]) -> Optional[str]:
+        """对冲模式下的聊天请求（线程模式）：主请求迟迟没有首字节时再发一个请求，采用先返回的结果"""
+        hedging = self._hedging
+        model = task.get('model')
+        push = self._delta_sink(task) if task.get('on_delta') else None
+        
+        def attempt(is_hedge: bool, cancel_token: CancelToken, on_delta: Optional[Callable[[str], None]]):
+            target_model, base_url = hedging.target(model) if is_hedge else (model, None)
+            if on_delta is None:
+                return send_message_to_ai(task['message_content'], task['chat_history'], task['temperature'],
+                                          target_model, cancel_token, base_url, use_cache=task['use_cache'])
+            return self._stream_response(task, on_delta, target_model, cancel_token, base_url)
+        
+        return hedging.call(attempt, (model, push is not None), push, task['handle'].cancel_token)
+        
+    async def _process_task_async(self, task: Dict[str, Any]):
+        """在事件循环中处理单个任务（回调在事件循环线程中调用）"""
+        engine = self._engine
+        task_type = task['type']
+        callback = task.get('callback')
+        client = get_api_client()
+        
+        if task_type == 'send_message':
+            try:
+                client = get_model_client(task.get('model'))
+                if not client:
+                    raise APIError("API客户端未初始化")
+                messages = client.format_messages_for_api(task['chat_history'])
+                model = task.get('model')
+                push = self._delta_sink(task) if task.get('on_delta') else None
+                
+                async def attempt(is_hedge: bool, cancel_token: CancelToken,
+                                  on_delta: Optional[Callable[[str], None]]):
+                    target_model, base_url = self._hedging.target(model) if is_hedge else (model, None)
+                    received = []
+                    
+                    def forward(delta: str):
+                        received.append(True)
+                        on_delta(delta)
+                    
+                    async def request(routed_model: Optional[str]):
+                        routed_client = get_model_client(routed_model, base_url)
+                        if on_delta is None:
+                            return await engine.chat_completion(
+                                routed_client, messages, temperature=task['temperature'], cancel_token=cancel_token,
+                                use_cache=task['use_cache'])
+                        try:
+                            return await engine.chat_completion_stream(
+                                routed_client, messages, forward, temperature=task['temperature'],
+                                cancel_token=cancel_token, use_cache=task['use_cache'])
+                        except APIError as e:
+                            if received:
+                                # 已经开始输出，不再切换模型
+                                raise APIError(str(e))
+                            raise
+                    
+                    # 模型不可用时由路由器切换到其他可用模型
+                    return await get_model_router().call_async(target_model, request)
+                
+                cancel_token = task['handle'].cancel_token
+                if self._hedging:
+                    response = await self._hedging.call_async(attempt, (model, push is not None), push, cancel_token)
+                else:
+                    response = await attempt(False, cancel_token, push)
+                self._deliver_response(task, callback, response)
+            except Exception as e:
+                print(f"异步消息处理异常: {e}")
+                if callback and not task['handle'].cancelled:
+                    callback(False, None, str(e))
+        elif task_type == 'test_connection':
+            if not client:
+                if callback:
+                    callback(False, "API客户端未初始化")
+                return
+            success = await engine.test_connection(client)
+            if callback:
+                callback(success, None if success else "连接测试失败")
+        elif task_type == 'warm_up':
+            if client:
+                await engine.warm_up(client)
+        else:
+            print(f"未知任务类型: {task_type}")
+        
     def _handle_test_connection(self, callback: Callable[[bool, Optional[str]], None]):
         """处理测试连接任务"""
         try:
@@ -213,12 +641,17 @@ class AsyncAPIClient:
 _async_api_client = None
 
 
-def get_async_api_client() -> AsyncAPIClient:
-    """获取全局异步API客户端实例"""
+def get_async_api_client(engine: str = ENGINE_THREAD) -> AsyncAPIClient:
+    """
+    获取全局异步API客户端实例
+    
+    Args:
+        engine: 首次创建时使用的请求执行方式 ENGINE_THREAD 或 ENGINE_ASYNCIO
+    """
     global _async_api_client
     
     if _async_api_client is None:
-        _async_api_client = AsyncAPIClient()
+        _async_api_client = AsyncAPIClient(engine=engine)
         _async_api_client.start()
         
     return _async_api_client
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio API引擎模块
+在一个后台事件循环中发起所有API请求，少量线程即可同时处理大量并发请求。
+安装了 aiohttp 时使用 aiohttp，否则使用基于 asyncio 流的标准库 HTTP/1.1 实现（支持长连接和分块传输）。
+"""
+
+import asyncio
+import json
+import ssl
+import threading
+import concurrent.futures
+from typing import Optional, Callable, List, Dict, Any, Tuple
+from urllib.parse import urlsplit
+
+from tool.api_client import (
+    APIClient,
+    APIError,
+    CancelToken,
+    SSEDecoder,
+    SSE_DONE,
+    DEFAULT_POOL_SIZE,
+    REQUEST_TIMEOUT,
+    WARM_UP_TIMEOUT,
+    get_response_cache,
+    get_prompt_usage_stats,
+    parse_stream_delta,
+    status_error
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# 同时进行的最大请求数
+MAX_CONCURRENCY = 64
+# 读取网络数据的块大小
+READ_CHUNK_SIZE = 65536
+
+
+def _is_connect_error(error: Exception) -> bool:
+    """判断 aiohttp 的错误是否发生在建立连接阶段（请求尚未发出）"""
+    if aiohttp is None:
+        return False
+    connect_errors = (aiohttp.ClientConnectorError,)
+    if hasattr(aiohttp, 'ConnectionTimeoutError'):
+        connect_errors += (aiohttp.ConnectionTimeoutError,)
+    return isinstance(error, connect_errors) and not isinstance(error, aiohttp.ClientSSLError)
+
+
+class _StdlibResponse:
+    """标准库实现的HTTP响应"""
+
+    def __init__(self, transport, key, reader, writer, status: int, headers: Dict[str, str]):
+        self._transport = transport
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self.status = status
+        self.headers = headers
+        self._finished = False
+
+    async def iter_chunks(self):
+        """逐块读取响应体（分块传输时每收到一块就返回）"""
+        reader = self._reader
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+                if size == 0:
+                    # 读完结尾的 trailer 和空行
+                    while (await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)).strip():
+                        pass
+                    break
+                data = await asyncio.wait_for(reader.readexactly(size), REQUEST_TIMEOUT)
+                await reader.readexactly(2)
+                yield data
+        elif 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining > 0:
+                data = await asyncio.wait_for(reader.read(min(remaining, READ_CHUNK_SIZE)), REQUEST_TIMEOUT)
+                if not data:
+                    raise APIError("响应内容不完整")
+                remaining -= len(data)
+                yield data
+        else:
+            # 没有长度信息：读到连接关闭为止，之后连接不能复用
+            self.headers['connection'] = 'close'
+            while True:
+                data = await asyncio.wait_for(reader.read(READ_CHUNK_SIZE), REQUEST_TIMEOUT)
+                if not data:
+                    break
+                yield data
+        self._finished = True
+
+    async def read(self) -> bytes:
+        """读取完整响应体"""
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    def release(self):
+        """响应读完且允许长连接时放回连接池，否则关闭连接"""
+        if self._writer is None:
+            return
+        if self._finished and self.headers.get('connection', '').lower() != 'close':
+            self._transport._put_idle(self._key, self._reader, self._writer)
+        else:
+            self._writer.close()
+        self._writer = None
+
+
+class _StdlibTransport:
+    """基于 asyncio 流的 HTTP/1.1 客户端，按主机保持空闲长连接"""
+
+    name = "asyncio-stdlib"
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        self._pool_size = pool_size
+        self._idle: Dict[Tuple[str, str, int], List[tuple]] = {}
+        self._ssl_context = None
+
+    def _put_idle(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self._pool_size:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _open(self, key, timeout: float):
+        scheme, host, port = key
+        ssl_context = None
+        if scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context, limit=READ_CHUNK_SIZE), timeout)
+
+    async def _connect(self, key, timeout: float):
+        """建立新连接；失败时请求还没有发出，标记为可以安全重试"""
+        try:
+            return await self._open(key, timeout)
+        except asyncio.TimeoutError:
+            raise APIError("API请求超时", transient=True)
+        except ssl.SSLError:
+            # 证书错误重试也不会成功
+            raise
+        except OSError as e:
+            raise APIError(f"网络连接错误，请检查网络连接: {e}", transient=True)
+
+    async def request(self, method: str, url: str, headers: Dict[str, str],
+                      body: bytes = b"", timeout: float = REQUEST_TIMEOUT) -> _StdlibResponse:
+        """
+        发送请求并读取响应头
+
+        Args:
+            method: 请求方法
+            url: 完整URL
+            headers: 请求头
+            body: 请求体
+            timeout: 建立连接和等待响应头的超时秒数
+
+        Returns:
+            _StdlibResponse: 响应（读取完毕后需要调用 release()）
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        host_header = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host_header}", f"Content-Length: {len(body)}",
+                 "Connection: keep-alive"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        payload = ("\r\n".join(lines) + "\r\n\r\n").encode('utf-8') + body
+
+        while True:
+            idle = self._idle.get(key)
+            reused = bool(idle)
+            reader, writer = idle.pop() if idle else await self._connect(key, timeout)
+            try:
+                writer.write(payload)
+                await writer.drain()
+                status_line = await asyncio.wait_for(reader.readline(), timeout)
+                if not status_line:
+                    raise ConnectionResetError("连接已被服务器关闭")
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    # 复用的空闲连接已被服务器关闭，服务器没有处理请求，换新连接重试
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+
+        try:
+            status = int(status_line.split()[1])
+            response_headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+        response = _StdlibResponse(self, key, reader, writer, status, response_headers)
+        if method == 'HEAD':
+            response._finished = True
+        return response
+
+    async def close(self):
+        """关闭所有空闲连接"""
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class _AiohttpResponse:
+    """aiohttp 响应的适配器，与标准库实现提供相同的接口"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status = response.status
+        self.headers = {name.lower(): value for name, value in response.headers.items()}
+
+    async def iter_chunks(self):
+        async for data in self._response.content.iter_any():
+            yield data
+
+    async def read(self) -> bytes:
+        return await self._response.read()
+
+    def release(self):
+        self._response.release()
+
+
+class _AiohttpTransport:
+    """aiohttp 实现的HTTP客户端"""
+
+    name = "aiohttp"
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=pool_size * 16)
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    async def request(self, method: str, url: str, headers: Dict[str, str],
+                      body: bytes = b"", timeout: float = REQUEST_TIMEOUT) -> _AiohttpResponse:
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        response = await self._session.request(method, url, headers=headers, data=body or None,
+                                               timeout=client_timeout)
+        return _AiohttpResponse(response)
+
+    async def close(self):
+        await self._session.close()
+
+
+class AsyncEngine:
+    """在后台事件循环中运行的API请求引擎"""
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, use_aiohttp: Optional[bool] = None):
+        """
+        初始化引擎
+
+        Args:
+            pool_size: 每个主机保持的空闲长连接数
+            use_aiohttp: 是否使用 aiohttp，None 表示已安装时使用
+        """
+        self._pool_size = pool_size
+        self._use_aiohttp = aiohttp is not None if use_aiohttp is None else use_aiohttp and aiohttp is not None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread = None
+        self._transport = None
+        self._semaphore = None
+
+    @property
+    def transport_name(self) -> str:
+        """当前使用的HTTP实现"""
+        return "aiohttp" if self._use_aiohttp else _StdlibTransport.name
+
+    def start(self):
+        """启动事件循环线程"""
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.call_soon(ready.set)
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        self.submit(self._setup()).result()
+
+    async def _setup(self):
+        # aiohttp 会话和信号量必须在事件循环内创建
+        transport_class = _AiohttpTransport if self._use_aiohttp else _StdlibTransport
+        self._transport = transport_class(self._pool_size)
+        self._semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    def stop(self, timeout: float = 5):
+        """关闭连接并停止事件循环"""
+        if self._loop is None:
+            return
+        try:
+            self.submit(self._transport.close()).result(timeout)
+        except Exception as e:
+            print(f"关闭异步引擎连接时出错: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._loop.close()
+        self._loop = None
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """在引擎的事件循环中运行协程（可在任意线程调用）"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _post(self, client: APIClient, data: Dict[str, Any], timeout: float = REQUEST_TIMEOUT):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        try:
+            return await self._transport.request('POST', f"{client.base_url}/chat/completions",
+                                                 client.headers, body, timeout)
+        except APIError:
+            raise
+        except Exception as e:
+            # 只有建立连接失败（请求尚未发出）可以安全重试；之后的超时和断线服务器可能已经在生成
+            if _is_connect_error(e):
+                raise APIError(f"网络连接错误，请检查网络连接: {e}", transient=True)
+            if isinstance(e, asyncio.TimeoutError):
+                raise APIError("API请求超时")
+            if isinstance(e, (OSError, ConnectionError)) or (aiohttp is not None and isinstance(e, aiohttp.ClientError)):
+                raise APIError(f"网络连接错误，请检查网络连接: {e}")
+            raise
+
+    async def _run_cancellable(self, coro, cancel_token: Optional[CancelToken]):
+        """运行协程，取消标记被触发时立即取消（包括等待响应头的阶段）"""
+        if cancel_token is None:
+            return await coro
+        if cancel_token.cancelled:
+            coro.close()
+            return None
+        task = asyncio.ensure_future(coro)
+        loop = asyncio.get_running_loop()
+        abort = lambda: loop.call_soon_threadsafe(task.cancel)
+        cancel_token.on_cancel(abort)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if cancel_token.cancelled:
+                return None
+            raise
+        finally:
+            cancel_token.discard(abort)
+
+    async def chat_completion(self, client: APIClient, messages: List[Dict[str, str]],
+                              temperature: float = 0.7, max_tokens: int = 2000,
+                              model: Optional[str] = None,
+                              cancel_token: Optional[CancelToken] = None,
+                              use_cache: bool = True) -> Optional[str]:
+        """
+        发送非流式聊天请求
+
+        Args:
+            client: 提供 base_url、请求头和默认模型的API客户端
+            messages: API格式的消息列表
+            temperature: 创造性参数
+            max_tokens: 最大响应token数
+            model: 模型名称，None 使用客户端的默认模型
+            cancel_token: 取消标记
+            use_cache: 是否使用响应缓存（开启缓存时有效）
+
+        Returns:
+            AI回复内容，已取消时返回None
+
+        Raises:
+            APIError: 请求失败
+        """
+        data = {"model": model or client.model, "messages": messages, "temperature": temperature,
+                "max_tokens": max_tokens, "stream": False}
+        cache = get_response_cache() if use_cache else None
+        if cache:
+            cache_key = cache.make_key(client.base_url, data["model"], messages, temperature, max_tokens)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                print("命中响应缓存")
+                return cached
+
+        async def attempt(remaining: float):
+            async with self._semaphore:
+                response = await self._post(client, data, min(REQUEST_TIMEOUT, max(remaining, 1)))
+                try:
+                    body = (await response.read()).decode('utf-8', errors='replace')
+                except asyncio.TimeoutError:
+                    # 请求已经发出，服务器可能已经在生成，不重试
+                    raise APIError("API请求超时")
+                finally:
+                    response.release()
+            if response.status != 200:
+                raise status_error(response.status, body, response.headers.get('retry-after'))
+            try:
+                result = json.loads(body)
+                get_prompt_usage_stats().record(result.get('usage'))
+                content = result['choices'][0].get('message', {}).get('content', '')
+            except (ValueError, KeyError, IndexError) as e:
+                raise APIError(f"API响应格式错误: {e}")
+            return content.strip() if content else None
+
+        content = await self._run_cancellable(client.retry_policy.call_async(attempt), cancel_token)
+        if cache and content and not (cancel_token and cancel_token.cancelled):
+            cache.put(cache_key, content)
+        return content
+
+    async def chat_completion_stream(self, client: APIClient, messages: List[Dict[str, str]],
+                                     on_delta: Callable[[str], None],
+                                     temperature: float = 0.7, max_tokens: int = 2000,
+                                     model: Optional[str] = None,
+                                     cancel_token: Optional[CancelToken] = None,
+                                     use_cache: bool = True) -> Optional[str]:
+        """
+        发送流式聊天请求，每收到一段增量文本调用一次 on_delta（在事件循环线程中）
+
+        Args:
+            client: 提供 base_url、请求头和默认模型的API客户端
+            messages: API格式的消息列表
+            on_delta: 增量文本回调
+            temperature: 创造性参数
+            max_tokens: 最大响应token数
+            model: 模型名称，None 使用客户端的默认模型
+            cancel_token: 取消标记
+            use_cache: 是否使用响应缓存（开启缓存时有效，命中时一次性交给 on_delta）
+
+        Returns:
+            完整回复内容，已取消时返回None
+
+        Raises:
+            APIError: 请求失败
+        """
+        data = {"model": model or client.model, "messages": messages, "temperature": temperature,
+                "max_tokens": max_tokens, "stream": True}
+        cache = get_response_cache() if use_cache else None
+        if cache:
+            cache_key = cache.make_key(client.base_url, data["model"], messages, temperature, max_tokens)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                print("命中响应缓存")
+                on_delta(cached)
+                return cached
+
+        async def open_stream(remaining: float):
+            response = await self._post(client, data, min(REQUEST_TIMEOUT, max(remaining, 1)))
+            if response.status != 200:
+                try:
+                    body = (await response.read()).decode('utf-8', errors='replace')
+                finally:
+                    response.release()
+                raise status_error(response.status, body, response.headers.get('retry-after'))
+            return response
+
+        async def run():
+            parts = []
+
+            def consume(payloads: List[str]) -> bool:
+                """处理一批 data: 内容，收到 [DONE] 时返回False"""
+                for payload in payloads:
+                    if payload == SSE_DONE:
+                        return False
+                    content = parse_stream_delta(payload)
+                    if content:
+                        parts.append(content)
+                        on_delta(content)
+                return True
+
+            async with self._semaphore:
+                # 只重试建立连接和等待响应头的阶段：开始输出后再重试会让界面出现重复文本
+                response = await client.retry_policy.call_async(open_stream)
+                try:
+                    decoder = SSEDecoder()
+                    async for chunk in response.iter_chunks():
+                        # 收到 [DONE] 立即结束，不等服务器关闭响应体（连接不再复用）
+                        if not consume(decoder.feed(chunk)):
+                            break
+                    else:
+                        # 最后一行 data: 可能没有换行结尾
+                        consume(decoder.close())
+                except asyncio.TimeoutError:
+                    raise APIError("流式响应中断: 读取超时")
+                finally:
+                    response.release()
+            return "".join(parts).strip() or None
+
+        content = await self._run_cancellable(run(), cancel_token)
+        # 完整接收后才写入缓存
+        if cache and content and not (cancel_token and cancel_token.cancelled):
+            cache.put(cache_key, content)
+        return content
+
+    async def warm_up(self, client: APIClient) -> bool:
+        """预热到 base_url 的连接，放入连接池供后续请求复用"""
+        try:
+            response = await self._transport.request('HEAD', client.base_url, client.headers,
+                                                     timeout=WARM_UP_TIMEOUT)
+            response.release()
+            return True
+        except Exception as e:
+            print(f"API连接预热失败: {e}")
+            return False
+
+    async def test_connection(self, client: APIClient) -> bool:
+        """测试API连接"""
+        try:
+            # 连接测试必须真正访问网络，不使用响应缓存
+            response = await self.chat_completion(client, [{"role": "user", "content": "Hello"}], max_tokens=10,
+                                                  use_cache=False)
+            return response is not None
+        except APIError as e:
+            print(f"连接测试失败: {e}")
+            return False
+
+
+if __name__ == "__main__":
+    # 基准测试：100 个并发请求，对比线程模型与 asyncio 模型
+    # 用法: python -m tool.async_engine [并发数] [模拟耗时ms]
+    import contextlib
+    import io
+    import sys
+    import time
+    from tool.api_client import initialize_api_client
+    from tool.async_api_client import AsyncAPIClient, ENGINE_ASYNCIO, ENGINE_THREAD
+    from tool.mock_server import MockAPIServer
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 500
+    server = MockAPIServer(latency=latency_ms / 1000)
+    initialize_api_client("sk-mock", server.start(), "mock-model")
+    history = [{"role": "user", "content": "你好"}]
+
+    def run(engine, workers):
+        client = AsyncAPIClient(max_workers=workers, engine=engine)
+        threads_before = threading.active_count()
+        client.start()
+        threads_used = threading.active_count() - threads_before
+        latencies = []
+        finished = threading.Semaphore(0)
+        lock = threading.Lock()
+
+        def make_callback(start):
+            def callback(success, response, error=None):
+                with lock:
+                    latencies.append((time.perf_counter() - start) * 1000 if success else None)
+                finished.release()
+            return callback
+
+        # 屏蔽客户端的调试输出，避免终端打印影响计时
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for i in range(total):
+                # 每个请求属于不同的会话，互不阻塞
+                client.send_message_async("你好", history, make_callback(time.perf_counter()),
+                                          conversation=f"bench-{i}")
+            for _ in range(total):
+                finished.acquire()
+            elapsed = time.perf_counter() - start
+            client.stop()
+
+        ok = sorted(value for value in latencies if value is not None)
+        return {"threads": threads_used, "elapsed": elapsed, "failed": total - len(ok),
+                "p50": ok[len(ok) // 2] if ok else 0, "p95": ok[int(len(ok) * 0.95)] if ok else 0}
+
+    rows = [
+        (f"线程池×{DEFAULT_POOL_SIZE}", run(ENGINE_THREAD, DEFAULT_POOL_SIZE)),
+        (f"线程池×{total}", run(ENGINE_THREAD, total)),
+        (f"asyncio", run(ENGINE_ASYNCIO, 1)),
+    ]
+    server.stop()
+
+    print(f"{total} 个并发请求，模拟服务端耗时 {latency_ms:.0f}ms，asyncio HTTP实现: "
+          f"{'aiohttp' if aiohttp is not None else _StdlibTransport.name}")
+    print(f"{'模型':<12}{'线程数':>6}{'总耗时(s)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'失败':>6}")
+    for name, row in rows:
+        print(f"{name:<12}{row['threads']:>6}{row['elapsed']:>10.2f}{row['p50']:>10.0f}"
+              f"{row['p95']:>10.0f}{row['failed']:>6}")
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+原子写文件模块
+先写临时文件并 fsync，再原子替换目标文件，崩溃或被杀时不会留下写了一半的文件
+
+本模块只依赖标准库，便于在独立子进程中做故障注入测试。
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from typing import Any
+
+BACKUP_SUFFIX = ".bak"
+
+
+def _fsync_dir(dir_path: str) -> None:
+    """将目录项落盘，确保 rename 本身在断电后仍然生效（Windows 不支持，忽略）"""
+    if os.name == "nt":
+        return
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _make_backup(path: str) -> None:
+    """将当前文件复制为 .bak（同样先写临时文件再替换）"""
+    if not os.path.exists(path):
+        return
+    backup_path = path + BACKUP_SUFFIX
+    tmp_backup = backup_path + ".tmp"
+    shutil.copyfile(path, tmp_backup)
+    os.replace(tmp_backup, backup_path)
+
+
+def atomic_write_bytes(path: str, content: bytes, backup: bool = False) -> None:
+    """
+    原子写入二进制文件
+
+    Args:
+        path: 目标文件路径
+        content: 文件内容
+        backup: 是否在替换前保留上一版本为 path + ".bak"
+    """
+    dir_path = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dir_path, exist_ok=True)
+
+    # 临时文件必须与目标在同一目录，os.replace 才是原子操作
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if backup:
+            _make_backup(path)
+
+        os.replace(tmp_path, path)
+        _fsync_dir(dir_path)
+    except BaseException:
+        # 任何异常都清理临时文件，原文件保持不变
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def atomic_write_text(path: str, text: str, backup: bool = False, encoding: str = "utf-8") -> None:
+    """
+    原子写入文本文件
+
+    Args:
+        path: 目标文件路径
+        text: 文件内容
+        backup: 是否在替换前保留上一版本为 path + ".bak"
+        encoding: 文件编码
+    """
+    atomic_write_bytes(path, text.encode(encoding), backup=backup)
+
+
+def atomic_write_json(path: str, obj: Any, indent: int = 2, backup: bool = False) -> None:
+    """
+    原子写入 JSON 文件
+
+    Args:
+        path: 目标文件路径
+        obj: 要序列化的对象
+        indent: 缩进空格数
+        backup: 是否保留上一版本为 .bak
+    """
+    # 先完整序列化，序列化失败时不会触碰目标文件
+    text = json.dumps(obj, ensure_ascii=False, indent=indent)
+    atomic_write_text(path, text, backup=backup)
+
+
+def load_json_with_backup(path: str, default: Any = None) -> Any:
+    """
+    读取 JSON 文件，主文件缺失或损坏时回退到 .bak
+
+    Args:
+        path: 文件路径
+        default: 两者都不可用时的返回值
+
+    Returns:
+        解析后的对象或 default
+    """
+    for candidate in (path, path + BACKUP_SUFFIX):
+        if not os.path.exists(candidate):
+            continue
+        try:
+            with open(candidate, "r", encoding="utf-8") as f:
+                obj = json.load(f)
+            if candidate != path:
+                print(f"主文件损坏，已从备份恢复: {candidate}")
+            return obj
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            print(f"JSON文件损坏: {candidate} ({e})")
+    return default
+
+
+if __name__ == "__main__":
+    # 故障注入测试：在子进程写入大 JSON 的过程中强制杀掉进程，
+    # 检查目标文件始终是旧版本或新版本之一，而不是截断的半个文件
+    import random
+    import signal
+    import subprocess
+    import sys
+    import time
+
+    test_dir = tempfile.mkdtemp()
+    target = os.path.join(test_dir, "config.json")
+    old_obj = {"version": "old", "items": ["x" * 100] * 10}
+    atomic_write_json(target, old_obj, backup=True)
+
+    writer_code = (
+        "import importlib.util, sys\n"
+        "spec = importlib.util.spec_from_file_location('atomic_io', sys.argv[1])\n"
+        "m = importlib.util.module_from_spec(spec); spec.loader.exec_module(m)\n"
+        "obj = {'version': 'new', 'items': ['y' * 100] * 200000}\n"
+        "while True:\n"
+        "    m.atomic_write_json(sys.argv[2], obj, backup=True)\n"
+    )
+    naive_code = (
+        "import json, sys\n"
+        "obj = {'version': 'new', 'items': ['y' * 100] * 200000}\n"
+        "while True:\n"
+        "    with open(sys.argv[1], 'w', encoding='utf-8') as f:\n"
+        "        json.dump(obj, f, indent=2)\n"
+    )
+
+    def kill_during_writes(code, args, rounds):
+        corrupted = 0
+        for _ in range(rounds):
+            proc = subprocess.Popen([sys.executable, "-c", code] + args)
+            time.sleep(random.uniform(0.05, 0.4))
+            if os.name == "nt":
+                proc.kill()
+            else:
+                proc.send_signal(signal.SIGKILL)
+            proc.wait()
+            try:
+                with open(args[-1], "r", encoding="utf-8") as f:
+                    version = json.load(f)["version"]
+                assert version in ("old", "new")
+            except (json.JSONDecodeError, KeyError, AssertionError):
+                corrupted += 1
+        return corrupted
+
+    rounds = 20
+    corrupted = kill_during_writes(writer_code, [os.path.abspath(__file__), target], rounds)
+    leftovers = [name for name in os.listdir(test_dir) if name.endswith(".tmp")]
+    print(f"原子写入: {rounds} 次强制终止，损坏 {corrupted} 次，残留临时文件 {len(leftovers)} 个")
+    print(f"读取结果版本: {load_json_with_backup(target, {}).get('version')}")
+
+    naive_target = os.path.join(test_dir, "naive.json")
+    atomic_write_json(naive_target, old_obj)
+    naive_corrupted = kill_during_writes(naive_code, [naive_target], rounds)
+    print(f"直接覆盖写入（对照）: {rounds} 次强制终止，损坏 {naive_corrupted} 次")
+
+    shutil.rmtree(test_dir, ignore_errors=True)
+    sys.exit(1 if corrupted else 0)
@@ -39,6 +39,8 @@ from kivymd.uix.divider import MDDivider
 from tool import fonts  # 导入字体模块
 from kivymd.uix.boxlayout import MDBoxLayout
 from kivy.app import App
+from .atomic_io import atomic_write_json, load_json_with_backup
+from .data_saver import get_sqlite_store
 
 
 class CharacterManager:
@@ -60,11 +62,40 @@ class CharacterManager:
         self.delete_character_btn = None
         self.callbacks = {}
         
+    def _read_config(self) -> Dict[str, Any]:
+        """读取配置文件，主文件损坏时回退到备份"""
+        config = load_json_with_backup(self.config_path)
+        if config is None:
+            raise FileNotFoundError(f"配置文件不存在或已损坏: {self.config_path}")
+        return config
+    
+    def _load_characters_from_store(self, store) -> None:
+        """从 SQLite 后端加载角色信息，数据库为空时先从配置文件导入"""
+        characters = store.list_characters()
+        if not characters:
+            try:
+                app_config = self._read_config().get("app", {})
+                store.import_characters(app_config.get("characters", []), app_config.get("current_character"))
+                characters = store.list_characters()
+            except Exception as e:
+                print(f"从配置文件导入角色时出错: {e}")
+        
+        self.characters = [char["name"] for char in characters] or ["默认角色", "AI助手", "翻译专家", "编程助手", "写作助手"]
+        self.current_character = store.get_setting("current_character", "默认角色")
+    
     def load_characters_from_config(self) -> None:
         """从配置文件加载角色信息"""
         try:
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+            store = get_sqlite_store()
+            if store is not None:
+                self._load_characters_from_store(store)
+                if self.current_character not in self.characters:
+                    self.current_character = self.characters[0] if self.characters else "默认角色"
+                print(f"从数据库加载角色: {self.characters}")
+                print(f"当前角色: {self.current_character}")
+                return
+            
+            config = self._read_config()
             
             # 获取角色列表
             if "characters" in config.get("app", {}) and config["app"]["characters"]:
@@ -92,9 +123,14 @@ class CharacterManager:
     def update_current_character_in_config(self, character_name: str) -> None:
         """更新配置文件中的当前角色"""
         try:
+            store = get_sqlite_store()
+            if store is not None:
+                store.set_setting("current_character", character_name)
+                print(f"数据库中的当前角色已更新为: {character_name}")
+                return
+            
             # 读取当前配置文件
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+            config = self._read_config()
             
             # 更新当前角色
             config["app"]["current_character"] = character_name
@@ -103,8 +139,7 @@ class CharacterManager:
             config["metadata"]["last_updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             
             # 保存回文件
-            with open(self.config_path, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=4)
+            atomic_write_json(self.config_path, config, indent=4, backup=True)
                 
             print(f"配置文件中的当前角色已更新为: {character_name}")
             
@@ -114,10 +149,6 @@ class CharacterManager:
     def save_character_to_config(self, character_name: str) -> None:
         """将角色信息保存到配置文件并创建对应的对话记录文件"""
         try:
-            # 读取当前配置文件
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-            
             # 创建新角色配置
             new_character = {
                 "name": character_name,
@@ -126,6 +157,16 @@ class CharacterManager:
                 "icon": "account-circle-outline"  # 默认图标
             }
             
+            store = get_sqlite_store()
+            if store is not None:
+                # 数据库后端不需要预先创建对话记录文件
+                store.add_character(new_character)
+                print(f"角色 '{character_name}' 已添加到数据库")
+                return
+            
+            # 读取当前配置文件
+            config = self._read_config()
+            
             # 添加到角色列表
             if "characters" not in config["app"]:
                 config["app"]["characters"] = []
@@ -139,8 +180,7 @@ class CharacterManager:
                 config["metadata"]["last_updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 
                 # 保存回文件
-                with open(self.config_path, 'w', encoding='utf-8') as f:
-                    json.dump(config, f, ensure_ascii=False, indent=4)
+                atomic_write_json(self.config_path, config, indent=4, backup=True)
                 
                 # 创建对应的对话记录文件
                 from .platform_utils import get_storage_path
@@ -148,8 +188,7 @@ class CharacterManager:
                 os.makedirs(os.path.dirname(data_file_path), exist_ok=True)
                 
                 # 创建空的对话记录文件
-                with open(data_file_path, 'w', encoding='utf-8') as f:
-                    json.dump([], f, ensure_ascii=False, indent=2)
+                atomic_write_json(data_file_path, [], indent=2)
                 
                 print(f"角色 '{character_name}' 已添加到配置文件")
                 print(f"对话记录文件已创建: {data_file_path}")
@@ -160,9 +199,19 @@ class CharacterManager:
     def remove_character_from_config(self, character_name: str) -> None:
         """从配置文件中移除角色并删除对应的对话记录文件"""
         try:
+            store = get_sqlite_store()
+            if store is not None:
+                from .data_saver import delete_chat_data
+                for char in store.list_characters():
+                    if char["name"] == character_name:
+                        delete_chat_data(char.get("data_file") or f"data/chat_history_{character_name}.json")
+                        break
+                store.remove_character(character_name)
+                print(f"角色 '{character_name}' 已从数据库中移除")
+                return
+            
             # 读取当前配置文件
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+            config = self._read_config()
             
             # 获取要删除的角色的数据文件路径
             data_file_path = None
@@ -182,17 +231,15 @@ class CharacterManager:
                 config["metadata"]["last_updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 
                 # 保存回文件
-                with open(self.config_path, 'w', encoding='utf-8') as f:
-                    json.dump(config, f, ensure_ascii=False, indent=4)
+                atomic_write_json(self.config_path, config, indent=4, backup=True)
                     
                 print(f"角色 '{character_name}' 已从配置文件中移除")
                 
                 # 删除对应的对话记录文件
                 if data_file_path:
                     try:
-                        if os.path.exists(data_file_path):
-                            os.remove(data_file_path)
-                            print(f"对话记录文件已删除: {data_file_path}")
+                        from .data_saver import delete_chat_data
+                        delete_chat_data(data_file_path)
                     except Exception as e:
                         print(f"删除对话记录文件时出错: {e}")
                 
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+角色聊天记录路径解析模块
+把角色名映射为聊天记录文件的完整路径，按角色名建立字典索引，
+避免每条消息都遍历一次配置中的角色列表。
+"""
+
+import os
+import threading
+from typing import Callable, Dict, Any, Optional
+
+from .platform_utils import get_storage_path
+
+DEFAULT_CHARACTER = "默认角色"
+
+
+class CharacterPathResolver:
+    """角色名 -> 聊天记录文件路径"""
+
+    def __init__(self, config_getter: Callable[[], Dict[str, Any]]):
+        """
+        初始化路径解析器
+
+        Args:
+            config_getter: 返回当前配置字典的函数。配置被重新加载（字典对象被替换）时索引自动失效
+        """
+        self._config_getter = config_getter
+        self._index: Optional[Dict[str, str]] = None
+        self._config_ref = None
+        self._lock = threading.Lock()
+
+    def _build_index(self, config: Dict[str, Any]) -> Dict[str, str]:
+        """遍历一次配置中的角色列表建立索引"""
+        storage_path = get_storage_path()
+        index = {}
+        for char in config.get("app", {}).get("characters", []):
+            name = char.get("name") if isinstance(char, dict) else None
+            if not name:
+                continue
+            data_file = char.get("data_file", f"data/chat_history_{name}.json")
+            # 确保使用完整路径，特别是在移动端
+            index[name] = data_file if os.path.isabs(data_file) else os.path.join(storage_path, data_file)
+        return index
+
+    def resolve(self, character: Optional[str]) -> str:
+        """
+        获取角色的聊天记录文件路径
+
+        Args:
+            character: 角色名
+
+        Returns:
+            str: 聊天记录文件完整路径，配置中没有该角色时使用默认命名规则
+        """
+        config = self._config_getter() or {}
+        index = self._index
+        if index is None or config is not self._config_ref:
+            with self._lock:
+                if self._index is None or config is not self._config_ref:
+                    self._index = self._build_index(config)
+                    self._config_ref = config
+                index = self._index
+
+        path = index.get(character)
+        if path is None:
+            if character and character != DEFAULT_CHARACTER:
+                path = os.path.join(get_storage_path(), "data", f"chat_history_{character}.json")
+            else:
+                path = os.path.join(get_storage_path(), "data", "chat_data.json")
+            index[character] = path
+        return path
+
+    def invalidate(self) -> None:
+        """使索引失效（添加或删除角色后调用），下次解析时重建"""
+        with self._lock:
+            self._index = None
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天记录压缩模块
+聊天日志只追加不重写，编辑和撤回补丁会让日志不断变长、回放变慢。
+本模块在应用空闲时（或通过命令行）把补丁折叠进新的快照，并报告回收的空间和节省的回放时间；
+随后把较早的消息封存为压缩分段（见 chat_segments）。
+"""
+
+import glob
+import os
+import threading
+import traceback
+from typing import Optional, List, Dict, Any, Iterable
+
+from tool.platform_utils import get_storage_path
+from tool.data_saver import LOG_SUFFIX, compact_chat_log, seal_chat_log, get_log_path, get_sqlite_store
+
+
+def compact_chat_data_folder(data_dir: str = None, exclude: Iterable[str] = (),
+                             should_stop=None, skip_unchanged: Dict[str, tuple] = None) -> List[Dict[str, Any]]:
+    """
+    压缩 data 目录下的所有聊天日志
+
+    Args:
+        data_dir: 数据目录，默认为存储路径下的 data 目录
+        exclude: 跳过的聊天记录文件（如界面上正在显示的会话，压缩会改变记录位置）
+        should_stop: 返回True时提前结束的回调
+        skip_unchanged: 路径 -> (大小, 修改时间)，上次检查后未变化的日志跳过，本次结果会写回
+
+    Returns:
+        List[Dict[str, Any]]: 实际压缩的日志报告
+    """
+    if data_dir is None:
+        data_dir = os.path.join(get_storage_path(), "data")
+
+    excluded = {os.path.abspath(get_log_path(path)) for path in exclude if path}
+    reports = []
+    for log_path in sorted(glob.glob(os.path.join(data_dir, "*" + LOG_SUFFIX))):
+        if should_stop and should_stop():
+            break
+        if os.path.abspath(log_path) in excluded:
+            continue
+
+        try:
+            stat = os.stat(log_path)
+            if skip_unchanged is not None and skip_unchanged.get(log_path) == (stat.st_size, stat.st_mtime):
+                continue
+
+            report = compact_chat_log(log_path)
+            if report:
+                reports.append(report)
+                print(f"聊天记录已压缩: {os.path.basename(log_path)} "
+                      f"回收 {report['bytes_reclaimed']} 字节，"
+                      f"记录 {report['records_before']} -> {report['records_after']}，"
+                      f"回放 {report['replay_ms_before']:.1f}ms -> {report['replay_ms_after']:.1f}ms")
+
+            sealed = seal_chat_log(log_path)
+            if sealed:
+                print(f"聊天记录已封存: {os.path.basename(log_path)} {sealed['sealed_records']} 条 -> "
+                      f"{sealed['segments']} 个分段，{sealed['raw_bytes']} -> {sealed['compressed_bytes']} 字节")
+
+            if skip_unchanged is not None:
+                stat = os.stat(log_path)
+                skip_unchanged[log_path] = (stat.st_size, stat.st_mtime)
+        except Exception as e:
+            print(f"压缩聊天记录失败: {log_path} ({e})")
+            traceback.print_exc()
+    return reports
+
+
+class ChatCompactor:
+    """后台压缩线程，在应用空闲时按需运行，一次只运行一轮"""
+
+    def __init__(self):
+        """初始化压缩器"""
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop_requested = False
+        self._checked: Dict[str, tuple] = {}  # 已检查过且未变化的日志不再重复读取
+        self.last_reports: List[Dict[str, Any]] = []
+
+    def is_running(self) -> bool:
+        """是否有一轮压缩正在进行"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def request_compaction(self, data_dir: str = None, exclude: Iterable[str] = ()) -> bool:
+        """
+        在后台线程启动一轮压缩（立即返回）
+
+        Args:
+            data_dir: 数据目录
+            exclude: 跳过的聊天记录文件
+
+        Returns:
+            bool: 启动了新一轮返回True，上一轮尚未结束返回False
+        """
+        if get_sqlite_store() is not None:
+            # SQLite 后端直接在原行上修改，没有需要折叠的补丁
+            return False
+
+        with self._lock:
+            if self.is_running():
+                return False
+            self._stop_requested = False
+            self._thread = threading.Thread(target=self._run, args=(data_dir, list(exclude)), daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self, timeout: float = 5):
+        """请求停止并等待当前日志处理完"""
+        self._stop_requested = True
+        if self._thread:
+            self._thread.join(timeout=timeout)
+
+    def _run(self, data_dir: Optional[str], exclude: List[str]):
+        """后台压缩线程"""
+        reports = compact_chat_data_folder(data_dir, exclude, lambda: self._stop_requested, self._checked)
+        self.last_reports = reports
+        if reports:
+            reclaimed = sum(report['bytes_reclaimed'] for report in reports)
+            print(f"后台压缩完成: {len(reports)} 个聊天记录，共回收 {reclaimed} 字节")
+
+
+# 全局压缩器实例
+_chat_compactor = None
+
+
+def get_chat_compactor() -> ChatCompactor:
+    """获取全局压缩器实例"""
+    global _chat_compactor
+
+    if _chat_compactor is None:
+        _chat_compactor = ChatCompactor()
+
+    return _chat_compactor
+
+
+def stop_chat_compactor():
+    """停止全局压缩器"""
+    global _chat_compactor
+
+    if _chat_compactor:
+        _chat_compactor.stop()
+        _chat_compactor = None
+
+
+if __name__ == "__main__":
+    # 命令行压缩（请在应用关闭时运行）
+    # 用法: python -m tool.chat_compactor [data目录]
+    import sys
+
+    target_dir = sys.argv[1] if len(sys.argv) > 1 else None
+    results = compact_chat_data_folder(target_dir)
+    total_before = sum(report['bytes_before'] for report in results)
+    total_reclaimed = sum(report['bytes_reclaimed'] for report in results)
+    saved_ms = sum(report['replay_ms_before'] - report['replay_ms_after'] for report in results)
+    print(f"共压缩 {len(results)} 个聊天记录，回收 {total_reclaimed}/{total_before} 字节，"
+          f"回放时间共节省 {saved_ms:.1f}ms")
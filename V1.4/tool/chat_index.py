@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天日志偏移索引模块
+为 JSONL 聊天日志维护一个 .idx 旁路文件，按顺序保存每条记录在日志中的起始字节偏移，
+用于从文件末尾直接定位最近 N 条消息，启动耗时不随历史长度增长
+"""
+
+import os
+import struct
+from typing import List
+
+INDEX_SUFFIX = ".idx"
+_ENTRY = struct.Struct("<Q")  # 每条记录一个 8 字节小端无符号整数
+_ENTRY_SIZE = _ENTRY.size
+
+
+def get_index_path(log_path: str) -> str:
+    """获取日志对应的索引文件路径"""
+    return log_path + INDEX_SUFFIX
+
+
+def scan_line_offsets(log_path: str, start: int = 0) -> List[int]:
+    """
+    从指定位置顺序扫描日志，返回每个非空行的起始偏移
+
+    Args:
+        log_path: JSONL 日志路径
+        start: 开始扫描的字节偏移（必须位于行首）
+
+    Returns:
+        List[int]: 行起始偏移列表
+    """
+    offsets = []
+    with open(log_path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if line.strip():
+                offsets.append(pos)
+            pos += len(line)
+    return offsets
+
+
+class ChatLogIndex:
+    """JSONL 聊天日志的字节偏移索引"""
+
+    def __init__(self, log_path: str):
+        """
+        初始化索引
+
+        Args:
+            log_path: JSONL 日志路径
+        """
+        self.log_path = log_path
+        self.index_path = get_index_path(log_path)
+
+    def _write_entries(self, offsets: List[int], mode: str) -> None:
+        if not offsets and mode == 'ab':
+            return
+        with open(self.index_path, mode) as f:
+            f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+
+    def _read_entries(self, start: int, end: int) -> List[int]:
+        if end <= start:
+            return []
+        with open(self.index_path, 'rb') as f:
+            f.seek(start * _ENTRY_SIZE)
+            buf = f.read((end - start) * _ENTRY_SIZE)
+        return list(struct.unpack(f"<{len(buf) // _ENTRY_SIZE}Q", buf))
+
+    def rebuild(self) -> int:
+        """完整扫描日志重建索引，返回记录数"""
+        offsets = scan_line_offsets(self.log_path) if os.path.exists(self.log_path) else []
+        self._write_entries(offsets, 'wb')
+        return len(offsets)
+
+    def append(self, offsets: List[int]) -> None:
+        """追加新写入记录的偏移（日志先写、索引后写）"""
+        self._write_entries(offsets, 'ab')
+
+    def remove(self) -> None:
+        """删除索引文件（日志被重写前调用，避免留下过期索引）"""
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def count(self) -> int:
+        """
+        校验并修复索引，返回日志中的记录数
+
+        只检查索引最后一条是否仍指向行首，并补齐崩溃时写了日志却没写索引的尾部，
+        不需要扫描整个日志。
+        """
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        if not os.path.exists(self.index_path):
+            return self.rebuild()
+
+        index_size = os.path.getsize(self.index_path)
+        count = index_size // _ENTRY_SIZE
+        if index_size % _ENTRY_SIZE:
+            # 索引最后一条只写了一半，截掉
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(count * _ENTRY_SIZE)
+
+        if count == 0:
+            return self.rebuild() if log_size else 0
+
+        last = self._read_entries(count - 1, count)[0]
+        with open(self.log_path, 'rb') as f:
+            if last >= log_size:
+                return self.rebuild()
+            if last > 0:
+                f.seek(last - 1)
+                if f.read(1) != b"\n":
+                    return self.rebuild()
+            f.seek(last)
+            f.readline()
+            line_end = f.tell()
+
+        if line_end < log_size:
+            missing = scan_line_offsets(self.log_path, line_end)
+            self.append(missing)
+            count += len(missing)
+        return count
+
+    def read_offsets(self, start: int, end: int) -> List[int]:
+        """读取第 start 到 end（不含）条记录的偏移"""
+        return self._read_entries(start, end)
+
+
+if __name__ == "__main__":
+    # 简单测试：写入日志、删掉一部分索引后自动修复
+    import json
+    import tempfile
+
+    test_log = os.path.join(tempfile.mkdtemp(), "chat_history_test.jsonl")
+    with open(test_log, 'w', encoding='utf-8') as f:
+        for i in range(1000):
+            f.write(json.dumps({"role": "user", "content": f"消息 {i}"}, ensure_ascii=False) + "\n")
+
+    index = ChatLogIndex(test_log)
+    print(f"重建索引记录数: {index.count()}")
+
+    with open(index.index_path, 'r+b') as f:
+        f.truncate(500 * _ENTRY_SIZE + 3)
+    print(f"修复后记录数: {index.count()}")
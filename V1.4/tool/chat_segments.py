@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天记录冷存储分段模块
+较早的聊天记录从活动日志中切出为只读分段，用 zlib/lzma 压缩保存，
+只有向上翻页或搜索到这些记录时才解压。
+
+文件布局（以 chat_history_AI 为例）：
+    chat_history_AI.jsonl            活动日志（最近的消息和所有编辑/撤回补丁）
+    chat_history_AI.jsonl.000000.z   已封存的分段（只含消息，不含补丁）
+    chat_history_AI.jsonl.segments   分段清单（JSON），记录每个分段的起始位置和条数
+"""
+
+import lzma
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import List, Dict, Any
+
+from .atomic_io import atomic_write_bytes, atomic_write_json, load_json_with_backup, BACKUP_SUFFIX
+
+# 每个分段的消息条数，活动日志至少保留这么多条最近的消息
+SEGMENT_RECORDS = 5000
+MANIFEST_SUFFIX = ".segments"
+DEFAULT_CODEC = "zlib"
+
+_CODECS = {
+    "zlib": (".z", lambda raw: zlib.compress(raw, 6), zlib.decompress),
+    "lzma": (".xz", lambda raw: lzma.compress(raw, preset=6), lzma.decompress),
+}
+
+# 最近解压过的分段缓存（连续翻页通常落在同一分段）
+_CACHE_SIZE = 2
+_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_manifest_path(log_path: str) -> str:
+    """获取分段清单路径"""
+    return log_path + MANIFEST_SUFFIX
+
+
+def load_manifest(log_path: str) -> List[Dict[str, Any]]:
+    """读取分段清单，没有分段时返回空列表"""
+    manifest_path = get_manifest_path(log_path)
+    if not os.path.exists(manifest_path) and not os.path.exists(manifest_path + BACKUP_SUFFIX):
+        return []
+    return load_json_with_backup(manifest_path, [])
+
+
+def save_manifest(log_path: str, segments: List[Dict[str, Any]]) -> None:
+    """原子写入分段清单"""
+    atomic_write_json(get_manifest_path(log_path), segments, indent=2, backup=True)
+
+
+def sealed_count(segments: List[Dict[str, Any]]) -> int:
+    """已封存的记录总数"""
+    return segments[-1]["start"] + segments[-1]["count"] if segments else 0
+
+
+def write_segment(log_path: str, segments: List[Dict[str, Any]], lines: List[bytes],
+                  codec: str = DEFAULT_CODEC) -> Dict[str, Any]:
+    """
+    压缩写入一个新分段（尚未加入清单）
+
+    Args:
+        log_path: 活动日志路径
+        segments: 当前清单，用于确定分段编号和起始位置
+        lines: 分段内容，每项是一行完整的 JSONL
+        codec: 压缩方式 "zlib" 或 "lzma"
+
+    Returns:
+        Dict[str, Any]: 分段清单项
+    """
+    suffix, compress, _ = _CODECS[codec]
+    start = sealed_count(segments)
+    number = int(segments[-1]["file"].rsplit(".", 2)[-2]) + 1 if segments else 0
+    file_name = f"{os.path.basename(log_path)}.{number:06d}{suffix}"
+    raw = b"".join(lines)
+    content = compress(raw)
+    atomic_write_bytes(os.path.join(os.path.dirname(log_path), file_name), content)
+    return {"file": file_name, "start": start, "count": len(lines), "codec": codec,
+            "size": len(content), "raw_size": len(raw)}
+
+
+def read_segment(log_path: str, segment: Dict[str, Any]) -> List[bytes]:
+    """
+    解压读取一个分段的所有行（带小容量缓存）
+
+    Args:
+        log_path: 活动日志路径
+        segment: 分段清单项
+
+    Returns:
+        List[bytes]: 分段中的 JSONL 行
+    """
+    path = os.path.join(os.path.dirname(log_path), segment["file"])
+    mtime = os.path.getmtime(path)
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached and cached[0] == mtime:
+            _cache.move_to_end(path)
+            return cached[1]
+
+    with open(path, 'rb') as f:
+        lines = _CODECS[segment.get("codec", DEFAULT_CODEC)][2](f.read()).splitlines(keepends=True)
+
+    with _cache_lock:
+        _cache[path] = (mtime, lines)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return lines
+
+
+def remove_segments(log_path: str) -> None:
+    """删除所有分段文件和清单"""
+    for segment in load_manifest(log_path):
+        path = os.path.join(os.path.dirname(log_path), segment["file"])
+        if os.path.exists(path):
+            os.remove(path)
+    manifest_path = get_manifest_path(log_path)
+    for path in (manifest_path, manifest_path + BACKUP_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+    with _cache_lock:
+        for key in [key for key in _cache if key.startswith(log_path + ".")]:
+            del _cache[key]
+
+
+if __name__ == "__main__":
+    # 基准测试：合成 100 万条消息的历史，对比分段压缩前后的磁盘占用和加载耗时
+    # 用法: python -m tool.chat_segments [消息条数] [zlib|lzma]
+    import json
+    import shutil
+    import sys
+    import tempfile
+    import time
+    from tool import data_saver
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    codec = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_CODEC
+    test_dir = tempfile.mkdtemp()
+    data_file = os.path.join(test_dir, "chat_history_bench.json")
+    log = data_saver.get_log_path(data_file)
+
+    print(f"生成 {total} 条合成消息...")
+    with open(log, 'wb') as f:
+        for i in range(total):
+            role = "user" if i % 2 == 0 else "assistant"
+            message = {"id": i + 1, "role": role, "content": f"第 {i} 条消息：今天天气怎么样？我们聊聊第 {i % 97} 个话题吧。",
+                       "timestamp": "2025-01-01T12:00:00.000000"}
+            f.write((json.dumps(message, ensure_ascii=False) + "\n").encode('utf-8'))
+
+    def footprint():
+        return sum(os.path.getsize(os.path.join(test_dir, name)) for name in os.listdir(test_dir))
+
+    def timed(func, *args, repeat=5):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def measure():
+        data_saver.load_chat_tail(data_file, 50)  # 预热索引
+        with _cache_lock:
+            _cache.clear()
+        old_page_cold = timed(data_saver.load_chat_page, data_file, 1000, 50, repeat=1)
+        return {
+            "磁盘占用(MB)": footprint() / 1024 / 1024,
+            "最近50条(ms)": timed(data_saver.load_chat_tail, data_file, 50),
+            "早期一页·首次(ms)": old_page_cold,
+            "早期一页·缓存(ms)": timed(data_saver.load_chat_page, data_file, 1000, 50),
+            "完整加载(ms)": timed(data_saver.load_chat_data, data_file, repeat=1),
+        }
+
+    before = measure()
+    start = time.perf_counter()
+    report = data_saver.seal_chat_log(data_file, codec=codec)
+    seal_seconds = time.perf_counter() - start
+    after = measure()
+
+    print(f"封存 {report['sealed_records']} 条为 {report['segments']} 个分段（{codec}），耗时 {seal_seconds:.1f}s")
+    print(f"{'指标':<16}{'分段前':>12}{'分段后':>12}")
+    for key in before:
+        print(f"{key:<16}{before[key]:>12.2f}{after[key]:>12.2f}")
+
+    shutil.rmtree(test_dir, ignore_errors=True)
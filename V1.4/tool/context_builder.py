@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上下文构建模块
+按token预算（而不是固定条数）挑选发送给模型的最近消息：
+本地快速估算token数（中日韩字符按每字一个token计），并增量维护窗口内的token总数，
+每轮对话只处理新增的消息，不必重新扫描整个聊天记录。
+窗口按整块前移：连续多轮对话的上下文开头保持不变，可以命中服务端的提示缓存（prompt caching）。
+"""
+
+import re
+from typing import List, Dict, Any, Optional
+
+# 中日韩文字、假名、谚文和全角符号（这些字符大多每个字就是一个token）
+_CJK_RE = re.compile(r'[⺀-鿿가-힯豈-﫿︰-﹏＀-￯]')
+# 其他文字平均每个token的字符数
+CHARS_PER_TOKEN = 4
+# 每条消息的格式开销（角色、分隔符）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 为回复预留的token数（与请求的 max_tokens 一致）
+REPLY_RESERVE_TOKENS = 2000
+# 默认的上下文token上限（控制费用和延迟，config: app.context_tokens）
+DEFAULT_CONTEXT_TOKENS = 16000
+# 窗口超出预算时一次移出的比例：降到预算的 75% 以下，之后若干轮只在末尾追加，上下文开头保持不变
+DEFAULT_BLOCK_FRACTION = 0.25
+# 未知模型的上下文窗口
+DEFAULT_CONTEXT_WINDOW = 32000
+# 已知模型的上下文窗口（按名称前缀匹配，越长的前缀越优先）
+MODEL_CONTEXT_WINDOWS = {
+    "gemini-2.5": 1000000,
+    "gemini": 128000,
+    "gpt-4.1": 1000000,
+    "gpt-4o": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5": 16385,
+    "deepseek": 64000,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    快速估算文本的token数
+
+    Args:
+        text: 文本
+
+    Returns:
+        估算的token数（中日韩字符每字一个token，其他字符每4个一个token）
+    """
+    if not text:
+        return 0
+    other = len(_CJK_RE.sub('', text))
+    return len(text) - other + (other + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def context_window_of(model: Optional[str]) -> int:
+    """获取模型的上下文窗口大小（token）"""
+    if model:
+        for prefix in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+            if model.startswith(prefix):
+                return MODEL_CONTEXT_WINDOWS[prefix]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def context_budget(model: Optional[str], max_context_tokens: int = DEFAULT_CONTEXT_TOKENS,
+                   reply_tokens: int = REPLY_RESERVE_TOKENS) -> int:
+    """
+    计算发送给模型的上下文token预算
+
+    Args:
+        model: 模型名称
+        max_context_tokens: 上下文token上限（控制费用和延迟）
+        reply_tokens: 为回复预留的token数
+
+    Returns:
+        上下文token预算：不超过上限，也不超过模型窗口减去回复预留
+    """
+    return max(1, min(max_context_tokens, context_window_of(model) - reply_tokens))
+
+
+# API接受的消息角色
+API_ROLES = ("user", "assistant", "system")
+
+
+def _message_tokens(message: Dict[str, Any]) -> int:
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _api_message(item: Dict[str, Any]) -> Dict[str, str]:
+    return {'role': item['role'], 'content': item['content']}
+
+
+class ContextWindow:
+    """
+    聊天记录末尾的上下文窗口
+
+    每条可发送的消息只在加入时转换一次为API格式（{"role", "content"}）并估算token数，
+    之后构建上下文只是取列表末尾的切片，不再逐轮复制消息。
+    与聊天记录列表惰性同步：末尾追加的消息增量加入，编辑和撤回由 update/remove 就地更新，
+    列表被替换或在前面插入更早的消息时重建（沿用已转换的消息）。窗口内的token总数随增删增量维护。
+
+    窗口不逐条滑动：超出token预算或条数上限时一次移出最旧的一整块，降到低水位（上限减去一块），
+    之后的若干轮只在末尾追加，发送的上下文共享同一段开头，服务端的提示缓存得以命中。
+    block 为 0 时退化为逐条滑动（始终在上限内包含尽量多的消息）。
+
+    返回的消息字典在多轮之间共用，调用方不应修改。
+    """
+
+    def __init__(self):
+        self._source: Optional[List[Any]] = None
+        self._source_last: Any = None
+        self._synced_len = 0
+        # 聊天记录中可以发送的消息、对应的API格式消息及其token数（三个列表按下标对应）
+        self._items: List[Dict[str, Any]] = []
+        self._messages: List[Dict[str, str]] = []
+        self._tokens: List[int] = []
+        # 窗口起点（列表下标）和窗口内的token总数
+        self._start = 0
+        self.total_tokens = 0
+        self._budget = DEFAULT_CONTEXT_TOKENS
+        self._max_messages: Optional[int] = None
+        self._block = DEFAULT_BLOCK_FRACTION
+        # 窗口起点每变化一次加一（上下文开头随之改变）
+        self.generation = 0
+
+    @staticmethod
+    def _usable(item: Any) -> bool:
+        return isinstance(item, dict) and item.get('role') in API_ROLES and bool(item.get('content'))
+
+    def _sync(self, messages: List[Any]):
+        """把聊天记录的变化同步到窗口"""
+        synced = self._synced_len
+        if (messages is self._source and synced <= len(messages)
+                and (synced == 0 or messages[synced - 1] is self._source_last)):
+            # 只在末尾追加了消息：增量转换新消息
+            for index in range(synced, len(messages)):
+                item = messages[index]
+                if self._usable(item):
+                    tokens = _message_tokens(item)
+                    self._items.append(item)
+                    self._messages.append(_api_message(item))
+                    self._tokens.append(tokens)
+                    self.total_tokens += tokens
+        else:
+            # 列表被替换或在前面插入了消息：重建（沿用已转换的消息和token数）
+            known = {id(item): index for index, item in enumerate(self._items)}
+            items, api_messages, token_counts = [], [], []
+            for item in messages:
+                if not self._usable(item):
+                    continue
+                index = known.get(id(item))
+                items.append(item)
+                if index is None:
+                    api_messages.append(_api_message(item))
+                    token_counts.append(_message_tokens(item))
+                else:
+                    api_messages.append(self._messages[index])
+                    token_counts.append(self._tokens[index])
+            self._items, self._messages, self._tokens = items, api_messages, token_counts
+            self._start = len(items)
+            self.total_tokens = 0
+            self.generation += 1
+        self._source = messages
+        self._synced_len = len(messages)
+        self._source_last = messages[-1] if messages else None
+
+    def _fit(self):
+        """调整窗口起点：超出上限时从最旧的消息开始整块移出，低于低水位时往前纳入更早的消息"""
+        count = len(self._tokens)
+        start = self._start
+        low_tokens = self._budget - int(self._budget * self._block)
+        if self._max_messages:
+            max_messages = self._max_messages
+            low_messages = max(1, max_messages - int(max_messages * self._block))
+        else:
+            max_messages = low_messages = count
+        # 超出上限时移出到低水位（至少保留最新的一条消息）
+        if self.total_tokens > self._budget or count - self._start > max_messages:
+            while count - self._start > 1 and (
+                    self.total_tokens > low_tokens or count - self._start > low_messages):
+                self.total_tokens -= self._tokens[self._start]
+                self._start += 1
+        # 往前纳入更早的消息，直到低水位
+        while self._start > 0 and count - self._start < low_messages:
+            tokens = self._tokens[self._start - 1]
+            if self.total_tokens + tokens > low_tokens and count - self._start >= 1:
+                break
+            self._start -= 1
+            self.total_tokens += tokens
+        if self._start != start:
+            self.generation += 1
+
+    def build(self, messages: List[Any], budget: int, max_messages: Optional[int] = None,
+              block: float = DEFAULT_BLOCK_FRACTION) -> List[Dict[str, str]]:
+        """
+        构建发送给API的上下文
+
+        Args:
+            messages: 聊天记录（按时间顺序）
+            budget: 上下文token预算（见 context_budget）
+            max_messages: 最多包含的消息条数，None 表示不限
+            block: 超出上限时一次移出的比例（0-1），0 表示逐条滑动
+
+        Returns:
+            List[Dict[str, str]]: 预算内最新的若干条消息，格式为 {"role", "content"}
+        """
+        self._sync(messages)
+        self._budget = budget
+        self._max_messages = max_messages
+        self._block = min(max(block, 0.0), 0.9)
+        self._fit()
+        return self._messages[self._start:]
+
+    def dropped_after(self, message_id: int) -> List[Dict[str, Any]]:
+        """
+        获取已移出窗口、且 id 大于 message_id 的消息（按时间顺序）
+
+        从窗口起点往前找，遇到 id 不大于 message_id 的消息即停止，只处理新移出的消息。
+        没有 id 的消息（如界面上的错误提示）不计入。
+        """
+        result = []
+        for index in range(self._start - 1, -1, -1):
+            item = self._items[index]
+            item_id = item.get('id')
+            if item_id is None:
+                continue
+            if item_id <= message_id:
+                break
+            result.append(item)
+        result.reverse()
+        return result
+
+    def _find(self, message: Dict[str, Any]) -> int:
+        """按对象查找消息的下标（从末尾往前，最近的消息几乎立即命中），找不到时返回-1"""
+        for index in range(len(self._items) - 1, -1, -1):
+            if self._items[index] is message:
+                return index
+        return -1
+
+    def update(self, message: Dict[str, Any]):
+        """消息内容被原地修改（如编辑AI回复）后更新它的API格式和token数"""
+        index = self._find(message)
+        if index < 0:
+            return
+        if not self._usable(message):
+            # 编辑后不再可发送，下次构建时重建
+            self._source = None
+            return
+        tokens = _message_tokens(message)
+        if index >= self._start:
+            self.total_tokens += tokens - self._tokens[index]
+        # 换成新的字典，不影响仍在发送中的上一轮上下文
+        self._messages[index] = _api_message(message)
+        self._tokens[index] = tokens
+
+    def remove(self, message: Dict[str, Any]):
+        """消息已从聊天记录列表中删除（撤回）后，把它移出窗口"""
+        if self._source is None:
+            return
+        index = self._find(message)
+        if index < 0:
+            # 不是已同步的可发送消息，无法确定列表的变化，下次构建时重建
+            self._source = None
+            return
+        if index >= self._start:
+            self.total_tokens -= self._tokens[index]
+            if index == self._start:
+                self.generation += 1
+        else:
+            self._start -= 1
+        del self._items[index], self._messages[index], self._tokens[index]
+        self._synced_len -= 1
+        self._source_last = self._source[self._synced_len - 1] if self._synced_len else None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取窗口状态
+
+        Returns:
+            Dict[str, Any]: messages 窗口内消息数、tokens 窗口内估算token数、budget 当前预算、
+            dropped 因预算或条数被排除在外的较早消息数、generation 窗口起点变化次数
+        """
+        return {
+            'messages': len(self._tokens) - self._start,
+            'tokens': self.total_tokens,
+            'budget': self._budget,
+            'dropped': self._start,
+            'generation': self.generation,
+        }
+
+
+if __name__ == "__main__":
+    # 基准测试：长聊天记录中每轮追加一问一答后构建上下文，
+    # 对比按条数复制最近消息（旧做法）、每轮从头估算token与增量维护窗口的耗时，并对比按条数截取与按token预算截取的实际token数；
+    # 最后对比逐条滑动与整块前移时，相邻两轮请求共享的上下文开头（可命中服务端提示缓存的部分）占比
+    # 用法: python -m tool.context_builder [历史消息数] [轮数]
+    import sys
+    import time
+
+    history_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    samples = ["你好，今天过得怎么样？", "I'm fine, thanks. " * 20, "这是一段比较长的回复。" * 60, "ok"]
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}. {samples[i % len(samples)]}"}
+               for i in range(history_size)]
+    budget = context_budget("deepseek-chat", 8000)
+
+    def rescan(messages):
+        # 每轮从最新的消息往前重新估算，直到超出预算
+        result, total = [], 0
+        for item in reversed(messages):
+            tokens = _message_tokens(item)
+            if result and total + tokens > budget:
+                break
+            result.append(item)
+            total += tokens
+        return result[::-1]
+
+    def copy_tail(messages):
+        # 旧做法：复制最近50条为新字典，格式化时再复制一遍
+        tail = [{'role': item['role'], 'content': item['content']} for item in messages[-50:]
+                if isinstance(item, dict) and 'role' in item and 'content' in item]
+        return [{'role': item['role'], 'content': item['content']} for item in tail]
+
+    timings = {}
+    for name in ("复制50条", "重新扫描", "增量窗口"):
+        messages = list(history)
+        window = ContextWindow()
+        start = time.perf_counter()
+        for turn in range(rounds):
+            messages.append({"role": "user", "content": f"{turn}? {samples[turn % len(samples)]}"})
+            if name == "复制50条":
+                context = copy_tail(messages)
+            elif name == "重新扫描":
+                context = rescan(messages)
+            else:
+                context = window.build(messages, budget, block=0)
+            messages.append({"role": "assistant", "content": f"{turn}! {samples[(turn + 2) % len(samples)]}"})
+        timings[name] = (time.perf_counter() - start) * 1000 / rounds
+    assert [m['content'] for m in rescan(messages)] == [m['content'] for m in window.build(messages, budget, block=0)]
+
+    print(f"历史 {history_size} 条，{rounds} 轮，token预算 {budget}")
+    for name, elapsed in timings.items():
+        print(f"{name:<8} 每轮 {elapsed:.3f}ms")
+    by_count = sum(_message_tokens(item) for item in messages[-50:])
+    stats = window.get_stats()
+    print(f"按条数截取最近50条: 约 {by_count} tokens")
+    print(f"按token预算截取: {stats['messages']} 条，约 {stats['tokens']} tokens")
+
+    for block in (0, DEFAULT_BLOCK_FRACTION):
+        messages = list(history)
+        window = ContextWindow()
+        previous, shared, sent = [], 0, 0
+        for turn in range(rounds):
+            messages.append({"role": "user", "content": f"{turn}? {samples[turn % len(samples)]}"})
+            context = window.build(messages, budget, block=block)
+            # 与上一轮请求相同的开头（逐条比较，直到第一条不同的消息）
+            for old, new in zip(previous, context):
+                if old != new:
+                    break
+                shared += _message_tokens(new)
+            sent += window.total_tokens
+            previous = context
+            messages.append({"role": "assistant", "content": f"{turn}! {samples[(turn + 2) % len(samples)]}"})
+        name = "逐条滑动" if block == 0 else f"整块前移({block:.0%})"
+        print(f"{name:<12} 与上一轮共享的开头占发送token的 {shared / sent:.0%}，平均每轮发送约 {sent // rounds} tokens")
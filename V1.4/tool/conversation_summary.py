@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对话摘要模块
+把移出上下文窗口的较早对话总结成一段简短摘要，作为系统消息放在上下文开头，
+长对话每轮发送的内容不再随聊天记录增长。摘要在后台线程生成，按角色保存在聊天记录文件旁边；
+每次只把新移出窗口的消息合并进已有摘要，不会从头重新总结。
+"""
+
+import os
+import threading
+import traceback
+from datetime import datetime
+from typing import Optional, List, Dict, Any
+
+from tool.atomic_io import atomic_write_json, load_json_with_backup
+from tool.api_client import get_model_client
+
+# 摘要文件后缀（不用 .json/.jsonl，避免被当作聊天记录加载或压缩）
+SUMMARY_SUFFIX = ".summary"
+# 累计多少条新移出窗口的消息后更新一次摘要
+SUMMARY_BATCH_MESSAGES = 6
+# 摘要长度上限（字）
+SUMMARY_MAX_CHARS = 600
+# 单次合并的对话内容上限（字），超出时分批合并
+SUMMARY_MAX_BATCH_CHARS = 6000
+# 生成摘要的最大token数
+SUMMARY_MAX_TOKENS = 1000
+# 摘要系统消息的前缀
+SUMMARY_PREFIX = "以下是之前对话的摘要，请在回复时参考：\n"
+
+_SUMMARY_PROMPT = ("你是对话摘要助手。请把已有摘要和新的对话内容合并成一份新的摘要，不超过{max_chars}字。"
+                   "保留人物设定、重要事实、用户的偏好和约定以及尚未结束的话题，省略寒暄，用第三人称陈述。只输出摘要本身。")
+_ROLE_NAMES = {"user": "用户", "assistant": "AI"}
+
+
+def get_summary_path(data_file_path: str) -> str:
+    """获取聊天记录对应的摘要文件路径"""
+    return os.path.splitext(data_file_path)[0] + SUMMARY_SUFFIX
+
+
+class ConversationSummarizer:
+    """滚动对话摘要（按聊天记录文件分别维护，线程安全）"""
+
+    def __init__(self, model: Optional[str] = None, batch_messages: int = SUMMARY_BATCH_MESSAGES,
+                 max_chars: int = SUMMARY_MAX_CHARS):
+        """
+        初始化摘要器
+
+        Args:
+            model: 生成摘要使用的模型，None 表示使用当前对话的模型
+            batch_messages: 累计多少条新移出窗口的消息后更新一次摘要
+            max_chars: 摘要长度上限（字）
+        """
+        self.model = model
+        self.batch_messages = max(1, batch_messages)
+        self.max_chars = max_chars
+        # 聊天记录文件 -> {"summary": 摘要, "through_id": 已总结到的消息id}
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._threads: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+        self.updates = 0
+        self.summarized_messages = 0
+        self.failures = 0
+
+    def _get_state(self, data_file_path: str) -> Dict[str, Any]:
+        """获取摘要状态（首次访问时从磁盘读取）"""
+        with self._lock:
+            state = self._states.get(data_file_path)
+        if state is None:
+            loaded = load_json_with_backup(get_summary_path(data_file_path), None)
+            if not isinstance(loaded, dict) or not isinstance(loaded.get("summary"), str):
+                loaded = {"summary": "", "through_id": 0}
+            with self._lock:
+                state = self._states.setdefault(data_file_path, loaded)
+        return state
+
+    def through_id(self, data_file_path: str) -> int:
+        """获取摘要已覆盖到的消息 id（id 不大于它的消息都已总结过）"""
+        return self._get_state(data_file_path).get("through_id", 0)
+
+    def system_message(self, data_file_path: str) -> Optional[Dict[str, str]]:
+        """
+        获取放在上下文开头的摘要系统消息
+
+        Returns:
+            {"role": "system", "content": 摘要}，还没有摘要时返回None
+        """
+        summary = self._get_state(data_file_path).get("summary")
+        if not summary:
+            return None
+        return {"role": "system", "content": SUMMARY_PREFIX + summary}
+
+    def request_update(self, data_file_path: str, pending: List[Dict[str, Any]], model: Optional[str] = None) -> bool:
+        """
+        新移出窗口的消息足够多时，在后台线程把它们合并进摘要（立即返回）
+
+        Args:
+            data_file_path: 聊天记录文件路径
+            pending: 尚未总结、已移出上下文窗口的消息（见 ContextWindow.dropped_after）
+            model: 当前对话的模型（未指定摘要模型时使用）
+
+        Returns:
+            bool: 启动了后台更新返回True
+        """
+        messages = [{"id": message["id"], "role": message["role"], "content": message["content"]}
+                    for message in pending if message.get("role") in _ROLE_NAMES and message.get("content")]
+        if len(messages) < self.batch_messages:
+            return False
+        with self._lock:
+            thread = self._threads.get(data_file_path)
+            if thread is not None and thread.is_alive():
+                return False
+            thread = threading.Thread(target=self._run, args=(data_file_path, messages, self.model or model),
+                                      daemon=True)
+            self._threads[data_file_path] = thread
+        thread.start()
+        return True
+
+    def _run(self, data_file_path: str, messages: List[Dict[str, Any]], model: Optional[str]):
+        """后台更新线程：按批合并，每批完成后立即保存，失败时保留已有摘要下次再试"""
+        try:
+            while messages:
+                batch, size = [], 0
+                while messages and (not batch or size + len(messages[0]["content"]) <= SUMMARY_MAX_BATCH_CHARS):
+                    size += len(messages[0]["content"])
+                    batch.append(messages.pop(0))
+
+                previous = self._get_state(data_file_path).get("summary", "")
+                summary = self._summarize(previous, batch, model)
+                if not summary:
+                    with self._lock:
+                        self.failures += 1
+                    print(f"更新对话摘要失败: {os.path.basename(data_file_path)}")
+                    return
+
+                state = {"summary": summary, "through_id": batch[-1]["id"],
+                         "updated_at": datetime.now().isoformat()}
+                with self._lock:
+                    if self._threads.get(data_file_path) is not threading.current_thread():
+                        # 聊天记录已被删除（forget），丢弃结果，不再写回
+                        return
+                    self._states[data_file_path] = state
+                    self.updates += 1
+                    self.summarized_messages += len(batch)
+                    atomic_write_json(get_summary_path(data_file_path), state)
+                print(f"对话摘要已更新: {os.path.basename(data_file_path)} 合并 {len(batch)} 条消息，"
+                      f"摘要 {len(summary)} 字")
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            print(f"更新对话摘要时出错: {e}")
+            traceback.print_exc()
+
+    def forget(self, data_file_path: str) -> None:
+        """丢弃聊天记录的摘要状态（聊天记录被删除时调用），正在进行的后台更新的结果也会被丢弃"""
+        target = os.path.abspath(data_file_path)
+        with self._lock:
+            for path in [path for path in set(self._states) | set(self._threads) if os.path.abspath(path) == target]:
+                self._states.pop(path, None)
+                self._threads.pop(path, None)
+
+    def _summarize(self, previous: str, messages: List[Dict[str, Any]], model: Optional[str]) -> Optional[str]:
+        """请求模型把已有摘要和新消息合并成新摘要"""
+        client = get_model_client(model)
+        if client is None:
+            return None
+        dialogue = "\n".join(f"{_ROLE_NAMES[message['role']]}: {message['content']}" for message in messages)
+        prompt = [
+            {"role": "system", "content": _SUMMARY_PROMPT.format(max_chars=self.max_chars)},
+            {"role": "user", "content": f"已有摘要：\n{previous or '（无）'}\n\n新的对话：\n{dialogue}"},
+        ]
+        summary = client.create_chat_completion(prompt, temperature=0.3, max_tokens=SUMMARY_MAX_TOKENS)
+        return summary.strip() if summary else None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取摘要统计
+
+        Returns:
+            Dict[str, Any]: updates 摘要更新次数、summarized_messages 已合并的消息数、failures 失败次数
+        """
+        with self._lock:
+            return {
+                'updates': self.updates,
+                'summarized_messages': self.summarized_messages,
+                'failures': self.failures,
+            }
+
+
+# 全局摘要器实例（未开启时为None）
+_conversation_summarizer: Optional[ConversationSummarizer] = None
+
+
+def configure_conversation_summarizer(config: Optional[Dict[str, Any]]) -> Optional[ConversationSummarizer]:
+    """
+    根据配置（app.conversation_summary）开启或关闭对话摘要
+
+    Args:
+        config: {"enabled": bool, "model": 摘要模型, "batch_messages": 每批消息数, "max_chars": 摘要长度上限}
+
+    Returns:
+        ConversationSummarizer实例，未开启时返回None
+    """
+    global _conversation_summarizer
+    if not config or not config.get("enabled"):
+        _conversation_summarizer = None
+        return None
+    _conversation_summarizer = ConversationSummarizer(model=config.get("model"),
+                                                      batch_messages=config.get("batch_messages", SUMMARY_BATCH_MESSAGES),
+                                                      max_chars=config.get("max_chars", SUMMARY_MAX_CHARS))
+    return _conversation_summarizer
+
+
+def get_conversation_summarizer() -> Optional[ConversationSummarizer]:
+    """
+    获取全局对话摘要器
+
+    Returns:
+        ConversationSummarizer实例，未开启时返回None
+    """
+    return _conversation_summarizer
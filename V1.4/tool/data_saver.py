@@ -1,81 +1,909 @@
 import json
 import os
+import glob
+import threading
+import time
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 from .platform_utils import get_storage_path
+from .atomic_io import atomic_write_bytes, load_json_with_backup, BACKUP_SUFFIX
+from .chat_index import ChatLogIndex, get_index_path
+from .sqlite_store import SQLiteChatStore, conversation_key
+from .chat_segments import (
+    SEGMENT_RECORDS,
+    DEFAULT_CODEC,
+    load_manifest,
+    save_manifest,
+    sealed_count,
+    write_segment,
+    read_segment,
+    remove_segments
+)
 
-def save_message_to_chat_data(message_content: str, role: str = "user", data_file_path: str = None) -> bool:
+# 聊天记录采用 JSONL 追加日志存储：每行一条消息，追加消息只需写入一行，
+# 不再随历史长度增长而变慢。旧版 JSON 数组文件在首次写入时自动迁移。
+LOG_SUFFIX = ".jsonl"
+MIGRATED_SUFFIX = ".migrated"
+
+# 每条消息带有单调递增的 id。编辑和撤回不重写日志，而是追加补丁记录：
+#   {"op": "edit", "id": 消息id, "content": 新内容, "edited_at": 时间}
+#   {"op": "del", "id": 消息id}
+# 读取时按顺序回放。补丁记录总以 "op" 开头，扫描时无需解析消息行即可识别。
+PATCH_OP_EDIT = "edit"
+PATCH_OP_DELETE = "del"
+_PATCH_PREFIX = b'{"op"'
+
+_id_lock = threading.Lock()
+_last_message_id = 0
+
+# 每个日志一把锁：追加与压缩替换互斥（压缩的耗时部分在锁外完成）
+_log_locks: Dict[str, threading.Lock] = {}
+_log_locks_guard = threading.Lock()
+
+# 可选的 SQLite 存储后端，为 None 时使用 JSONL 文件
+_sqlite_store = None
+
+
+def _default_data_file_path() -> str:
+    return os.path.join(get_storage_path(), "data", "chat_data.json")
+
+
+def use_sqlite_backend(db_path: str = None, import_existing: bool = True) -> SQLiteChatStore:
+    """
+    切换到 SQLite 存储后端，之后本模块的读写函数都转发到数据库
+
+    Args:
+        db_path: 数据库路径，默认为存储路径下的 data/yuchat.db
+        import_existing: 首次启用时是否导入 data 目录下已有的 JSON 聊天记录
+
+    Returns:
+        SQLiteChatStore: 存储实例
+    """
+    global _sqlite_store
+
+    data_dir = os.path.join(get_storage_path(), "data")
+    if db_path is None:
+        db_path = os.path.join(data_dir, "yuchat.db")
+
+    if _sqlite_store is None or _sqlite_store.db_path != db_path:
+        _sqlite_store = SQLiteChatStore(db_path)
+        if import_existing and _sqlite_store.get_setting("json_imported") != "1":
+            count = _sqlite_store.import_json_histories(data_dir)
+            _sqlite_store.set_setting("json_imported", "1")
+            print(f"SQLite后端已启用，导入 {count} 个聊天记录文件")
+    return _sqlite_store
+
+
+def use_file_backend() -> None:
+    """切换回 JSONL 文件存储后端"""
+    global _sqlite_store
+
+    if _sqlite_store is not None:
+        _sqlite_store.close()
+        _sqlite_store = None
+
+
+def get_sqlite_store():
+    """返回当前的 SQLite 存储实例，未启用时返回None"""
+    return _sqlite_store
+
+
+def get_log_path(data_file_path: str) -> str:
+    """
+    获取聊天记录对应的 JSONL 日志文件路径
+
+    Args:
+        data_file_path: 配置中的聊天记录文件路径（.json 或 .jsonl）
+
+    Returns:
+        str: JSONL 日志文件路径
+    """
+    if data_file_path.endswith(LOG_SUFFIX):
+        return data_file_path
+    return os.path.splitext(data_file_path)[0] + LOG_SUFFIX
+
+
+def get_log_lock(log_path: str) -> threading.Lock:
+    """获取日志对应的写锁"""
+    key = os.path.abspath(log_path)
+    with _log_locks_guard:
+        lock = _log_locks.get(key)
+        if lock is None:
+            lock = _log_locks[key] = threading.Lock()
+        return lock
+
+
+def _get_legacy_path(data_file_path: str) -> str:
+    """获取旧版 JSON 数组文件路径"""
+    if data_file_path.endswith(LOG_SUFFIX):
+        return data_file_path[:-len(LOG_SUFFIX)] + ".json"
+    return data_file_path
+
+
+def new_message_id() -> int:
+    """
+    生成新的消息 id：以微秒时间戳为基准，同一进程内严格递增
+
+    旧版没有 id 的消息按其在日志中的位置取 位置+1，远小于时间戳，不会冲突。
     """
-    将消息保存到指定的聊天记录文件中
-    
+    global _last_message_id
+
+    with _id_lock:
+        _last_message_id = max(_last_message_id + 1, time.time_ns() // 1000)
+        return _last_message_id
+
+
+def is_patch_record(record: Any) -> bool:
+    """判断日志记录是否为编辑/撤回补丁"""
+    return isinstance(record, dict) and "op" in record
+
+
+def _assign_ids(messages: List[Any], base: int) -> List[Any]:
+    """为没有 id 的旧消息按位置补上 id（与回放时的规则一致）"""
+    return [dict(message, id=base + i + 1) if isinstance(message, dict) and "id" not in message else message
+            for i, message in enumerate(messages)]
+
+
+def _apply_patch(messages: Dict[Any, Any], patch: Dict[str, Any]) -> bool:
+    """将补丁应用到按 id 索引的消息上，目标不在其中时忽略并返回False"""
+    target = messages.get(patch.get("id"))
+    if target is None:
+        return False
+    if patch["op"] == PATCH_OP_DELETE:
+        del messages[patch["id"]]
+    elif patch["op"] == PATCH_OP_EDIT:
+        target.update({k: v for k, v in patch.items() if k not in ("op", "id")})
+    return True
+
+
+def _fold_patches(patches: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """合并针对同一条消息的多个补丁：撤回覆盖编辑，多次编辑只保留合并后的一条"""
+    folded: Dict[Any, Dict[str, Any]] = {}
+    for patch in patches:
+        previous = folded.get(patch.get("id"))
+        if previous is None or patch["op"] == PATCH_OP_DELETE:
+            folded[patch.get("id")] = dict(patch)
+        elif previous["op"] == PATCH_OP_EDIT:
+            previous.update(patch)
+    return list(folded.values())
+
+
+def _replay(lines, base: int = 0, orphans: List[Dict[str, Any]] = None) -> Dict[Any, Any]:
+    """
+    按顺序回放 JSONL 行：为旧消息补 id，应用编辑补丁并移除被撤回的消息
+
+    跳过空行和损坏的行（如崩溃时写了一半的最后一行），损坏的行仍占一个位置，
+    与偏移索引的计数保持一致。
+
+    Args:
+        lines: JSONL 行（str 或 bytes）
+        base: 第一行在日志中的位置
+        orphans: 传入列表时，收集目标不在 lines 中的补丁（目标在已封存的分段里）
+
+    Returns:
+        Dict[Any, Any]: 按 id 索引、保持日志顺序的消息
+    """
+    messages = {}
+    position = base
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        position += 1
+        try:
+            record = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            print(f"跳过损坏的聊天记录行: {line[:50]}")
+            continue
+        if is_patch_record(record):
+            if not _apply_patch(messages, record) and orphans is not None:
+                orphans.append(record)
+        elif isinstance(record, dict):
+            record.setdefault("id", position)
+            messages[record["id"]] = record
+        else:
+            messages[("raw", position)] = record
+    return messages
+
+
+def merge_pending_records(messages: List[Any], records: List[Dict[str, Any]]) -> List[Any]:
+    """
+    把尚未写入日志的记录按顺序合并到已读取的消息上
+
+    Args:
+        messages: 从日志读取的消息
+        records: 读取前取出的待写入记录（见 PersistenceWorker.pending_records），
+            其中读取期间已经写入日志的消息按 id 跳过，补丁重复应用结果不变
+
+    Returns:
+        List[Any]: 合并后的消息
+    """
+    if not records:
+        return messages
+    merged = {message["id"] if isinstance(message, dict) and "id" in message else ("raw", i): message
+              for i, message in enumerate(messages)}
+    for record in records:
+        if is_patch_record(record):
+            _apply_patch(merged, record)
+        elif record.get("id") not in merged:
+            merged[record["id"]] = dict(record)
+    return list(merged.values())
+
+
+def _read_visible(read, end: int, limit: int) -> Tuple[List[Any], int]:
+    """
+    读取第 end 条之前至少 limit 条可见消息（不足时读到开头为止）
+
+    日志位置还包含补丁记录和已撤回的消息，按位置只取 limit 条时，编辑、撤回多的会话会不足一页，
+    因此不足时成倍扩大读取范围；返回的消息可能多于 limit 条。
+
+    Args:
+        read: read(start, end) 读取第 start 到 end（不含）条记录中的可见消息
+        end: 结束位置
+        limit: 需要的可见消息条数
+
+    Returns:
+        Tuple[List[Any], int]: (消息列表, 读取的起始位置)
+    """
+    span = max(limit, 1)
+    while True:
+        start = max(end - span, 0)
+        messages = read(start, end)
+        if len(messages) >= limit or start == 0:
+            return messages, start
+        span *= 2
+
+
+def _read_log(log_path: str) -> List[Dict[str, Any]]:
+    """逐行读取并回放完整 JSONL 日志（先依次解压已封存的分段）"""
+    segments = load_manifest(log_path)
+    with open(log_path, 'rb') as f:
+        if not segments:
+            return list(_replay(f).values())
+        lines = [line for segment in segments for line in read_segment(log_path, segment)]
+        lines.extend(f)
+    return list(_replay(lines).values())
+
+
+def _scan_patches(f) -> List[Dict[str, Any]]:
+    """从文件当前位置读到末尾，只解析补丁行"""
+    patches = []
+    for line in f:
+        if line.startswith(_PATCH_PREFIX):
+            try:
+                patches.append(json.loads(line))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+    return patches
+
+
+def _encode_lines(messages: List[Dict[str, Any]]) -> List[bytes]:
+    """将消息编码为 JSONL 字节行"""
+    return [(json.dumps(message, ensure_ascii=False) + "\n").encode('utf-8') for message in messages]
+
+
+def _line_offsets(lines: List[bytes], base: int) -> List[int]:
+    """计算各行写入后的起始偏移"""
+    offsets = []
+    pos = base
+    for line in lines:
+        offsets.append(pos)
+        pos += len(line)
+    return offsets
+
+
+def _ends_with_newline(log_path: str) -> bool:
+    """判断日志是否以换行结尾（空文件或不存在也视为是）"""
+    if not os.path.exists(log_path):
+        return True
+    with open(log_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def _write_log(log_path: str, messages: List[Dict[str, Any]], prefix: bytes = b"") -> None:
+    """
+    将消息列表原子写入 JSONL 日志（临时文件 + fsync + 替换），并同步重建偏移索引
+
+    Args:
+        log_path: 日志路径
+        messages: 要写入的消息
+        prefix: 保留在新日志开头的原始字节（已是完整的 JSONL 行）
+    """
+    index = ChatLogIndex(log_path)
+    # 先删除旧索引：日志替换后、新索引写完前崩溃，下次读取会自动重建
+    index.remove()
+    lines = _encode_lines(messages)
+    atomic_write_bytes(log_path, prefix + b"".join(lines))
+    prefix_lines = prefix.splitlines(keepends=True)
+    prefix_offsets = [pos for pos, line in zip(_line_offsets(prefix_lines, 0), prefix_lines) if line.strip()]
+    index.append(prefix_offsets + _line_offsets(lines, len(prefix)))
+
+
+def migrate_json_to_jsonl(data_file_path: str) -> bool:
+    """
+    将旧版 JSON 数组聊天记录一次性迁移为 JSONL 日志
+
+    迁移成功后旧文件重命名为 *.json.migrated，避免被重复迁移或误读。
+
+    Args:
+        data_file_path: 旧版聊天记录文件路径
+
+    Returns:
+        bool: 发生迁移返回True，无需迁移或失败返回False
+    """
+    legacy_path = _get_legacy_path(data_file_path)
+    log_path = get_log_path(data_file_path)
+
+    if os.path.exists(log_path) or not os.path.exists(legacy_path):
+        return False
+
+    try:
+        chat_data = load_json_with_backup(legacy_path)
+        if chat_data is None:
+            raise ValueError("文件及备份均无法解析")
+        if not isinstance(chat_data, list):
+            chat_data = [chat_data]
+        chat_data = _assign_ids(chat_data, 0)
+    except (ValueError, FileNotFoundError) as e:
+        print(f"迁移聊天记录失败，旧文件无法解析: {legacy_path} ({e})")
+        return False
+
+    try:
+        _write_log(log_path, chat_data)
+        os.replace(legacy_path, legacy_path + MIGRATED_SUFFIX)
+        print(f"聊天记录已迁移为JSONL: {log_path} ({len(chat_data)} 条)")
+        return True
+    except Exception as e:
+        print(f"迁移聊天记录失败: {e}")
+        return False
+
+
+def migrate_chat_data_folder(data_dir: str = None) -> int:
+    """
+    迁移 data 目录下所有旧版聊天记录文件
+
+    Args:
+        data_dir: 数据目录，默认为存储路径下的 data 目录
+
+    Returns:
+        int: 迁移的文件数量
+    """
+    if data_dir is None:
+        data_dir = os.path.join(get_storage_path(), "data")
+
+    migrated = 0
+    for path in sorted(glob.glob(os.path.join(data_dir, "*.json"))):
+        if migrate_json_to_jsonl(path):
+            migrated += 1
+    return migrated
+
+
+def build_message(message_content: str, role: str = "user") -> Dict[str, Any]:
+    """
+    构建一条待保存的消息记录
+
     Args:
         message_content: 消息内容
         role: 消息角色 ("user" 或 "assistant")
+
+    Returns:
+        Dict[str, Any]: 消息记录
+    """
+    return {
+        "id": new_message_id(),
+        "role": role,
+        "content": message_content,
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+def build_edit_record(message_id: int, message_content: str) -> Dict[str, Any]:
+    """构建编辑补丁记录"""
+    return {"op": PATCH_OP_EDIT, "id": message_id, "content": message_content,
+            "edited_at": datetime.now().isoformat()}
+
+
+def build_delete_record(message_id: int) -> Dict[str, Any]:
+    """构建撤回（删除）补丁记录"""
+    return {"op": PATCH_OP_DELETE, "id": message_id}
+
+
+def append_messages_to_chat_data(messages: List[Dict[str, Any]], data_file_path: str = None,
+                                 fsync: bool = False) -> bool:
+    """
+    批量追加消息到聊天记录日志，一次打开文件、一次写入
+
+    Args:
+        messages: 要追加的消息记录列表（可包含编辑/撤回补丁记录）
         data_file_path: 聊天记录文件路径
-        
+        fsync: 写入后是否强制落盘
+
     Returns:
         bool: 保存成功返回True，失败返回False
     """
     if data_file_path is None:
-        data_file_path = os.path.join(get_storage_path(), "data", "chat_data.json")
-    
+        data_file_path = _default_data_file_path()
+
     try:
+        if _sqlite_store is not None:
+            _sqlite_store.append_messages(conversation_key(data_file_path), messages)
+            return True
+
         # 确保目录存在
         os.makedirs(os.path.dirname(data_file_path), exist_ok=True)
-        
-        # 如果文件不存在，创建空列表
-        if not os.path.exists(data_file_path):
-            chat_data = []
-        else:
-            # 读取现有数据
-            try:
-                with open(data_file_path, 'r', encoding='utf-8') as f:
-                    chat_data = json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                chat_data = []
-        
-        # 创建新消息
-        new_message = {
-            "role": role,
-            "content": message_content,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        # 添加到聊天记录
-        chat_data.append(new_message)
-        
-        # 写回文件
-        with open(data_file_path, 'w', encoding='utf-8') as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
-            
+
+        # 旧版 JSON 数组文件先迁移，之后只追加不重写
+        migrate_json_to_jsonl(data_file_path)
+
+        log_path = get_log_path(data_file_path)
+        lines = _encode_lines(messages)
+        with get_log_lock(log_path):
+            index = ChatLogIndex(log_path)
+            index.count()  # 确保索引与日志一致后再追加偏移
+
+            # 上次崩溃时最后一行只写了一半：先补换行，否则新记录会接在半行后面，整行被当作损坏跳过
+            # （半行本身已被索引计为一个位置，仍作为损坏行保留）
+            separator = b"" if _ends_with_newline(log_path) else b"\n"
+            with open(log_path, 'ab') as f:
+                base = f.tell() + len(separator)
+                f.write(separator + b"".join(lines))
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            index.append(_line_offsets(lines, base))
+
         return True
-        
+
     except Exception as e:
         print(f"保存消息失败: {e}")
         return False
 
+
+def save_message_to_chat_data(message_content: str, role: str = "user", data_file_path: str = None) -> bool:
+    """
+    将消息追加保存到指定的聊天记录文件中
+
+    Args:
+        message_content: 消息内容
+        role: 消息角色 ("user" 或 "assistant")
+        data_file_path: 聊天记录文件路径
+
+    Returns:
+        bool: 保存成功返回True，失败返回False
+    """
+    return append_messages_to_chat_data([build_message(message_content, role)], data_file_path)
+
+
+def update_message(data_file_path: str, message_id: int, message_content: str) -> bool:
+    """
+    修改一条消息的内容（追加编辑补丁，不重写日志）
+
+    Args:
+        data_file_path: 聊天记录文件路径
+        message_id: 消息 id
+        message_content: 新内容
+
+    Returns:
+        bool: 保存成功返回True，失败返回False
+    """
+    return append_messages_to_chat_data([build_edit_record(message_id, message_content)], data_file_path)
+
+
+def delete_messages(data_file_path: str, message_ids: List[int]) -> bool:
+    """
+    撤回消息（追加撤回补丁，不重写日志）
+
+    Args:
+        data_file_path: 聊天记录文件路径
+        message_ids: 要撤回的消息 id 列表
+
+    Returns:
+        bool: 保存成功返回True，失败返回False
+    """
+    return append_messages_to_chat_data([build_delete_record(message_id) for message_id in message_ids],
+                                        data_file_path)
+
+
+def seal_chat_log(data_file_path: str, segment_records: int = SEGMENT_RECORDS,
+                  keep_records: int = SEGMENT_RECORDS, codec: str = DEFAULT_CODEC) -> Dict[str, Any]:
+    """
+    将活动日志中较早的消息封存为压缩分段，活动日志只保留最近的消息和补丁
+
+    与压缩一样，读取、回放和压缩写分段都在锁外进行，只有替换活动日志时持有锁。
+
+    Args:
+        data_file_path: 聊天记录文件路径
+        segment_records: 每个分段的消息条数
+        keep_records: 活动日志至少保留的最近消息条数
+        codec: 压缩方式 "zlib" 或 "lzma"
+
+    Returns:
+        Dict[str, Any]: 封存报告，消息不足以封存一个分段时返回None
+    """
+    log_path = get_log_path(data_file_path)
+    if not os.path.exists(log_path):
+        return None
+
+    lock = get_log_lock(log_path)
+    with lock:
+        snapshot_end = os.path.getsize(log_path)
+    with open(log_path, 'rb') as f:
+        raw = f.read(snapshot_end)
+
+    segments = load_manifest(log_path)
+    orphans = []
+    messages = list(_replay(raw.splitlines(), sealed_count(segments), orphans).values())
+    sealable = (len(messages) - keep_records) // segment_records * segment_records
+    if sealable <= 0:
+        return None
+
+    new_segments = list(segments)
+    for i in range(0, sealable, segment_records):
+        new_segments.append(write_segment(log_path, new_segments,
+                                          _encode_lines(messages[i:i + segment_records]), codec))
+    remaining = b"".join(_encode_lines(_fold_patches(orphans) + messages[sealable:]))
+
+    with lock:
+        with open(log_path, 'rb') as f:
+            f.seek(snapshot_end)
+            tail = f.read()
+        if tail and not tail.endswith(b"\n"):
+            tail += b"\n"
+        # 先写清单再改写活动日志：中途崩溃最多出现重复消息（回放时按 id 去重），不会丢失
+        save_manifest(log_path, new_segments)
+        _write_log(log_path, [], remaining + tail)
+
+    added = new_segments[len(segments):]
+    return {
+        "path": log_path,
+        "sealed_records": sealable,
+        "segments": len(added),
+        "raw_bytes": sum(segment["raw_size"] for segment in added),
+        "compressed_bytes": sum(segment["size"] for segment in added),
+        "active_bytes": len(remaining) + len(tail),
+    }
+
+
+def compact_chat_log(data_file_path: str) -> Dict[str, Any]:
+    """
+    压缩聊天日志：回放所有编辑/撤回补丁，写出只含当前消息的新快照
+
+    读取与回放在锁外进行，只有最后的替换步骤持有日志锁；压缩期间新追加的记录
+    会原样接在快照之后，不会丢失，追加方也不会被长时间阻塞。
+
+    Args:
+        data_file_path: 聊天记录文件路径
+
+    Returns:
+        Dict[str, Any]: 压缩报告（字节数、记录数、回放耗时），没有可压缩内容时返回None
+    """
+    log_path = get_log_path(data_file_path)
+    if not os.path.exists(log_path):
+        return None
+
+    lock = get_log_lock(log_path)
+    with lock:
+        # 锁内取得的长度一定位于行尾（追加在锁内一次写完）
+        snapshot_end = os.path.getsize(log_path)
+    with open(log_path, 'rb') as f:
+        raw = f.read(snapshot_end)
+
+    lines = raw.splitlines()
+    records_before = sum(1 for line in lines if line.strip())
+    patch_records = sum(1 for line in lines if line.startswith(_PATCH_PREFIX))
+    orphans = []
+    start = time.perf_counter()
+    messages = list(_replay(lines, sealed_count(load_manifest(log_path)), orphans).values())
+    replay_before = time.perf_counter() - start
+    # 针对已封存分段的补丁必须留在活动日志里，合并后放在快照开头
+    orphans = _fold_patches(orphans)
+    if patch_records == len(orphans) and records_before == len(messages) + len(orphans):
+        return None
+
+    snapshot = b"".join(_encode_lines(orphans + messages))
+    start = time.perf_counter()
+    _replay(snapshot.splitlines())
+    replay_after = time.perf_counter() - start
+
+    with lock:
+        with open(log_path, 'rb') as f:
+            f.seek(snapshot_end)
+            tail = f.read()
+        if tail and not tail.endswith(b"\n"):
+            tail += b"\n"
+        _write_log(log_path, [], snapshot + tail)
+        bytes_after = len(snapshot) + len(tail)
+
+    return {
+        "path": log_path,
+        "bytes_before": snapshot_end,
+        "bytes_after": bytes_after,
+        "bytes_reclaimed": snapshot_end + len(tail) - bytes_after,
+        "records_before": records_before,
+        "records_after": len(messages) + len(orphans),
+        "patch_records": patch_records,
+        "replay_ms_before": replay_before * 1000,
+        "replay_ms_after": replay_after * 1000,
+    }
+
+
 def load_chat_data(data_file_path: str = None) -> List[Dict[str, Any]]:
     """
-    从聊天记录文件加载数据
-    
+    加载完整聊天记录
+
     Args:
         data_file_path: 聊天记录文件路径
-        
+
     Returns:
         List[Dict[str, Any]]: 聊天记录列表
     """
     if data_file_path is None:
-        data_file_path = os.path.join(get_storage_path(), "data", "chat_data.json")
-    
-    try:
-        if not os.path.exists(data_file_path):
+        data_file_path = _default_data_file_path()
+
+    if _sqlite_store is not None:
+        try:
+            return _sqlite_store.load_messages(conversation_key(data_file_path))
+        except Exception as e:
+            print(f"加载聊天记录失败: {e}")
             return []
-            
-        with open(data_file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-            
-    except (json.JSONDecodeError, FileNotFoundError):
+
+    return load_chat_data_from_files(data_file_path)
+
+
+def load_chat_data_from_files(data_file_path: str) -> List[Dict[str, Any]]:
+    """
+    从聊天记录文件加载数据，兼容 JSONL 日志和旧版 JSON 数组两种格式
+
+    Args:
+        data_file_path: 聊天记录文件路径
+
+    Returns:
+        List[Dict[str, Any]]: 聊天记录列表
+    """
+    try:
+        log_path = get_log_path(data_file_path)
+        if os.path.exists(log_path):
+            return _read_log(log_path)
+
+        # 旧版 JSON 数组文件损坏时回退到 .bak，而不是静默返回空记录
+        legacy_path = _get_legacy_path(data_file_path)
+        chat_data = load_json_with_backup(legacy_path, [])
+        return _assign_ids(chat_data if isinstance(chat_data, list) else [chat_data], 0)
+
+    except FileNotFoundError:
         return []
     except Exception as e:
         print(f"加载聊天记录失败: {e}")
-        return []
\ No newline at end of file
+        return []
+
+
+def _read_log_range(log_path: str, index: ChatLogIndex, start: int, end: int, count: int,
+                    base: int = 0) -> List[Dict[str, Any]]:
+    """读取并回放活动日志中第 start 到 end（不含）条记录，之后的补丁也会应用到这些消息上"""
+    if end <= start:
+        return []
+    offsets = index.read_offsets(start, min(end + 1, count))
+    begin = offsets[0]
+    with open(log_path, 'rb') as f:
+        f.seek(begin)
+        if end < count:
+            raw = f.read(offsets[-1] - begin)
+            messages = _replay(raw.splitlines(), base + start)
+            # 补丁总在目标消息之后，只需扫描本页之后的补丁行
+            for patch in _scan_patches(f):
+                _apply_patch(messages, patch)
+        else:
+            messages = _replay(f.read().splitlines(), base + start)
+    return list(messages.values())
+
+
+def _read_range(log_path: str, index: ChatLogIndex, segments: List[Dict[str, Any]],
+                start: int, end: int, active_count: int) -> List[Dict[str, Any]]:
+    """读取第 start 到 end（不含）条记录，跨越已封存分段和活动日志"""
+    sealed = sealed_count(segments)
+    messages = {}
+    for segment in segments:
+        segment_start = segment["start"]
+        segment_end = segment_start + segment["count"]
+        if segment_end <= start or segment_start >= end:
+            continue
+        # 只有翻到已封存的部分时才解压
+        lines = read_segment(log_path, segment)
+        lo = max(start, segment_start) - segment_start
+        hi = min(end, segment_end) - segment_start
+        messages.update(_replay(lines[lo:hi], segment_start + lo))
+    if messages:
+        # 分段中只有消息，针对它们的补丁都在活动日志里
+        with open(log_path, 'rb') as f:
+            for patch in _scan_patches(f):
+                _apply_patch(messages, patch)
+
+    result = list(messages.values())
+    if end > sealed:
+        result.extend(_read_log_range(log_path, index, max(start - sealed, 0), end - sealed, active_count, sealed))
+    return result
+
+
+def load_chat_tail(data_file_path: str = None, limit: int = 50) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    只加载最近 limit 条聊天记录（借助偏移索引从文件末尾定位，耗时与历史长度无关）
+
+    Args:
+        data_file_path: 聊天记录文件路径
+        limit: 至少加载的可见消息数（补丁记录和已撤回的消息不计，历史不足时全部加载）
+
+    Returns:
+        Tuple[List[Dict[str, Any]], int]: (消息列表, 第一条消息在日志中的位置)
+    """
+    if data_file_path is None:
+        data_file_path = _default_data_file_path()
+
+    try:
+        if _sqlite_store is not None:
+            key = conversation_key(data_file_path)
+            return _read_visible(lambda start, end: _sqlite_store.load_range(key, start, end),
+                                 _sqlite_store.count_messages(key), limit)
+
+        migrate_json_to_jsonl(data_file_path)
+        log_path = get_log_path(data_file_path)
+        if not os.path.exists(log_path):
+            # 无法迁移的旧文件退化为整体加载
+            chat_data = load_chat_data(data_file_path)
+            start = max(len(chat_data) - limit, 0)
+            return chat_data[start:], start
+
+        index = ChatLogIndex(log_path)
+        segments = load_manifest(log_path)
+        active_count = index.count()
+        count = sealed_count(segments) + active_count
+        return _read_visible(lambda start, end: _read_range(log_path, index, segments, start, end, active_count),
+                             count, limit)
+
+    except Exception as e:
+        print(f"加载最近聊天记录失败: {e}")
+        return [], 0
+
+
+def load_chat_page(data_file_path: str, end_index: int, limit: int = 50) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    加载第 end_index 条之前的一页更早的聊天记录（用户向上滚动时按需加载）
+
+    Args:
+        data_file_path: 聊天记录文件路径
+        end_index: 已加载的最早一条消息的位置
+        limit: 本页至少加载的可见消息数（更早的历史不足时全部加载）
+
+    Returns:
+        Tuple[List[Dict[str, Any]], int]: (消息列表, 本页第一条消息在日志中的位置)
+    """
+    if end_index <= 0:
+        return [], 0
+
+    try:
+        if _sqlite_store is not None:
+            key = conversation_key(data_file_path)
+            return _read_visible(lambda start, end: _sqlite_store.load_range(key, start, end), end_index, limit)
+
+        log_path = get_log_path(data_file_path)
+        if not os.path.exists(log_path):
+            chat_data = load_chat_data(data_file_path)
+            start = max(end_index - limit, 0)
+            return chat_data[start:end_index], start
+
+        index = ChatLogIndex(log_path)
+        segments = load_manifest(log_path)
+        active_count = index.count()
+        end_index = min(end_index, sealed_count(segments) + active_count)
+        return _read_visible(lambda start, end: _read_range(log_path, index, segments, start, end, active_count),
+                             end_index, limit)
+
+    except Exception as e:
+        print(f"加载更早聊天记录失败: {e}")
+        return [], end_index
+
+
+def search_chat_data(data_file_path: str, keyword: str, limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    按关键字搜索聊天记录，从最新的消息往前找，找够 limit 条即停止（更早的分段不会被解压）
+
+    Args:
+        data_file_path: 聊天记录文件路径
+        keyword: 关键字
+        limit: 最多返回的消息条数
+
+    Returns:
+        List[Dict[str, Any]]: 匹配的消息，最新的在前
+    """
+    def matches(message):
+        return isinstance(message, dict) and keyword in str(message.get("content", ""))
+
+    try:
+        if _sqlite_store is not None:
+            return _sqlite_store.search_messages(conversation_key(data_file_path), keyword, limit)
+
+        log_path = get_log_path(data_file_path)
+        if not os.path.exists(log_path):
+            return [m for m in reversed(load_chat_data(data_file_path)) if matches(m)][:limit]
+
+        segments = load_manifest(log_path)
+        with open(log_path, 'rb') as f:
+            lines = f.read().splitlines()
+        results = [m for m in reversed(list(_replay(lines, sealed_count(segments)).values())) if matches(m)]
+        if len(results) >= limit or not segments:
+            return results[:limit]
+
+        patches = [json.loads(line) for line in lines if line.startswith(_PATCH_PREFIX)]
+        for segment in reversed(segments):
+            messages = _replay(read_segment(log_path, segment), segment["start"])
+            for patch in patches:
+                _apply_patch(messages, patch)
+            results.extend(m for m in reversed(list(messages.values())) if matches(m))
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    except Exception as e:
+        print(f"搜索聊天记录失败: {e}")
+        return []
+
+
+def delete_chat_data(data_file_path: str) -> None:
+    """
+    删除聊天记录的所有相关文件（JSONL 日志、旧版 JSON、迁移备份及对话摘要）
+
+    Args:
+        data_file_path: 聊天记录文件路径
+    """
+    from .conversation_summary import get_summary_path, get_conversation_summarizer
+
+    if _sqlite_store is not None:
+        _sqlite_store.delete_messages(conversation_key(data_file_path))
+
+    # 同名角色重新创建时不能沿用旧对话的摘要
+    summarizer = get_conversation_summarizer()
+    if summarizer is not None:
+        summarizer.forget(data_file_path)
+
+    legacy_path = _get_legacy_path(data_file_path)
+    log_path = get_log_path(data_file_path)
+    remove_segments(log_path)
+    for path in (log_path, get_index_path(log_path), legacy_path, legacy_path + BACKUP_SUFFIX,
+                 legacy_path + MIGRATED_SUFFIX, get_summary_path(data_file_path)):
+        if os.path.exists(path):
+            os.remove(path)
+            print(f"对话记录文件已删除: {path}")
+
+
+def _check_torn_append() -> None:
+    """自检：日志最后一行只写了一半时，之后追加的消息不会被吞掉"""
+    import tempfile
+
+    test_file = os.path.join(tempfile.mkdtemp(), "chat_history_test.jsonl")
+    append_messages_to_chat_data([build_message("a"), build_message("b")], test_file)
+    with open(test_file, 'ab') as f:
+        f.write('{"role": "user", "content": "torn'.encode('utf-8'))
+    append_messages_to_chat_data([build_message("c")], test_file)
+
+    contents = [m["content"] for m in load_chat_data(test_file)]
+    tail, _ = load_chat_tail(test_file, 10)
+    assert contents == ["a", "b", "c"], contents
+    assert [m["content"] for m in tail] == contents, tail
+    assert ChatLogIndex(test_file).count() == 4
+    print(f"半行后追加检查通过: {contents}")
+
+
+if __name__ == "__main__":
+    # 一次性迁移 data 目录下的旧版聊天记录
+    # 用法: python -m tool.data_saver [data目录]
+    #       python -m tool.data_saver --check  （追加写入自检）
+    import sys
+    if sys.argv[1:2] == ["--check"]:
+        _check_torn_append()
+        sys.exit(0)
+    target_dir = sys.argv[1] if len(sys.argv) > 1 else None
+    count = migrate_chat_data_folder(target_dir)
+    print(f"共迁移 {count} 个聊天记录文件")
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对冲请求模块
+偶发卡住的上游请求决定了尾延迟：请求发出后超过最近首字节延迟的某个百分位仍没有响应时，
+再发一个相同的请求（可以发往备用模型或备用 base_url），采用先返回的结果并取消另一个。
+额外请求数受预算限制，对冲次数和对冲请求胜出的次数计入统计。
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Optional, Callable, Dict, Any, Tuple, Hashable, Awaitable
+
+from tool.api_client import CancelToken
+
+# 触发对冲的首字节延迟百分位
+DEFAULT_PERCENTILE = 0.95
+# 对冲等待时间的下限和上限（秒）
+MIN_HEDGE_DELAY = 0.2
+MAX_HEDGE_DELAY = 10.0
+# 额外请求数占请求总数的最大比例
+DEFAULT_BUDGET = 0.1
+# 每类请求至少积累多少个延迟样本后才开始对冲
+MIN_SAMPLES = 10
+# 每类请求保留的最近延迟样本数
+LATENCY_SAMPLES = 200
+
+# 一次请求的尝试函数：(是否为对冲请求, 取消标记, 增量回调或None) -> 回复内容
+Attempt = Callable[[bool, CancelToken, Optional[Callable[[str], None]]], Optional[str]]
+
+
+def _ignore_delta(delta: str):
+    """非流式请求的增量回调：只用于决出胜负，增量本身不需要"""
+
+
+class _Race:
+    """一次请求中主请求与对冲请求的竞争状态：先收到首字节（或先完成）的一方胜出，另一方被取消并断开连接"""
+
+    def __init__(self, on_delta: Optional[Callable[[str], None]], cancel_token: Optional[CancelToken],
+                 notify: Callable[[], None]):
+        self._on_delta = on_delta
+        self._parent = cancel_token
+        self._notify = notify
+        self._lock = threading.Lock()
+        self._tokens = []
+        self._results: Dict[int, Tuple[Optional[str], Optional[Exception]]] = {}
+        self.winner: Optional[int] = None
+        self.first_byte_at: Optional[float] = None
+
+    def new_attempt(self) -> Tuple[int, CancelToken, Optional[Callable[[str], None]]]:
+        """登记一次尝试，返回 (序号, 取消标记, 增量回调)"""
+        token = CancelToken()
+        if self._parent:
+            self._parent.on_cancel(token.cancel)
+        with self._lock:
+            index = len(self._tokens)
+            self._tokens.append(token)
+            lost = self.winner is not None
+        if lost:
+            token.cancel()
+
+        on_delta = None
+        if self._on_delta:
+            def on_delta(delta: str):
+                # 只转发胜出一方的增量，失败方的增量直接丢弃
+                if self._claim(index):
+                    self._on_delta(delta)
+        return index, token, on_delta
+
+    def _claim(self, index: int) -> bool:
+        """尝试成为胜出方，返回该尝试是否为胜出方"""
+        with self._lock:
+            if self.winner is not None:
+                return self.winner == index
+            self.winner = index
+            self.first_byte_at = time.monotonic()
+            losers = [token for i, token in enumerate(self._tokens) if i != index]
+        for token in losers:
+            token.cancel()
+        self._notify()
+        return True
+
+    def finish(self, index: int, result: Optional[str], error: Optional[Exception]):
+        """记录一次尝试的结果（成功完成而还没有胜出方时直接胜出）"""
+        if error is None and result is not None:
+            self._claim(index)
+        with self._lock:
+            self._results[index] = (result, error)
+        self._notify()
+
+    @property
+    def started(self) -> bool:
+        """是否已有一方收到首字节或所有尝试都已结束"""
+        with self._lock:
+            return self.winner is not None or len(self._results) == len(self._tokens)
+
+    @property
+    def decided(self) -> bool:
+        """胜出方已完成，或所有尝试都已结束"""
+        with self._lock:
+            if self.winner is not None:
+                return self.winner in self._results
+            return len(self._results) == len(self._tokens)
+
+    def release(self):
+        """解除与外层取消标记的关联"""
+        if self._parent:
+            for token in self._tokens:
+                self._parent.discard(token.cancel)
+
+    def outcome(self) -> Optional[str]:
+        """返回胜出方的结果；没有胜出方时返回主请求的结果"""
+        self.release()
+        result, error = self._results[self.winner if self.winner is not None else 0]
+        if error is not None:
+            raise error
+        return result
+
+
+class HedgeStats:
+    """对冲统计（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_won = 0
+        self.budget_denied = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取统计快照
+
+        Returns:
+            Dict[str, Any]: requests 请求数、hedged 发出对冲请求的次数、hedge_won 对冲请求胜出次数、
+            budget_denied 因预算不足未对冲的次数、hedge_rate 对冲比例、win_rate 对冲请求的胜出比例
+        """
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_won': self.hedge_won,
+                'budget_denied': self.budget_denied,
+                'hedge_rate': self.hedged / self.requests if self.requests else 0.0,
+                'win_rate': self.hedge_won / self.hedged if self.hedged else 0.0,
+            }
+
+
+class HedgePolicy:
+    """对冲策略：等待时间取最近首字节延迟的百分位，额外请求数受预算限制"""
+
+    def __init__(self, percentile: float = DEFAULT_PERCENTILE, budget: float = DEFAULT_BUDGET,
+                 min_delay: float = MIN_HEDGE_DELAY, max_delay: float = MAX_HEDGE_DELAY,
+                 model: Optional[str] = None, base_url: Optional[str] = None):
+        """
+        初始化对冲策略
+
+        Args:
+            percentile: 触发对冲的首字节延迟百分位（0-1）
+            budget: 对冲请求数占请求总数的最大比例
+            min_delay: 对冲等待时间下限（秒）
+            max_delay: 对冲等待时间上限（秒）
+            model: 对冲请求使用的备用模型，None 表示与主请求相同
+            base_url: 对冲请求使用的备用 API 地址，None 表示与主请求相同
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.model = model
+        self.base_url = base_url
+        self.stats = HedgeStats()
+        self._latencies: Dict[Hashable, deque] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> Optional['HedgePolicy']:
+        """
+        根据配置（app.hedging）创建对冲策略
+
+        Returns:
+            HedgePolicy实例，未启用时返回None
+        """
+        if not config or not config.get("enabled"):
+            return None
+        return cls(percentile=config.get("percentile", DEFAULT_PERCENTILE),
+                   budget=config.get("budget", DEFAULT_BUDGET),
+                   model=config.get("model") or None,
+                   base_url=config.get("base_url") or None)
+
+    def target(self, model: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        """对冲请求使用的 (模型, base_url)"""
+        return self.model or model, self.base_url
+
+    def hedge_delay(self, key: Hashable) -> Optional[float]:
+        """
+        获取对冲等待时间
+
+        Args:
+            key: 请求类别（如 (模型, 是否流式)），不同类别的延迟分别统计
+
+        Returns:
+            等待秒数，样本不足时返回None（不对冲）
+        """
+        with self._lock:
+            samples = self._latencies.get(key)
+            if not samples or len(samples) < MIN_SAMPLES:
+                return None
+            ordered = sorted(samples)
+        delay = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def _record_latency(self, key: Hashable, latency: float):
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None:
+                samples = self._latencies[key] = deque(maxlen=LATENCY_SAMPLES)
+            samples.append(latency)
+
+    def _acquire_budget(self) -> bool:
+        """预算允许时占用一个对冲名额"""
+        with self.stats._lock:
+            if self.stats.hedged + 1 > self.budget * self.stats.requests:
+                self.stats.budget_denied += 1
+                return False
+            self.stats.hedged += 1
+            return True
+
+    def _start(self, key: Hashable) -> Optional[float]:
+        with self.stats._lock:
+            self.stats.requests += 1
+        return self.hedge_delay(key)
+
+    def _finish(self, race: _Race, key: Hashable, start: float):
+        # 记录用户实际等到的首字节延迟（对冲胜出时主请求的真实延迟只会更长）
+        if race.first_byte_at is not None:
+            self._record_latency(key, race.first_byte_at - start)
+        if race.winner == 1:
+            with self.stats._lock:
+                self.stats.hedge_won += 1
+            print("对冲请求先于主请求返回")
+
+    def call(self, attempt: Attempt, key: Hashable, on_delta: Optional[Callable[[str], None]] = None,
+             cancel_token: Optional[CancelToken] = None) -> Optional[str]:
+        """
+        发送请求，超过对冲等待时间仍未收到首字节时再发一个对冲请求（阻塞当前线程）
+
+        Args:
+            attempt: 发起一次尝试的函数
+            key: 请求类别
+            on_delta: 流式增量回调，None 表示非流式请求。非流式请求的尝试也会收到一个只用于
+                计时的增量回调，以流式接收：失败方在胜出方收到首字节时就被断开，而不是等胜出方生成完
+            cancel_token: 取消标记，取消时主请求和对冲请求都会被取消
+
+        Returns:
+            胜出方的回复内容
+
+        Raises:
+            胜出方（没有胜出方时为主请求）的异常
+        """
+        delay = self._start(key)
+        start = time.monotonic()
+        changed = threading.Condition()
+
+        def notify():
+            with changed:
+                changed.notify_all()
+
+        race = _Race(on_delta or _ignore_delta, cancel_token, notify)
+
+        def run(index: int, token: CancelToken, delta: Optional[Callable[[str], None]]):
+            try:
+                result, error = attempt(index == 1, token, delta), None
+            except Exception as e:
+                result, error = None, e
+            race.finish(index, result, error)
+
+        def launch():
+            threading.Thread(target=run, args=race.new_attempt(), daemon=True).start()
+
+        if delay is None:
+            # 样本不足，不对冲，直接在当前线程发送
+            run(*race.new_attempt())
+        else:
+            launch()
+            with changed:
+                first_byte = changed.wait_for(lambda: race.started, delay)
+            if not first_byte and self._acquire_budget():
+                print(f"{delay * 1000:.0f}ms 内未收到响应，发出对冲请求")
+                launch()
+            # 取消时不必等待还在阻塞读取的请求结束
+            if cancel_token:
+                cancel_token.on_cancel(notify)
+            try:
+                with changed:
+                    changed.wait_for(lambda: race.decided or (cancel_token and cancel_token.cancelled))
+            finally:
+                if cancel_token:
+                    cancel_token.discard(notify)
+            if not race.decided:
+                race.release()
+                return None
+        self._finish(race, key, start)
+        return race.outcome()
+
+    async def call_async(self, attempt: Callable[[bool, CancelToken, Optional[Callable[[str], None]]],
+                                                 Awaitable[Optional[str]]],
+                         key: Hashable, on_delta: Optional[Callable[[str], None]] = None,
+                         cancel_token: Optional[CancelToken] = None) -> Optional[str]:
+        """call 的协程版本（在事件循环中使用，attempt 为协程函数，on_delta 在事件循环线程中调用）"""
+        delay = self._start(key)
+        start = time.monotonic()
+        changed = asyncio.Event()
+        race = _Race(on_delta or _ignore_delta, cancel_token, changed.set)
+
+        async def run(index: int, token: CancelToken, delta: Optional[Callable[[str], None]]):
+            try:
+                result, error = await attempt(index == 1, token, delta), None
+            except Exception as e:
+                result, error = None, e
+            race.finish(index, result, error)
+
+        async def wait_until(predicate):
+            while not predicate():
+                await changed.wait()
+                changed.clear()
+
+        if delay is None:
+            await run(*race.new_attempt())
+        else:
+            asyncio.ensure_future(run(*race.new_attempt()))
+            try:
+                await asyncio.wait_for(wait_until(lambda: race.started), delay)
+            except asyncio.TimeoutError:
+                if self._acquire_budget():
+                    print(f"{delay * 1000:.0f}ms 内未收到响应，发出对冲请求")
+                    asyncio.ensure_future(run(*race.new_attempt()))
+            await wait_until(lambda: race.decided)
+        self._finish(race, key, start)
+        return race.outcome()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取对冲统计，字段见 HedgeStats.snapshot"""
+        return self.stats.snapshot()
+
+
+if __name__ == "__main__":
+    # 基准测试：5% 的请求卡住 1 秒，对比不对冲与对冲时的延迟分布和额外请求数
+    # 用法: python -m tool.hedging [请求数] [引擎 thread|asyncio]
+    import contextlib
+    import io
+    import sys
+    import tool.async_api_client as async_api_client
+    from tool.api_client import initialize_api_client
+    from tool.async_api_client import AsyncAPIClient, ENGINE_THREAD
+    from tool.mock_server import MockAPIServer
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    engine = sys.argv[2] if len(sys.argv) > 2 else ENGINE_THREAD
+    # 没有 Kivy 主循环，增量直接在后台线程回调
+    async_api_client._schedule_next_frame = lambda func: func(0)
+    server = MockAPIServer(latency=0.02, stall_rate=0.05, stall=1.0)
+    initialize_api_client("sk-mock", server.start(), "mock-model")
+    history = [{"role": "user", "content": "你好"}]
+
+    def percentile(samples, p):
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    print(f"模拟 5% 的请求卡住 1 秒，每种方式 {total} 个流式请求（{engine} 引擎）")
+    print(f"{'方式':<8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'实际请求':>10}{'对冲胜出':>10}")
+    for name, policy in (("不对冲", None), ("对冲", HedgePolicy())):
+        client = AsyncAPIClient(engine=engine)
+        client.set_hedging(policy)
+        client.start()
+        requests_before = server.requests
+        samples = []
+        # 屏蔽客户端的调试输出，避免终端打印影响计时
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(total):
+                start = time.perf_counter()
+                first = []
+                handle = client.send_message_async(
+                    "你好", history, lambda *args: None,
+                    on_delta=lambda delta: first or first.append(time.perf_counter()))
+                handle.wait()
+                samples.append(((first[0] if first else time.perf_counter()) - start) * 1000)
+        client.stop()
+        won = policy.get_stats()['hedge_won'] if policy else 0
+        print(f"{name:<8}{percentile(samples, 0.5):>10.1f}{percentile(samples, 0.95):>10.1f}"
+              f"{percentile(samples, 0.99):>10.1f}{server.requests - requests_before:>10}{won:>10}")
+    server.stop()
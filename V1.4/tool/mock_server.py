@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟API服务器模块
+提供一个兼容 OpenAI /chat/completions 接口的本地桩服务器，
+用于在没有网络和密钥的情况下测试、压测API客户端。
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Dict, Any, List
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    """模拟API请求处理器（HTTP/1.1，支持长连接）"""
+
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，关闭 Nagle 避免与客户端延迟确认叠加出约 40ms 的停顿
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        # 每个新连接只付一次"握手"开销，模拟 TCP+TLS 建连耗时
+        self.server.mock.on_connection()
+
+    def log_message(self, format, *args):
+        # 不输出访问日志
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端在响应前断开（取消请求）
+            self.close_connection = True
+
+    def do_HEAD(self):
+        self._send_json(200, {})
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+        else:
+            self._send_json(200, {})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+
+        mock = self.server.mock
+        mock.on_request()
+        if mock.latency:
+            time.sleep(mock.latency)
+        if mock.stall and random.random() < mock.stall_rate:
+            time.sleep(mock.stall)
+        if mock.status != 200 and mock.fails(request) and random.random() < mock.failure_rate:
+            headers = {'Retry-After': mock.retry_after} if mock.retry_after is not None else None
+            self._send_json(mock.status, {"error": {"message": f"mock status {mock.status}"}}, headers)
+            return
+
+        tokens = mock.reply_tokens(request)
+        if request.get("stream"):
+            self._send_stream(request, tokens)
+        else:
+            if mock.token_delay:
+                time.sleep(mock.token_delay * len(tokens))
+            self._send_json(200, mock.build_completion(request, "".join(tokens)))
+
+    def _send_stream(self, request: Dict[str, Any], tokens):
+        """以 SSE 分块逐个发送token"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write_chunk(data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        model = request.get("model", "mock-model")
+        try:
+            for i, token in enumerate(tokens):
+                if i and self.server.mock.token_delay:
+                    time.sleep(self.server.mock.token_delay)
+                event = {"object": "chat.completion.chunk", "model": model,
+                         "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+            write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开（取消请求或只读取了部分回复）
+            self.close_connection = True
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    """每个连接一个线程的模拟服务器，加大监听队列以承受并发压测"""
+
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class MockAPIServer:
+    """本地模拟API服务器"""
+
+    def __init__(self, latency: float = 0.0, handshake_delay: float = 0.0,
+                 status: int = 200, host: str = "127.0.0.1", port: int = 0,
+                 token_delay: float = 0.0, reply: Optional[str] = None,
+                 failure_rate: float = 1.0, retry_after: Optional[str] = None,
+                 failing_models: Optional[List[str]] = None,
+                 stall_rate: float = 0.0, stall: float = 0.0):
+        """
+        初始化模拟服务器
+
+        Args:
+            latency: 每个请求生成首个token前的模拟耗时（秒）
+            handshake_delay: 每个新连接的模拟握手耗时（秒）
+            status: 返回的HTTP状态码
+            host: 监听地址
+            port: 监听端口，0 表示自动分配
+            token_delay: 每个后续token的模拟生成耗时（秒）
+            reply: 固定的回复内容，None 表示回显最后一条用户消息
+            failure_rate: status 不是200时，每个请求返回该状态码的概率（其余请求正常回复）
+            retry_after: 错误响应附带的 Retry-After 响应头，None 表示不附带
+            failing_models: status 只对这些模型的请求生效，None 表示对所有模型生效
+            stall_rate: 请求偶发卡住的概率
+            stall: 卡住的请求额外等待的时间（秒）
+        """
+        self.latency = latency
+        self.handshake_delay = handshake_delay
+        self.status = status
+        self.token_delay = token_delay
+        self.reply = reply
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.failing_models = failing_models
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.connections = 0
+        self.requests = 0
+        self._host = host
+        self._port = port
+        self._server: Optional[_MockHTTPServer] = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        """服务器的API基础URL"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> str:
+        """
+        启动服务器
+
+        Returns:
+            str: API基础URL
+        """
+        if self._server is None:
+            self._server = _MockHTTPServer((self._host, self._port), _MockHandler)
+            self._server.mock = self
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        """停止服务器"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def on_connection(self):
+        """新连接建立时调用"""
+        with self._lock:
+            self.connections += 1
+        if self.handshake_delay:
+            time.sleep(self.handshake_delay)
+
+    def on_request(self):
+        """收到补全请求时调用"""
+        with self._lock:
+            self.requests += 1
+
+    def fails(self, request: Dict[str, Any]) -> bool:
+        """该请求的模型是否受 status 影响"""
+        return self.failing_models is None or request.get("model") in self.failing_models
+
+    def reply_tokens(self, request: Dict[str, Any]) -> List[str]:
+        """生成回复内容并按每2个字符切分为token"""
+        if self.reply is not None:
+            content = self.reply
+        else:
+            messages = request.get("messages") or [{}]
+            content = f"收到: {messages[-1].get('content', '')}"
+        return [content[i:i + 2] for i in range(0, len(content), 2)]
+
+    def build_completion(self, request: Dict[str, Any], content: str) -> Dict[str, Any]:
+        """构造非流式补全响应"""
+        return {
+            "id": f"mock-{self.requests}",
+            "object": "chat.completion",
+            "model": request.get("model", "mock-model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+
+if __name__ == "__main__":
+    # 基准测试
+    # 用法: python -m tool.mock_server pool [握手耗时ms] [轮数]   对比每轮新建连接与连接池长连接的单轮延迟
+    #       python -m tool.mock_server stream [轮数]              对比非流式与流式请求的首个token耗时
+    import contextlib
+    import io
+    import sys
+    import requests
+    from tool.api_client import APIClient
+
+    mode = sys.argv[1] if len(sys.argv) > 1 else "pool"
+    messages = [{"role": "user", "content": "你好"}]
+
+    def percentile(samples, p):
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def run(send, turns):
+        samples = []
+        # 屏蔽客户端的调试输出，避免终端打印影响计时
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(turns):
+                start = time.perf_counter()
+                samples.append(send(start))
+        return samples
+
+    def elapsed_ms(start):
+        return (time.perf_counter() - start) * 1000
+
+    def print_table(header, rows):
+        print(f"{header:<14}{'p50(ms)':>10}{'p95(ms)':>10}{'平均(ms)':>10}")
+        for name, samples in rows:
+            print(f"{name:<14}{percentile(samples, 0.5):>10.1f}"
+                  f"{percentile(samples, 0.95):>10.1f}{sum(samples) / len(samples):>10.1f}")
+
+    if mode == "stream":
+        turns = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        # 模拟首个token 300ms、之后每个token 20ms，回复共 200 个token
+        server = MockAPIServer(latency=0.3, token_delay=0.02, reply="流式输出测试。" * 57)
+        client = APIClient("sk-mock", server.start(), "mock-model")
+        client.warm_up()
+
+        def first_token(start):
+            next(iter(client.create_chat_completion_stream(messages)))
+            return elapsed_ms(start)
+
+        def full_stream(start):
+            "".join(client.create_chat_completion_stream(messages))
+            return elapsed_ms(start)
+
+        def non_stream(start):
+            # create_chat_completion 内部也使用流式请求，这里直接发送 stream=False 的请求作对比
+            client.session.post(f"{client.base_url}/chat/completions", headers=client.headers,
+                                json={"model": "mock-model", "messages": messages, "stream": False}, timeout=30)
+            return elapsed_ms(start)
+
+        rows = [
+            ("非流式", run(non_stream, turns)),
+            ("流式·首token", run(first_token, turns)),
+            ("流式·完整", run(full_stream, turns)),
+        ]
+        client.close()
+        server.stop()
+
+        print(f"模拟首token 300ms + 200 token × 20ms，每种方式 {turns} 轮（非流式需等待完整回复才能显示）")
+        print_table("首次可显示", rows)
+    else:
+        handshake_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 150
+        turns = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+        server = MockAPIServer(handshake_delay=handshake_ms / 1000)
+        base_url = server.start()
+
+        headers = {'Authorization': 'Bearer sk-mock', 'Content-Type': 'application/json'}
+        connections_before = server.connections
+        no_pool = run(lambda start: (requests.post(f"{base_url}/chat/completions", headers=headers,
+                                                   json={"model": "mock-model", "messages": messages},
+                                                   timeout=30), elapsed_ms(start))[1], turns)
+        no_pool_connections = server.connections - connections_before
+
+        client = APIClient("sk-mock", base_url, "mock-model")
+        start = time.perf_counter()
+        client.warm_up()
+        warm_up_ms = elapsed_ms(start)
+        connections_before = server.connections
+        pooled = run(lambda start: (client.create_chat_completion(messages), elapsed_ms(start))[1], turns)
+        pooled_connections = server.connections - connections_before
+        client.close()
+        server.stop()
+
+        print(f"模拟握手耗时 {handshake_ms:.0f}ms，每种方式 {turns} 轮；连接池预热耗时 {warm_up_ms:.1f}ms；"
+              f"新建连接数 requests.post={no_pool_connections} 连接池={pooled_connections}")
+        print_table("方式", [("requests.post", no_pool), ("连接池", pooled)])
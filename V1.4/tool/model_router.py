@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模型路由模块
+在 app.available_models 列出的可互换模型之间选择和切换：
+记录每个模型最近的延迟和错误率，优先使用用户选择的模型（或自动选择最健康的模型），
+遇到 5xx 或建立连接失败时切换到下一个模型；连续失败的模型熔断一段时间，冷却期间不再尝试。
+一次请求切换的所有模型共用重试策略的总时限，不会因为逐个尝试而成倍延长。
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Optional, Callable, Dict, Any, List, Awaitable, TypeVar
+
+from tool.retry_policy import get_retry_policy, request_deadline
+
+# 路由模式：优先用户选择的模型，失败时切换到其他模型
+ROUTING_PINNED = "pinned"
+# 路由模式：总是选择最近表现最好的健康模型
+ROUTING_AUTO = "auto"
+# 路由模式：只使用用户选择的模型，不切换
+ROUTING_OFF = "off"
+# 每个模型保留的最近请求样本数
+HEALTH_WINDOW = 20
+# 连续失败多少次后熔断
+FAILURE_THRESHOLD = 3
+# 熔断冷却时间（秒）
+COOLDOWN = 30.0
+# 一次请求最多尝试的模型数（含首选模型）
+MAX_MODELS_PER_REQUEST = 3
+
+T = TypeVar('T')
+
+
+def should_failover(error: Exception) -> bool:
+    """
+    判断错误是否说明模型本身不可用（值得换一个模型）
+
+    5xx 和建立连接失败切换模型；401、400 等客户端错误换模型也不会成功，直接返回给调用方。
+    """
+    if getattr(error, 'transient', False):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return status_code is not None and status_code >= 500
+
+
+class ModelHealth:
+    """单个模型的健康状态：最近请求的延迟、成败，以及熔断器状态"""
+
+    def __init__(self, window: int = HEALTH_WINDOW):
+        self._samples = deque(maxlen=window)
+        self.consecutive_failures = 0
+        # 熔断到期时间（time.monotonic），0 表示未熔断
+        self.open_until = 0.0
+        self.requests = 0
+
+    def record(self, latency: float, ok: bool):
+        self._samples.append((latency, ok))
+        self.requests += 1
+
+    @property
+    def error_rate(self) -> float:
+        if not self._samples:
+            return 0.0
+        return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+
+    @property
+    def latency(self) -> Optional[float]:
+        """最近成功请求的平均延迟（秒），没有样本时返回None"""
+        latencies = [latency for latency, ok in self._samples if ok]
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def latency_p95(self) -> Optional[float]:
+        latencies = sorted(latency for latency, ok in self._samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def state(self, now: float) -> str:
+        """熔断器状态: closed 正常、open 熔断中、half_open 冷却结束等待试探"""
+        if not self.open_until:
+            return "closed"
+        return "open" if now < self.open_until else "half_open"
+
+
+class ModelRouter:
+    """模型路由器（线程安全）"""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, cooldown: float = COOLDOWN,
+                 max_models: int = MAX_MODELS_PER_REQUEST):
+        """
+        初始化模型路由器
+
+        Args:
+            failure_threshold: 连续失败多少次后熔断
+            cooldown: 熔断冷却时间（秒）
+            max_models: 一次请求最多尝试的模型数
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_models = max(1, max_models)
+        self.mode = ROUTING_PINNED
+        self.failovers = 0
+        self._models: List[str] = []
+        self._health: Dict[str, ModelHealth] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, models: List[str], mode: str = ROUTING_PINNED):
+        """
+        设置可互换的模型列表和路由模式（启动时和修改设置后调用）
+
+        Args:
+            models: 可用模型列表（app.available_models）
+            mode: 路由模式，ROUTING_PINNED / ROUTING_AUTO / ROUTING_OFF
+        """
+        if mode not in (ROUTING_PINNED, ROUTING_AUTO, ROUTING_OFF):
+            print(f"未知的模型路由模式 {mode}，使用 {ROUTING_PINNED}")
+            mode = ROUTING_PINNED
+        with self._lock:
+            self._models = [model for model in dict.fromkeys(models or []) if model]
+            self.mode = mode
+
+    def _get_health(self, model: str) -> ModelHealth:
+        health = self._health.get(model)
+        if health is None:
+            health = self._health[model] = ModelHealth()
+        return health
+
+    def candidates(self, preferred: Optional[str] = None) -> List[str]:
+        """
+        按尝试顺序返回本次请求的候选模型
+
+        Args:
+            preferred: 用户选择的模型，None 表示没有偏好
+
+        Returns:
+            List[str]: 候选模型（熔断中的模型被跳过；全部熔断时仍返回一个模型，避免直接报错）。
+            没有配置模型列表时只包含 preferred（None 表示使用客户端默认模型）
+        """
+        with self._lock:
+            models = list(self._models)
+            if preferred and preferred not in models:
+                models.insert(0, preferred)
+            if not models or self.mode == ROUTING_OFF:
+                return [preferred]
+
+            now = time.monotonic()
+            order = {model: index for index, model in enumerate(models)}
+            healthy = [model for model in models if self._get_health(model).state(now) != "open"]
+            if not healthy:
+                # 全部熔断：首选模型优先，否则选最快结束冷却的模型
+                if preferred:
+                    return [preferred]
+                return [min(models, key=lambda model: self._health[model].open_until)]
+
+            def score(model):
+                health = self._health[model]
+                latency = health.latency
+                # 错误率按 10% 分档，避免一两次偶发失败就频繁换模型；没有样本的模型排在已知健康的模型之后
+                return (round(health.error_rate, 1), latency if latency is not None else float('inf'), order[model])
+
+            ranked = sorted(healthy, key=score)
+            if self.mode == ROUTING_PINNED and preferred in ranked:
+                ranked.remove(preferred)
+                ranked.insert(0, preferred)
+            return ranked[:self.max_models]
+
+    def record_success(self, model: Optional[str], latency: float):
+        """记录一次成功请求（延迟：非流式为完整回复耗时，流式为首个token耗时）"""
+        if not model:
+            return
+        with self._lock:
+            health = self._get_health(model)
+            health.record(latency, True)
+            health.consecutive_failures = 0
+            if health.open_until:
+                print(f"模型 {model} 已恢复")
+            health.open_until = 0.0
+
+    def record_failure(self, model: Optional[str], latency: float):
+        """记录一次失败请求，连续失败达到阈值（或冷却后的试探失败）时熔断"""
+        if not model:
+            return
+        with self._lock:
+            health = self._get_health(model)
+            health.record(latency, False)
+            health.consecutive_failures += 1
+            if health.open_until or health.consecutive_failures >= self.failure_threshold:
+                health.open_until = time.monotonic() + self.cooldown
+                print(f"模型 {model} 连续失败 {health.consecutive_failures} 次，暂停使用 {self.cooldown:.0f} 秒")
+
+    def _on_failover(self, model: Optional[str], error: Exception, latency: float, has_next: bool):
+        self.record_failure(model, latency)
+        if has_next:
+            with self._lock:
+                self.failovers += 1
+            print(f"模型 {model} 请求失败（{error}），切换到下一个模型")
+
+    def call(self, preferred: Optional[str], request: Callable[[Optional[str]], T]) -> T:
+        """
+        按候选顺序发送请求，模型不可用时切换到下一个模型
+
+        Args:
+            preferred: 用户选择的模型
+            request: 使用指定模型发送请求的函数
+
+        Returns:
+            第一个成功模型的返回值
+
+        Raises:
+            不值得换模型的错误，或最后一个模型的错误
+        """
+        models = self.candidates(preferred)
+        with request_deadline(get_retry_policy().deadline) as deadline:
+            for index, model in enumerate(models):
+                start = time.monotonic()
+                try:
+                    result = request(model)
+                except Exception as e:
+                    if not should_failover(e):
+                        raise
+                    has_next = index + 1 < len(models) and time.monotonic() < deadline
+                    self._on_failover(model, e, time.monotonic() - start, has_next)
+                    if not has_next:
+                        raise
+                    continue
+                self.record_success(model, time.monotonic() - start)
+                return result
+
+    async def call_async(self, preferred: Optional[str], request: Callable[[Optional[str]], Awaitable[T]]) -> T:
+        """call 的协程版本（在事件循环中使用）"""
+        models = self.candidates(preferred)
+        with request_deadline(get_retry_policy().deadline) as deadline:
+            for index, model in enumerate(models):
+                start = time.monotonic()
+                try:
+                    result = await request(model)
+                except Exception as e:
+                    if not should_failover(e):
+                        raise
+                    has_next = index + 1 < len(models) and time.monotonic() < deadline
+                    self._on_failover(model, e, time.monotonic() - start, has_next)
+                    if not has_next:
+                        raise
+                    continue
+                self.record_success(model, time.monotonic() - start)
+                return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取路由统计
+
+        Returns:
+            Dict[str, Any]: mode 路由模式、failovers 切换模型次数，
+            models 为每个模型的 requests/error_rate/latency_ms_avg/latency_ms_p95/state
+        """
+        with self._lock:
+            now = time.monotonic()
+            models = {}
+            for model, health in self._health.items():
+                latency = health.latency
+                latency_p95 = health.latency_p95()
+                models[model] = {
+                    'requests': health.requests,
+                    'error_rate': health.error_rate,
+                    'latency_ms_avg': latency * 1000 if latency is not None else None,
+                    'latency_ms_p95': latency_p95 * 1000 if latency_p95 is not None else None,
+                    'state': health.state(now),
+                }
+            return {'mode': self.mode, 'failovers': self.failovers, 'models': models}
+
+
+# 全局模型路由器实例
+_model_router: Optional[ModelRouter] = None
+
+
+def get_model_router() -> ModelRouter:
+    """获取全局模型路由器实例"""
+    global _model_router
+    if _model_router is None:
+        _model_router = ModelRouter()
+    return _model_router
+
+
+if __name__ == "__main__":
+    # 演示：首选模型持续返回 503 时，对比不切换与自动切换的成功率，以及熔断后跳过故障模型的效果
+    # 用法: python -m tool.model_router [请求数]
+    import contextlib
+    import io
+    import sys
+    from tool.api_client import initialize_api_client, send_message_to_ai
+    from tool.mock_server import MockAPIServer
+    from tool.retry_policy import get_retry_policy
+    # 以脚本运行时本文件是 __main__，需要使用 api_client 实际引用的路由器实例
+    from tool.model_router import get_model_router
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    server = MockAPIServer(status=503, failing_models=["model-a"], latency=0.01)
+    initialize_api_client("sk-mock", server.start(), "model-a")
+    # 演示路由本身，关闭单个模型内的重试
+    get_retry_policy().max_attempts = 1
+    history = [{"role": "user", "content": "你好"}]
+
+    router = get_model_router()
+    print(f"model-a 持续返回 503，每种模式 {total} 个请求")
+    for mode in (ROUTING_OFF, ROUTING_PINNED):
+        router.configure(["model-a", "model-b", "model-c"], mode)
+        requests_before = server.requests
+        ok = 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(total):
+                ok += send_message_to_ai("你好", history, model="model-a") is not None
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{mode:<8} 成功 {ok}/{total}  实际请求 {server.requests - requests_before}  "
+              f"平均耗时 {elapsed / total:.1f}ms  model-a 状态: {router.get_stats()['models']['model-a']['state']}")
+    server.stop()
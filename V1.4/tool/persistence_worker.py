@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天记录持久化模块
+使用后台线程写盘（write-behind），避免磁盘延迟阻塞 Kivy 主线程
+"""
+
+import threading
+import queue
+import time
+from typing import Optional, List, Dict, Any
+import traceback
+
+from tool.data_saver import (
+    build_message,
+    build_edit_record,
+    build_delete_record,
+    append_messages_to_chat_data
+)
+
+# 写入失败后等待多久重试（秒）
+RETRY_DELAY = 5.0
+
+
+class PersistenceWorker:
+    """聊天记录持久化工作线程，合并突发写入，每批每个文件只 fsync 一次"""
+
+    def __init__(self, fsync: bool = True):
+        """
+        初始化持久化工作线程
+
+        Args:
+            fsync: 每批写入后是否强制落盘
+        """
+        self._thread = None
+        self._queue = queue.Queue()
+        self._running = False
+        self._fsync = fsync
+        # 已提交但尚未写入的记录（按文件、按提交顺序），读取聊天记录时合并，不必等待写盘
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}
+        self._pending_lock = threading.Lock()
+        # 写入失败、等待重试的记录（只在工作线程中访问）
+        self._retry: Dict[str, List[Dict[str, Any]]] = {}
+        self._retry_at = 0.0
+
+    def start(self):
+        """启动持久化线程"""
+        if not self._running:
+            self._running = True
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        """写完所有待保存的数据后停止持久化线程"""
+        if self._running:
+            if not self.flush(timeout):
+                print("停止持久化线程时仍有聊天记录未能写入")
+            self._running = False
+            # 发送停止信号
+            self._queue.put(None)
+            if self._thread:
+                self._thread.join(timeout=timeout)
+
+    def append_message(self, data_file_path: str, message_content: str, role: str = "user") -> Dict[str, Any]:
+        """
+        追加一条消息（立即返回，由后台线程写盘）
+
+        Args:
+            data_file_path: 聊天记录文件路径
+            message_content: 消息内容
+            role: 消息角色
+
+        Returns:
+            Dict[str, Any]: 将要写入的消息记录
+        """
+        message = build_message(message_content, role)
+        self._append(data_file_path, message)
+        return message
+
+    def update_message(self, data_file_path: str, message_id: int, message_content: str):
+        """
+        修改一条消息（追加编辑补丁，与其他追加一起合并写入）
+
+        Args:
+            data_file_path: 聊天记录文件路径
+            message_id: 消息 id
+            message_content: 新内容
+        """
+        self._append(data_file_path, build_edit_record(message_id, message_content))
+
+    def delete_messages(self, data_file_path: str, message_ids: List[int]):
+        """
+        撤回消息（追加撤回补丁，与其他追加一起合并写入）
+
+        Args:
+            data_file_path: 聊天记录文件路径
+            message_ids: 要撤回的消息 id 列表
+        """
+        for message_id in message_ids:
+            self._append(data_file_path, build_delete_record(message_id))
+
+    def _append(self, data_file_path: str, record: Dict[str, Any]):
+        """登记并提交一条追加记录"""
+        with self._pending_lock:
+            self._pending.setdefault(data_file_path, []).append(record)
+        self._queue.put({'type': 'append', 'path': data_file_path, 'message': record})
+
+    def pending_records(self, data_file_path: str) -> List[Dict[str, Any]]:
+        """
+        返回该文件已提交但尚未写入的记录（消息和补丁，按提交顺序）
+
+        读取聊天记录前先取出这些记录，读取后用 merge_pending_records 合并，
+        读取期间写入完成的记录按 id 去重，不会丢失也不会重复。
+        """
+        with self._pending_lock:
+            return list(self._pending.get(data_file_path, ()))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待此前提交的所有写入完成并落盘
+
+        Args:
+            timeout: 最长等待秒数，None 表示一直等待
+
+        Returns:
+            bool: 在超时前全部写入成功返回True；超时或有记录写入失败（仍在等待重试）返回False
+        """
+        if not self._running:
+            return True
+        barrier = {'type': 'barrier', 'event': threading.Event(), 'ok': False}
+        self._queue.put(barrier)
+        if not barrier['event'].wait(timeout):
+            return False
+        if not barrier['ok']:
+            print("部分聊天记录写入失败，将在后台重试")
+        return barrier['ok']
+
+    def pending_count(self) -> int:
+        """返回队列中尚未处理的任务数量（近似值）"""
+        return self._queue.qsize()
+
+    def _worker(self):
+        """后台工作线程"""
+        while self._running:
+            try:
+                task = self._queue.get(timeout=1)
+            except queue.Empty:
+                if self._retry and time.monotonic() >= self._retry_at:
+                    self._run_batch([])
+                continue
+
+            if task is None:
+                break
+
+            # 取出当前积压的所有任务，合并为一批处理
+            batch = [task]
+            stop_requested = False
+            while True:
+                try:
+                    extra = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if extra is None:
+                    stop_requested = True
+                    break
+                batch.append(extra)
+
+            self._run_batch(batch)
+
+            if stop_requested:
+                break
+
+    def _run_batch(self, batch: List[Dict[str, Any]]):
+        try:
+            self._process_batch(batch)
+        except Exception as e:
+            print(f"持久化线程错误: {e}")
+            traceback.print_exc()
+
+    def _process_batch(self, batch: List[Dict[str, Any]]):
+        """按提交顺序处理一批任务，同一文件的连续追加合并为一次写入；写入失败的记录留到下一批最先重试"""
+        # 上次写入失败的记录排在本批同一文件的记录之前，保持提交顺序
+        pending_appends = self._retry
+        self._retry = {}
+
+        def flush_appends(path):
+            messages = pending_appends.pop(path, None)
+            if not messages:
+                return
+            try:
+                ok = append_messages_to_chat_data(messages, path, fsync=self._fsync)
+            except Exception as e:
+                print(f"写入聊天记录失败: {e}")
+                ok = False
+            if not ok:
+                self._retry[path] = messages
+                self._retry_at = time.monotonic() + RETRY_DELAY
+                print(f"{len(messages)} 条记录写入失败，{RETRY_DELAY:.0f} 秒后重试: {path}")
+                return
+            # 同一文件的记录按提交顺序写入，写完的正好是最早登记的这几条
+            with self._pending_lock:
+                remaining = self._pending.get(path, [])[len(messages):]
+                if remaining:
+                    self._pending[path] = remaining
+                else:
+                    self._pending.pop(path, None)
+
+        try:
+            for task in batch:
+                task_type = task['type']
+                if task_type == 'append':
+                    if task['path'] in self._retry:
+                        # 该文件之前的记录写入失败：之后的记录一起等待重试，不能越过它们先写
+                        self._retry[task['path']].append(task['message'])
+                    else:
+                        pending_appends.setdefault(task['path'], []).append(task['message'])
+                elif task_type == 'barrier':
+                    for path in list(pending_appends):
+                        flush_appends(path)
+                    task['ok'] = not self._retry
+                    task['event'].set()
+                else:
+                    print(f"未知持久化任务类型: {task_type}")
+
+            for path in list(pending_appends):
+                flush_appends(path)
+        finally:
+            # 意外出错时，尚未处理的记录也留待重试，并唤醒所有等待中的 flush()
+            for path, messages in pending_appends.items():
+                self._retry[path] = messages + self._retry.get(path, [])
+            for task in batch:
+                if task['type'] == 'barrier' and not task['event'].is_set():
+                    task['ok'] = False
+                    task['event'].set()
+
+
+# 全局持久化线程实例
+_persistence_worker = None
+
+
+def get_persistence_worker() -> PersistenceWorker:
+    """获取全局持久化线程实例"""
+    global _persistence_worker
+
+    if _persistence_worker is None:
+        _persistence_worker = PersistenceWorker()
+        _persistence_worker.start()
+
+    return _persistence_worker
+
+
+def stop_persistence_worker():
+    """写完待保存数据并停止全局持久化线程"""
+    global _persistence_worker
+
+    if _persistence_worker:
+        _persistence_worker.stop()
+        _persistence_worker = None
+
+
+if __name__ == "__main__":
+    # 测试持久化线程：突发写入后用 flush() 确认已落盘
+    import os
+    import tempfile
+    from tool.data_saver import load_chat_data
+
+    test_file = os.path.join(tempfile.mkdtemp(), "chat_history_test.json")
+    worker = get_persistence_worker()
+
+    for i in range(100):
+        worker.append_message(test_file, f"消息 {i}", "user" if i % 2 == 0 else "assistant")
+    worker.flush()
+    print(f"flush 后记录数: {len(load_chat_data(test_file))}")
+
+    stop_persistence_worker()
@@ -8,8 +8,18 @@ from kivy import platform
 def is_android():
     return platform == "android"
 
+# 存储路径在进程内不会变化，只计算一次
+_storage_path = None
+
 def get_storage_path():
-    """返回安卓外部存储根目录，桌面返回项目根目录"""
+    """返回安卓外部存储根目录，桌面返回项目根目录（首次调用后缓存）"""
+    global _storage_path
+    if _storage_path is None:
+        _storage_path = _compute_storage_path()
+    return _storage_path
+
+def _compute_storage_path():
+    """计算存储路径"""
     if is_android():
         # 安卓10+使用应用私有目录，避免存储权限问题
         try:
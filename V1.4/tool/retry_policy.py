@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+API请求重试策略模块
+对限流、服务暂时不可用和建立连接失败等临时错误按指数退避自动重试：
+退避时间加随机抖动，优先遵守服务器返回的 Retry-After，所有尝试共用一个总时限。
+聊天请求不是幂等的（重发会再生成、再计费一次），请求发出后的超时和断线、以及 500/502/504
+都可能是服务器已经在生成，因此不重试。
+重试次数、成功率和端到端延迟计入统计，便于衡量实际成功率和尾延迟。
+"""
+
+import asyncio
+import contextlib
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional, Callable, Dict, Any, Awaitable
+
+# 服务器明确没有处理请求，重试是安全的（如 429 限流、503 "无可用渠道"）
+RETRYABLE_STATUS = frozenset({408, 425, 429, 503})
+# 默认最多尝试次数（含第一次）
+DEFAULT_MAX_ATTEMPTS = 3
+# 退避基准时间（秒），第 n 次重试的退避上限为 base * 2^(n-1)
+DEFAULT_BASE_DELAY = 0.5
+# 单次退避的最长时间（秒）
+DEFAULT_MAX_DELAY = 8.0
+# 所有尝试（含退避等待）的总时限（秒）
+DEFAULT_DEADLINE = 60.0
+# 延迟统计保留的最近样本数
+LATENCY_SAMPLES = 200
+
+# 当前请求的截止时间（time.monotonic），由 request_deadline 设置，切换模型后的重试也不会超过它
+_request_deadline: ContextVar[Optional[float]] = ContextVar('request_deadline', default=None)
+
+
+@contextlib.contextmanager
+def request_deadline(seconds: float):
+    """
+    在此范围内的所有尝试（包括切换到其他模型后的重试）共用一个总时限
+
+    已经处在更早的截止时间内时沿用原来的截止时间。
+
+    Yields:
+        float: 截止时间（time.monotonic）
+    """
+    deadline = time.monotonic() + seconds
+    current = _request_deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _request_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _request_deadline.reset(token)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析 Retry-After 响应头
+
+    Args:
+        value: 响应头的值，秒数或HTTP日期
+
+    Returns:
+        需要等待的秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    判断错误是否值得重试
+
+    只看 APIError 的 status_code 和 transient 属性：可重试的状态码，或请求发出前建立连接失败。
+    请求发出后的超时、断线以及流式响应输出后中断的错误不带这两个标记，不会重试。
+    """
+    if getattr(error, 'transient', False):
+        return True
+    return getattr(error, 'status_code', None) in RETRYABLE_STATUS
+
+
+class RetryStats:
+    """重试统计（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.requests = 0
+        self.attempts = 0
+        self.retries = 0
+        self.succeeded = 0
+        self.first_try_succeeded = 0
+        self.failed = 0
+        self.deadline_exceeded = 0
+
+    def record(self, attempts: int, succeeded: bool, latency: float, deadline_exceeded: bool = False):
+        """记录一个请求（含所有重试）的结果"""
+        with self._lock:
+            self.requests += 1
+            self.attempts += attempts
+            self.retries += attempts - 1
+            if succeeded:
+                self.succeeded += 1
+                if attempts == 1:
+                    self.first_try_succeeded += 1
+            else:
+                self.failed += 1
+            if deadline_exceeded:
+                self.deadline_exceeded += 1
+            self._latencies.append(latency * 1000)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取统计快照
+
+        Returns:
+            Dict[str, Any]: requests 请求数、attempts 总尝试次数、retries 重试次数、
+            success_rate 最终成功率、first_try_success_rate 首次即成功率、deadline_exceeded 超出总时限次数，
+            以及最近请求（含重试）的端到端延迟 latency_ms_p50/latency_ms_p95/latency_ms_max
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            finished = self.succeeded + self.failed
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+            return {
+                'requests': self.requests,
+                'attempts': self.attempts,
+                'retries': self.retries,
+                'success_rate': self.succeeded / finished if finished else 1.0,
+                'first_try_success_rate': self.first_try_succeeded / finished if finished else 1.0,
+                'deadline_exceeded': self.deadline_exceeded,
+                'latency_ms_p50': percentile(0.5),
+                'latency_ms_p95': percentile(0.95),
+                'latency_ms_max': latencies[-1] if latencies else 0.0,
+            }
+
+
+class RetryPolicy:
+    """指数退避 + 随机抖动的重试策略"""
+
+    def __init__(self, max_attempts: int = DEFAULT_MAX_ATTEMPTS, base_delay: float = DEFAULT_BASE_DELAY,
+                 max_delay: float = DEFAULT_MAX_DELAY, deadline: float = DEFAULT_DEADLINE):
+        """
+        初始化重试策略
+
+        Args:
+            max_attempts: 最多尝试次数（含第一次），1 表示不重试
+            base_delay: 退避基准时间（秒）
+            max_delay: 单次退避的最长时间（秒）
+            deadline: 所有尝试的总时限（秒）
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.stats = RetryStats()
+
+    def backoff(self, retry: int) -> float:
+        """第 retry 次重试前的退避时间：在 [0, min(max_delay, base*2^(retry-1))] 内均匀随机（full jitter）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (retry - 1))))
+
+    def _end_time(self, start: float) -> float:
+        """本次调用的截止时间：自身总时限与外层请求截止时间（见 request_deadline）中较早的一个"""
+        end = start + self.deadline
+        shared = _request_deadline.get()
+        return end if shared is None else min(end, shared)
+
+    def _next_delay(self, error: Exception, attempt: int, remaining: float) -> Optional[float]:
+        """计算下一次重试前的等待时间，不应重试时返回None"""
+        if attempt >= self.max_attempts or not is_retryable(error):
+            return None
+        retry_after = getattr(error, 'retry_after', None)
+        delay = retry_after if retry_after is not None else self.backoff(attempt)
+        # 等待之后已经没有时间再发一次请求，直接放弃
+        if delay >= remaining:
+            return None
+        return delay
+
+    def call(self, attempt_func: Callable[[float], Any], cancel_token=None) -> Any:
+        """
+        执行请求，失败时按策略重试（阻塞当前线程）
+
+        Args:
+            attempt_func: 发起一次请求的函数，参数为本次尝试可用的剩余时间（秒）
+            cancel_token: 取消标记，退避等待中被取消时立即返回None
+
+        Returns:
+            attempt_func 的返回值，退避等待中被取消时返回None
+
+        Raises:
+            最后一次尝试的异常
+        """
+        start = time.monotonic()
+        end = self._end_time(start)
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = end - time.monotonic()
+            try:
+                result = attempt_func(remaining)
+            except Exception as e:
+                remaining = end - time.monotonic()
+                if cancel_token and cancel_token.cancelled:
+                    self.stats.record(attempt, False, time.monotonic() - start)
+                    raise
+                delay = self._next_delay(e, attempt, remaining)
+                if delay is None:
+                    self.stats.record(attempt, False, time.monotonic() - start,
+                                      deadline_exceeded=is_retryable(e) and attempt < self.max_attempts)
+                    raise
+                print(f"API请求失败，{delay:.1f}秒后进行第{attempt}次重试: {e}")
+                if not self._sleep(delay, cancel_token):
+                    self.stats.record(attempt, False, time.monotonic() - start)
+                    return None
+                continue
+            self.stats.record(attempt, True, time.monotonic() - start)
+            return result
+
+    async def call_async(self, attempt_func: Callable[[float], Awaitable[Any]]) -> Any:
+        """
+        在事件循环中执行请求，失败时按策略重试（取消由外层任务的 cancel 负责）
+
+        Args:
+            attempt_func: 发起一次请求的协程函数，参数为本次尝试可用的剩余时间（秒）
+
+        Returns:
+            attempt_func 的返回值
+
+        Raises:
+            最后一次尝试的异常
+        """
+        start = time.monotonic()
+        end = self._end_time(start)
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = end - time.monotonic()
+            try:
+                result = await attempt_func(remaining)
+            except asyncio.CancelledError:
+                self.stats.record(attempt, False, time.monotonic() - start)
+                raise
+            except Exception as e:
+                remaining = end - time.monotonic()
+                delay = self._next_delay(e, attempt, remaining)
+                if delay is None:
+                    self.stats.record(attempt, False, time.monotonic() - start,
+                                      deadline_exceeded=is_retryable(e) and attempt < self.max_attempts)
+                    raise
+                print(f"API请求失败，{delay:.1f}秒后进行第{attempt}次重试: {e}")
+                await asyncio.sleep(delay)
+                continue
+            self.stats.record(attempt, True, time.monotonic() - start)
+            return result
+
+    @staticmethod
+    def _sleep(delay: float, cancel_token=None) -> bool:
+        """退避等待，被取消时提前结束。返回是否等满（未被取消）"""
+        if cancel_token is None:
+            time.sleep(delay)
+            return True
+        woken = threading.Event()
+        cancel_token.on_cancel(woken.set)
+        try:
+            woken.wait(delay)
+        finally:
+            cancel_token.discard(woken.set)
+        return not cancel_token.cancelled
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取重试统计，字段见 RetryStats.snapshot"""
+        return self.stats.snapshot()
+
+
+# 全局重试策略实例
+_retry_policy: Optional[RetryPolicy] = None
+
+
+def get_retry_policy() -> RetryPolicy:
+    """获取全局重试策略实例（所有API客户端共用，统计也汇总在一起）"""
+    global _retry_policy
+    if _retry_policy is None:
+        _retry_policy = RetryPolicy()
+    return _retry_policy
+
+
+if __name__ == "__main__":
+    # 基准测试：服务端随机返回 503，对比不重试与按策略重试的实际成功率和延迟
+    # 用法: python -m tool.retry_policy [503概率] [请求数]
+    import contextlib
+    import io
+    import sys
+    from tool.api_client import APIClient
+    from tool.mock_server import MockAPIServer
+
+    failure_rate = float(sys.argv[1]) if len(sys.argv) > 1 else 0.3
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    messages = [{"role": "user", "content": "你好"}]
+
+    server = MockAPIServer(status=503, failure_rate=failure_rate, latency=0.01)
+    base_url = server.start()
+    rows = []
+    for name, policy in (("不重试", RetryPolicy(max_attempts=1)),
+                         ("重试3次", RetryPolicy(base_delay=0.05)),
+                         ("Retry-After", RetryPolicy())):
+        server.retry_after = "0.05" if name == "Retry-After" else None
+        client = APIClient("sk-mock", base_url, "mock-model", retry_policy=policy)
+        # 屏蔽客户端的调试输出，避免终端打印影响计时
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(total):
+                client.create_chat_completion(messages)
+        client.close()
+        rows.append((name, policy.get_stats()))
+    server.stop()
+
+    print(f"模拟 {failure_rate:.0%} 的请求返回 503，每种策略 {total} 个请求")
+    print(f"{'策略':<12}{'成功率':>8}{'首次成功率':>10}{'重试次数':>8}{'p50(ms)':>10}{'p95(ms)':>10}")
+    for name, stats in rows:
+        print(f"{name:<12}{stats['success_rate']:>8.0%}{stats['first_try_success_rate']:>10.0%}"
+              f"{stats['retries']:>8}{stats['latency_ms_p50']:>10.1f}{stats['latency_ms_p95']:>10.1f}")
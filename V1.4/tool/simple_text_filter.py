@@ -2,6 +2,56 @@ import re
 import unicodedata
 
 
+# 预编译的正则表达式（每次调用不再查找模式缓存）
+_THINK_RE = re.compile(r'<think>[\s\S]*?</think>\s*', flags=re.IGNORECASE | re.DOTALL)
+# markdown 标记按原有顺序逐个替换（前面的替换会影响后面的匹配，只合并互不影响的规则）。
+# 每条规则附带匹配时必然出现的子串（任一），文本中都没有时跳过整次扫描（用 in 判断，远快于正则扫描）
+# 以字面量开头的模式可以被正则引擎快速定位，因此行首规则尽量写成“先匹配字面量、再用后顾断言检查它位于行首”，
+# 重复次数写成 ---+ 而不是 -{3,}；这些写法与原来的 ^ / {n,} 写法匹配结果完全相同
+_MARKDOWN_INLINE_RULES = [
+    (('#',), re.compile(r'#(?<=(?<![^\n])#)#{0,5}\s*'), ''),
+    (('**',), re.compile(r'\*\*(.*?)\*\*'), r'\1'),
+    (('*',), re.compile(r'\*(.*?)\*'), r'\1'),
+    (('__',), re.compile(r'__(.*?)__'), r'\1'),
+    (('_',), re.compile(r'_(.*?)_'), r'\1'),
+    (('```',), re.compile(r'```[\s\S]*?```'), ''),
+    (('`',), re.compile(r'`(.*?)`'), r'\1'),
+    (('](',), re.compile(r'\[([^\]]+)\]\([^\)]+\)'), r'\1'),
+    (('](',), re.compile(r'!\[[^\]]*\]\([^\)]+\)'), ''),
+]
+# 表格竖线之后执行
+_MARKDOWN_BLOCK_RULES = [
+    (('---',), re.compile(r'---+'), ''),
+    (('-', '*', '+'), re.compile(r'^\s*[-*+]\s*', flags=re.MULTILINE), ''),
+    (('.',), re.compile(r'^\s*\d+\.\s*', flags=re.MULTILINE), ''),
+    (('>',), re.compile(r'>(?<=(?<![^\n])>)\s*'), ''),
+    # 三种分隔线各自只匹配整行，删除一行不会让其他行变得可以匹配，合并为一次扫描
+    (('---', '***', '___'), re.compile(r'^(?:---+|\*\*\*+|___+)$', flags=re.MULTILINE), ''),
+    (('\n\n\n',), re.compile(r'\n\n\n+'), '\n\n'),
+]
+# 连续空白合并为一个空格（单个空格替换后不变，不必匹配）
+_SPACES_RE = re.compile(r'[ \t](?:[ \t]+|(?<=\t))')
+_BLANK_LINES_RE = re.compile(r'\n\s*\n')
+# 无论类别如何都保留的空白字符
+_KEPT_WHITESPACE = ("\n", "\r", "\t", " ")
+
+
+class _DeletionTable(dict):
+    """
+    str.translate 使用的删除表：键为码位，值为码位本身（保留）或 None（删除）。
+    某个字符第一次出现时才判断并记住结果，表的大小只与实际出现过的不同字符数有关。
+    """
+
+    def __init__(self, keep):
+        super().__init__()
+        self._keep = keep
+
+    def __missing__(self, code):
+        value = code if self._keep(chr(code)) else None
+        self[code] = value
+        return value
+
+
 class SimpleTextFilter:
     """简化文本过滤器类"""
     
@@ -42,6 +92,9 @@ class SimpleTextFilter:
     # 若要保留特定 emoji 字符，添加到此列表（如 '😀', '❤' 等）
     EMOJI_WHITELIST = []
     
+    # (配置签名, strict) -> remove_emoji 使用的删除表；范围、白名单或开关变化后使用新表
+    _deletion_tables = {}
+    
     @staticmethod
     def remove_think_tags(text):
         """移除 <think>...</think> 标签块（用于移除 AI 内部思考过程）"""
@@ -49,7 +102,7 @@ class SimpleTextFilter:
             return text
         
         # 移除 <think>...</think> 标签及其内容（支持换行和任意内容）
-        text = re.sub(r'<think>[\s\S]*?</think>\s*', '', text, flags=re.IGNORECASE | re.DOTALL)
+        text = _THINK_RE.sub('', text)
         text = text.strip()
         return text
     
@@ -59,24 +112,13 @@ class SimpleTextFilter:
         if not text:
             return text
             
-        text = re.sub(r'^#{1,6}\s*', '', text, flags=re.MULTILINE)
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-        text = re.sub(r'\*(.*?)\*', r'\1', text)
-        text = re.sub(r'__(.*?)__', r'\1', text)
-        text = re.sub(r'_(.*?)_', r'\1', text)
-        text = re.sub(r'```[\s\S]*?```', '', text)
-        text = re.sub(r'`(.*?)`', r'\1', text)
-        text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
-        text = re.sub(r'!\[[^\]]*\]\([^\)]+\)', '', text)
-        text = re.sub(r'\|', '', text)
-        text = re.sub(r'-{3,}', '', text)
-        text = re.sub(r'^\s*[-*+]\s*', '', text, flags=re.MULTILINE)
-        text = re.sub(r'^\s*\d+\.\s*', '', text, flags=re.MULTILINE)
-        text = re.sub(r'^>\s*', '', text, flags=re.MULTILINE)
-        text = re.sub(r'^-{3,}$', '', text, flags=re.MULTILINE)
-        text = re.sub(r'^\*{3,}$', '', text, flags=re.MULTILINE)
-        text = re.sub(r'^_{3,}$', '', text, flags=re.MULTILINE)
-        text = re.sub(r'\n{3,}', '\n\n', text)
+        for markers, pattern, repl in _MARKDOWN_INLINE_RULES:
+            if any(marker in text for marker in markers):
+                text = pattern.sub(repl, text)
+        text = text.replace('|', '')
+        for markers, pattern, repl in _MARKDOWN_BLOCK_RULES:
+            if any(marker in text for marker in markers):
+                text = pattern.sub(repl, text)
         text = text.strip()
         return text
     
@@ -108,6 +150,34 @@ class SimpleTextFilter:
                 return True
         return False
     
+    @staticmethod
+    def _keep_char(ch, strict):
+        """判断 remove_emoji 是否保留该字符"""
+        # 跳过 emoji 字符和少见字符（泰文等）
+        if SimpleTextFilter.is_emoji_char(ch) or SimpleTextFilter.is_rare_char(ch):
+            return False
+        
+        cat = unicodedata.category(ch)
+        if strict:
+            # 严格模式：只保留字母、数字、其它标点（中文的，。！？；：、都属于其它标点）和空白
+            return cat[0] in ("L", "N") or cat == "Po" or ch in _KEPT_WHITESPACE
+        # 非严格模式（默认）：保留所有非 emoji 的可见字符
+        return cat[0] in ("L", "N", "P", "S", "Z") or ch in _KEPT_WHITESPACE
+    
+    @staticmethod
+    def _get_deletion_table(strict):
+        """获取当前配置下 remove_emoji 使用的删除表"""
+        cls = SimpleTextFilter
+        key = (cls.ENABLE_EMOJI_REMOVAL, cls.ENABLE_RARE_CHAR_REMOVAL, tuple(cls.EMOJI_RANGES),
+               tuple(cls.RARE_CHAR_RANGES), tuple(cls.EMOJI_WHITELIST), bool(strict))
+        table = cls._deletion_tables.get(key)
+        if table is None:
+            if len(cls._deletion_tables) >= 8:
+                # 配置反复变化时丢弃旧表
+                cls._deletion_tables.clear()
+            table = cls._deletion_tables[key] = _DeletionTable(lambda ch: cls._keep_char(ch, strict))
+        return table
+    
     @staticmethod
     def remove_emoji(text, strict=False):
         """
@@ -124,39 +194,11 @@ class SimpleTextFilter:
         if not SimpleTextFilter.ENABLE_EMOJI_REMOVAL:
             return text
 
-        allowed_prefix = ("L", "N", "P", "S", "Z")
-        out_chars = []
-        
-        for ch in text:
-            # 跳过 emoji 字符
-            if SimpleTextFilter.is_emoji_char(ch):
-                continue
-            
-            # 跳过少见字符（泰文等）
-            if SimpleTextFilter.is_rare_char(ch):
-                continue
-            
-            cat = unicodedata.category(ch)
-            
-            if strict:
-                # 严格模式：只保留基础 ASCII + 中文 + 常见标点
-                if cat and cat[0] in ("L", "N"):  # 字母、数字
-                    out_chars.append(ch)
-                elif cat == "Po":  # 其它标点
-                    out_chars.append(ch)
-                elif ch in ("\n", "\r", "\t", " ", "，", "。", "！", "？", "；", "：", """, """, "、"):
-                    out_chars.append(ch)
-            else:
-                # 非严格模式（默认）：保留所有非 emoji 的可见字符
-                if cat and cat[0] in allowed_prefix:
-                    out_chars.append(ch)
-                elif ch in ("\n", "\r", "\t", " "):
-                    out_chars.append(ch)
-
-        result = "".join(out_chars)
+        # 按字符逐个判断的结果缓存在删除表中，整段文本只需一次 str.translate
+        result = text.translate(SimpleTextFilter._get_deletion_table(strict))
         # 合并多余空格（保留换行）
-        result = re.sub(r'[ \t]+', ' ', result)
-        result = re.sub(r'\n\s*\n', '\n\n', result)
+        result = _SPACES_RE.sub(' ', result)
+        result = _BLANK_LINES_RE.sub('\n\n', result)
         return result.strip()
     
     @staticmethod
@@ -181,11 +223,12 @@ class SimpleTextFilter:
         if remove_markdown:
             text = SimpleTextFilter.remove_markdown(text)
         
-        if remove_emoji:
-            text = SimpleTextFilter.remove_emoji(text, strict=strict_emoji)
+        if remove_emoji and SimpleTextFilter.ENABLE_EMOJI_REMOVAL:
+            # remove_emoji 已合并空白并去掉首尾空白，再做一遍结果不变
+            return SimpleTextFilter.remove_emoji(text, strict=strict_emoji)
             
-        text = re.sub(r'[ \t]+', ' ', text)
-        text = re.sub(r'\n\s*\n', '\n\n', text)
+        text = _SPACES_RE.sub(' ', text)
+        text = _BLANK_LINES_RE.sub('\n\n', text)
         text = text.strip()
         
         return text
@@ -213,4 +256,97 @@ class SimpleTextFilter:
     @staticmethod
     def set_rare_char_removal_enabled(enabled):
         """启用/禁用少见字符移除功能"""
-        SimpleTextFilter.ENABLE_RARE_CHAR_REMOVAL = enabled
\ No newline at end of file
+        SimpleTextFilter.ENABLE_RARE_CHAR_REMOVAL = enabled
+
+if __name__ == "__main__":
+    # 基准测试：对约 100KB 的模型输出（markdown、emoji、中英文混排）对比原实现与预编译实现的耗时，并校验输出完全一致
+    # 用法: python -m tool.simple_text_filter [文本KB数] [轮数]
+    import random
+    import sys
+    import time
+
+    size_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    def reference_remove_markdown(text):
+        # 原实现：每条规则单独调用 re.sub
+        if not text:
+            return text
+        text = re.sub(r'^#{1,6}\s*', '', text, flags=re.MULTILINE)
+        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+        text = re.sub(r'\*(.*?)\*', r'\1', text)
+        text = re.sub(r'__(.*?)__', r'\1', text)
+        text = re.sub(r'_(.*?)_', r'\1', text)
+        text = re.sub(r'```[\s\S]*?```', '', text)
+        text = re.sub(r'`(.*?)`', r'\1', text)
+        text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+        text = re.sub(r'!\[[^\]]*\]\([^\)]+\)', '', text)
+        text = re.sub(r'\|', '', text)
+        text = re.sub(r'-{3,}', '', text)
+        text = re.sub(r'^\s*[-*+]\s*', '', text, flags=re.MULTILINE)
+        text = re.sub(r'^\s*\d+\.\s*', '', text, flags=re.MULTILINE)
+        text = re.sub(r'^>\s*', '', text, flags=re.MULTILINE)
+        text = re.sub(r'^-{3,}$', '', text, flags=re.MULTILINE)
+        text = re.sub(r'^\*{3,}$', '', text, flags=re.MULTILINE)
+        text = re.sub(r'^_{3,}$', '', text, flags=re.MULTILINE)
+        text = re.sub(r'\n{3,}', '\n\n', text)
+        return text.strip()
+
+    def reference_remove_emoji(text, strict=False):
+        # 原实现：逐个字符在 Python 中判断
+        if not text or not SimpleTextFilter.ENABLE_EMOJI_REMOVAL:
+            return text
+        out_chars = []
+        for ch in text:
+            if SimpleTextFilter.is_emoji_char(ch) or SimpleTextFilter.is_rare_char(ch):
+                continue
+            cat = unicodedata.category(ch)
+            if strict:
+                if cat[0] in ("L", "N") or cat == "Po" or ch in ("\n", "\r", "\t", " ", "，", "。", "！", "？", "；", "：", "、"):
+                    out_chars.append(ch)
+            elif cat[0] in ("L", "N", "P", "S", "Z") or ch in ("\n", "\r", "\t", " "):
+                out_chars.append(ch)
+        result = re.sub(r'[ \t]+', ' ', "".join(out_chars))
+        result = re.sub(r'\n\s*\n', '\n\n', result)
+        return result.strip()
+
+    def reference_clean_text(text, strict_emoji=False):
+        text = re.sub(r'<think>[\s\S]*?</think>\s*', '', text, flags=re.IGNORECASE | re.DOTALL).strip()
+        text = reference_remove_markdown(text)
+        text = reference_remove_emoji(text, strict=strict_emoji)
+        text = re.sub(r'[ \t]+', ' ', text)
+        text = re.sub(r'\n\s*\n', '\n\n', text)
+        return text.strip()
+
+    # 模拟模型回复：以中英文正文为主，夹杂 markdown 标记、emoji 和少见文字
+    random.seed(1)
+    prose = ["今天天气很好，我们一起去公园散步吧。", "这个问题可以从三个方面来分析：原因、影响和对策。",
+             "当然可以！下面是详细的说明，希望对你有帮助。", "The quick brown fox jumps over the lazy dog. ",
+             "Here is a short explanation of how the algorithm works, step by step. ", "好的～我明白了(๑•̀ㅂ•́)و✧ ", "\n"]
+    markup = ["# 标题\n", "## Heading two\n", "**加粗**文字", "*斜体* and _underline_ __bold__", "`code`",
+              "```python\nprint('hi')\n```\n", "[链接](https://example.com)", "![](img.png)", "| 列1 | 列2 |\n|---|---|\n",
+              "- 列表项\n", "1. 第一项\n", "> 引用\n", "***\n", "\n\n\n", "😀🎉👍🏻❤️", "☀★✨⌘", "สวัสดี", "é", "a‍b",
+              "\t  多余   空格  ", "<think>思考过程</think>", "！？；：、“引号”"]
+    text = ""
+    while len(text.encode("utf-8")) < size_kb * 1024:
+        text += random.choice(markup) if random.random() < 0.15 else random.choice(prose)
+
+    for strict in (False, True):
+        expected = reference_clean_text(text, strict_emoji=strict)
+        actual = SimpleTextFilter.clean_text(text, strict_emoji=strict)
+        assert actual.encode("utf-8") == expected.encode("utf-8"), "输出与原实现不一致"
+
+    # 取多轮中最快的一次，减少其他进程造成的抖动
+    timings = {}
+    for name, func in (("原实现", reference_clean_text), ("预编译实现", SimpleTextFilter.clean_text)):
+        best = float('inf')
+        for _ in range(rounds):
+            start = time.perf_counter()
+            func(text)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best * 1000
+
+    print(f"文本 {len(text.encode('utf-8')) / 1024:.0f}KB，{rounds} 轮，两种模式输出与原实现逐字节一致")
+    for name, elapsed in timings.items():
+        print(f"{name:<10} 每次 {elapsed:.1f}ms")
+    print(f"加速 {timings['原实现'] / timings['预编译实现']:.1f}x")
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite 存储后端模块
+可选的聊天记录与角色存储，适用于角色数量多、消息量大的场景。
+使用 WAL 模式、参数化语句缓存和 (character, seq) 索引，
+通过 data_saver.use_sqlite_backend() 启用后，data_saver 的读写函数与
+CharacterManager 的配置方法会自动转发到这里。
+"""
+
+import glob
+import json
+import os
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    character TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT,
+    extra TEXT,
+    msg_id INTEGER,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (character, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS characters (
+    name TEXT PRIMARY KEY,
+    data_file TEXT,
+    description TEXT,
+    icon TEXT,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+_INDEX_SCHEMA = "CREATE INDEX IF NOT EXISTS idx_messages_id ON messages (character, msg_id)"
+
+# 固定的参数化语句，sqlite3 会缓存其编译结果
+_SQL_NEXT_SEQ = "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE character = ?"
+_SQL_INSERT_MESSAGE = ("INSERT INTO messages (character, seq, role, content, timestamp, extra, msg_id) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)")
+_SQL_SELECT_RANGE = ("SELECT role, content, timestamp, extra, msg_id FROM messages "
+                     "WHERE character = ? AND seq >= ? AND seq < ? AND deleted = 0 ORDER BY seq")
+_SQL_EDIT_MESSAGE = ("UPDATE messages SET content = ?, extra = json_set(COALESCE(extra, '{}'), '$.edited_at', ?) "
+                     "WHERE character = ? AND msg_id = ?")
+_SQL_DELETE_MESSAGE = "UPDATE messages SET deleted = 1 WHERE character = ? AND msg_id = ?"
+_SQL_SEARCH = ("SELECT role, content, timestamp, extra, msg_id FROM messages "
+               "WHERE character = ? AND deleted = 0 AND instr(content, ?) > 0 ORDER BY seq DESC LIMIT ?")
+_SQL_DELETE_CHARACTER_MESSAGES = "DELETE FROM messages WHERE character = ?"
+_SQL_LIST_CHARACTERS = "SELECT name, data_file, description, icon FROM characters ORDER BY position"
+_SQL_INSERT_CHARACTER = ("INSERT OR IGNORE INTO characters (name, data_file, description, icon, position) "
+                         "VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(position) + 1, 0) FROM characters))")
+_SQL_DELETE_CHARACTER = "DELETE FROM characters WHERE name = ?"
+_SQL_GET_SETTING = "SELECT value FROM settings WHERE key = ?"
+_SQL_SET_SETTING = "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)"
+
+_MESSAGE_FIELDS = ("id", "role", "content", "timestamp")
+
+
+def conversation_key(data_file_path: str) -> str:
+    """
+    由聊天记录文件路径得到会话键（文件名去掉扩展名，如 chat_history_AI）
+
+    与文件后端使用同一套路径，切换后端时不需要修改角色配置。
+    """
+    name = os.path.basename(data_file_path)
+    for suffix in (".jsonl", ".json"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+class SQLiteChatStore:
+    """基于 SQLite 的聊天记录与角色存储"""
+
+    def __init__(self, db_path: str):
+        """
+        初始化 SQLite 存储
+
+        Args:
+            db_path: 数据库文件路径
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # UI 线程读、持久化线程写，共享一个连接并用锁串行化
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=64)
+        self._lock = threading.RLock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            self._upgrade_schema()
+            self._conn.execute(_INDEX_SCHEMA)
+            self._conn.commit()
+
+    def _upgrade_schema(self):
+        """为没有消息 id 列的旧数据库补列，旧消息的 id 取 seq + 1（与 JSONL 回放规则一致）"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(messages)")}
+        if "msg_id" not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN msg_id INTEGER")
+            self._conn.execute("UPDATE messages SET msg_id = seq + 1")
+        if "deleted" not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _to_row(character: str, seq: int, message: Dict[str, Any]) -> tuple:
+        extra = {k: v for k, v in message.items() if k not in _MESSAGE_FIELDS}
+        return (character, seq, message.get("role", "user"), message.get("content", ""),
+                message.get("timestamp"), json.dumps(extra, ensure_ascii=False) if extra else None,
+                message.get("id", seq + 1))
+
+    @staticmethod
+    def _from_row(row: tuple) -> Dict[str, Any]:
+        role, content, timestamp, extra, msg_id = row
+        message = {"id": msg_id, "role": role, "content": content}
+        if timestamp is not None:
+            message["timestamp"] = timestamp
+        if extra:
+            message.update(json.loads(extra))
+        return message
+
+    # ---- 聊天记录 ----
+
+    def count_messages(self, character: str) -> int:
+        """返回会话的记录数，含已撤回的（seq 连续，MAX(seq) 走主键索引）"""
+        with self._lock:
+            return self._conn.execute(_SQL_NEXT_SEQ, (character,)).fetchone()[0]
+
+    def append_messages(self, character: str, messages: List[Dict[str, Any]]) -> None:
+        """
+        在一个事务内按顺序追加多条消息
+
+        编辑/撤回补丁记录（带 "op" 字段）不插入新行，而是按 id 更新原消息或标记为已撤回。
+        """
+        with self._lock, self._conn:
+            seq = self._conn.execute(_SQL_NEXT_SEQ, (character,)).fetchone()[0]
+            for message in messages:
+                op = message.get("op")
+                if op == "edit":
+                    self._conn.execute(_SQL_EDIT_MESSAGE, (message.get("content", ""), message.get("edited_at"),
+                                                           character, message["id"]))
+                elif op == "del":
+                    self._conn.execute(_SQL_DELETE_MESSAGE, (character, message["id"]))
+                else:
+                    self._conn.execute(_SQL_INSERT_MESSAGE, self._to_row(character, seq, message))
+                    seq += 1
+
+    def load_range(self, character: str, start: int, end: int) -> List[Dict[str, Any]]:
+        """读取第 start 到 end（不含）条消息"""
+        with self._lock:
+            rows = self._conn.execute(_SQL_SELECT_RANGE, (character, start, end)).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def load_messages(self, character: str) -> List[Dict[str, Any]]:
+        """读取会话的全部消息"""
+        return self.load_range(character, 0, self.count_messages(character))
+
+    def load_tail(self, character: str, limit: int) -> Tuple[List[Dict[str, Any]], int]:
+        """读取最近 limit 条消息，返回 (消息列表, 起始位置)"""
+        with self._lock:
+            count = self.count_messages(character)
+            start = max(count - limit, 0)
+            return self.load_range(character, start, count), start
+
+    def search_messages(self, character: str, keyword: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """按关键字搜索消息，最新的在前"""
+        with self._lock:
+            rows = self._conn.execute(_SQL_SEARCH, (character, keyword, limit)).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def delete_messages(self, character: str) -> None:
+        """删除会话的全部消息"""
+        with self._lock, self._conn:
+            self._conn.execute(_SQL_DELETE_CHARACTER_MESSAGES, (character,))
+
+    # ---- 角色 ----
+
+    def list_characters(self) -> List[Dict[str, Any]]:
+        """按添加顺序返回所有角色"""
+        with self._lock:
+            rows = self._conn.execute(_SQL_LIST_CHARACTERS).fetchall()
+        return [{"name": name, "data_file": data_file, "description": description, "icon": icon}
+                for name, data_file, description, icon in rows]
+
+    def add_character(self, character: Dict[str, Any]) -> None:
+        """添加角色（已存在时忽略）"""
+        with self._lock, self._conn:
+            self._conn.execute(_SQL_INSERT_CHARACTER, (
+                character["name"], character.get("data_file"),
+                character.get("description"), character.get("icon")
+            ))
+
+    def remove_character(self, name: str) -> None:
+        """删除角色记录"""
+        with self._lock, self._conn:
+            self._conn.execute(_SQL_DELETE_CHARACTER, (name,))
+
+    def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(_SQL_GET_SETTING, (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key: str, value: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(_SQL_SET_SETTING, (key, value))
+
+    # ---- 导入 ----
+
+    def import_json_histories(self, data_dir: str) -> int:
+        """
+        从 data/chat_history_*.json(l) 导入已有聊天记录（数据库中已有的会话跳过）
+
+        Args:
+            data_dir: 数据目录
+
+        Returns:
+            int: 导入的会话数量
+        """
+        from .data_saver import load_chat_data_from_files
+
+        keys = set()
+        for pattern in ("chat_history_*.json", "chat_history_*.jsonl", "chat_data.json", "chat_data.jsonl"):
+            for path in glob.glob(os.path.join(data_dir, pattern)):
+                keys.add(conversation_key(path))
+
+        imported = 0
+        for key in sorted(keys):
+            if self.count_messages(key) > 0:
+                continue
+            messages = load_chat_data_from_files(os.path.join(data_dir, key + ".json"))
+            messages = [m for m in messages if isinstance(m, dict)]
+            if messages:
+                self.append_messages(key, messages)
+                imported += 1
+                print(f"已导入聊天记录: {key} ({len(messages)} 条)")
+        return imported
+
+    def import_characters(self, characters: List[Dict[str, Any]], current_character: Optional[str] = None) -> None:
+        """从 config.json 的角色列表导入角色"""
+        for character in characters:
+            if isinstance(character, dict) and character.get("name"):
+                self.add_character(character)
+        if current_character:
+            self.set_setting("current_character", current_character)
+
+
+if __name__ == "__main__":
+    # 简单测试：导入 data 目录并读取最近的消息
+    # 用法: python -m tool.sqlite_store [data目录] [数据库路径]
+    import sys
+    import tempfile
+
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "data")
+    db_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(tempfile.mkdtemp(), "yuchat.db")
+    store = SQLiteChatStore(db_path)
+    print(f"导入会话数: {store.import_json_histories(data_dir)}")
+    for path in glob.glob(os.path.join(data_dir, "chat_history_*.json")):
+        key = conversation_key(path)
+        tail, start = store.load_tail(key, 3)
+        print(f"{key}: 共 {store.count_messages(key)} 条，最近 {len(tail)} 条从第 {start} 条开始")
+    store.close()
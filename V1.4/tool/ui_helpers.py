@@ -20,7 +20,7 @@ def toast(text):
     ).open()
 
 class CopyLabel(MDBoxLayout):
-    def __init__(self, *args, message_role="assistant", on_double_tap_callback=None, **kwargs):
+    def __init__(self, *args, message_role="assistant", on_double_tap_callback=None, message_id=None, **kwargs):
         # 移除text参数，避免冲突
         text_content = kwargs.pop('text', '')
         super().__init__(*args, **kwargs)
@@ -28,6 +28,7 @@ class CopyLabel(MDBoxLayout):
         self.size_hint_y = None
         self.adaptive_height = True
         self.message_role = message_role  # 添加角色标识："user" 或 "assistant"
+        self.message_id = message_id  # 对应聊天记录中消息的 id（错误提示等未保存的消息为 None）
         self._text_content = text_content  # 存储文本内容
         self._on_double_tap_callback = on_double_tap_callback  # 双击回调函数
         
@@ -260,11 +261,11 @@ class CopyLabel(MDBoxLayout):
     
     @text.setter
     def text(self, value):
+        # 同步保存，避免延迟的 _setup_text_and_height 用旧内容覆盖新文本（流式回复时会频繁更新）
+        self._text_content = value
         if hasattr(self, 'label'):
             self.label.text = value
             self._update_height(0)
-        else:
-            self._text_content = value
 
 class ChatBubble(MDBoxLayout):
     